@@ -0,0 +1,42 @@
+# python -m benchmarks.bench_binary
+import json
+import time
+
+from trickle_block_util.binary import encodeBlocks, decodeBlocks, iterBlocks
+from trickle_block_util.generator import createAssistantCommentBlocks
+
+
+def timed(func, repeat: int = 5):
+    best = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        out = func()
+        seconds = time.perf_counter() - tic
+        best = seconds if best is None else min(best, seconds)
+    return out, best
+
+
+def bench(name, blocks):
+    jsonData, jsonEncode = timed(lambda: json.dumps(blocks).encode("utf-8"))
+    _, jsonDecode = timed(lambda: json.loads(jsonData))
+    binData, binEncode = timed(lambda: encodeBlocks(blocks))
+    decoded, binDecode = timed(lambda: decodeBlocks(binData))
+    _, binSkip = timed(lambda: list(iterBlocks(binData, skipChildren=True)))
+    assert decoded == blocks, name
+    print(f"{name:<12} json={len(jsonData):>9}B binary={len(binData):>9}B "
+          f"({len(binData) / len(jsonData):.0%}) | "
+          f"encode json={jsonEncode * 1000:7.1f}ms binary={binEncode * 1000:7.1f}ms | "
+          f"decode json={jsonDecode * 1000:7.1f}ms binary={binDecode * 1000:7.1f}ms "
+          f"skipChildren={binSkip * 1000:7.1f}ms")
+
+
+def main():
+    paragraph = "- point with **bold** and *italic* and `code` " \
+                "[link](https://www.trickle.so)\n"
+    for n in [100, 2000]:
+        markdown = ("# Title\n\n" + paragraph * 5 + "\n> quote\n> - nested\n\n") * n
+        bench(f"doc-{n}", createAssistantCommentBlocks(markdown))
+
+
+if __name__ == "__main__":
+    main()
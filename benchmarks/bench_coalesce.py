@@ -0,0 +1,42 @@
+# python -m benchmarks.bench_coalesce
+import copy
+import time
+
+import mistune
+from mistune.core import BlockState
+
+from trickle_block_util.generator import TrickleBlockRenderer
+
+
+def softWrapped(lines: int) -> str:
+    # 一个很长的段落，每行都是软换行，中间夹一些行内格式
+    out = []
+    for i in range(lines):
+        if i % 10 == 0:
+            out.append(f"line {i} with **bold** and `code`")
+        else:
+            out.append(f"line {i} of a soft wrapped paragraph")
+    return "\n".join(out)
+
+
+def main():
+    parser = mistune.create_markdown(renderer=None, hard_wrap=False)
+    renderer = TrickleBlockRenderer()
+    for lines in [1000, 5000, 20000]:
+        tokens = parser(softWrapped(lines))
+        snapshot = copy.deepcopy(tokens)
+        best = None
+        for _ in range(5):
+            tic = time.perf_counter()
+            blocks = renderer(tokens, BlockState())
+            seconds = time.perf_counter() - tic
+            best = seconds if best is None else min(best, seconds)
+        # 渲染不能修改解析结果
+        assert tokens == snapshot
+        elements = sum(len(b["elements"]) for b in blocks)
+        print(f"lines={lines:<6} blocks={len(blocks):<3} elements={elements:<6} "
+              f"render={best * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
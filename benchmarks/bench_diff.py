@@ -0,0 +1,69 @@
+# python -m benchmarks.bench_diff
+import copy
+import json
+import random
+import time
+
+from trickle_block_util.diff import diffBlocks, applyPatch
+from trickle_block_util.generator import Block, Element, generateUUID
+
+
+def makeDocument(n: int):
+    out = []
+    for i in range(n):
+        out.append(Block.rich_texts([
+            Element.normalText(f"paragraph {i} "),
+            Element.bold([Element.normalText("with some bold text")]),
+        ]).toJson())
+    return out
+
+
+def editDocument(blocks, rnd: random.Random, ratio: float = 0.01):
+    # 典型编辑: 1%修改、1%删除、1%插入、少量移动
+    out = copy.deepcopy(blocks)
+    k = max(1, int(len(out) * ratio))
+    for i in rnd.sample(range(len(out)), k):
+        out[i]['elements'][0]['text'] = f"edited {i} "
+    for i in sorted(rnd.sample(range(len(out)), k), reverse=True):
+        out.pop(i)
+    for _ in range(k):
+        out.insert(rnd.randrange(len(out)),
+                   Block.raw(f"inserted {rnd.random()}").toJson())
+    for _ in range(max(1, k // 4)):
+        out.insert(rnd.randrange(len(out)), out.pop(rnd.randrange(len(out))))
+    return out
+
+
+def rewriteIds(blocks):
+    # AI重新生成时所有id都是新的
+    out = copy.deepcopy(blocks)
+    for b in out:
+        b['id'] = generateUUID()
+    return out
+
+
+def bench(name, oldBlocks, newBlocks):
+    tic = time.perf_counter()
+    patch = diffBlocks(oldBlocks, newBlocks)
+    diffSeconds = time.perf_counter() - tic
+    tic = time.perf_counter()
+    rebuilt = applyPatch(oldBlocks, patch)
+    applySeconds = time.perf_counter() - tic
+    assert rebuilt == newBlocks, name
+    print(f"{name:<24} blocks={len(newBlocks):<6} ops={len(patch['ops']):<6} "
+          f"diff={diffSeconds * 1000:8.1f}ms apply={applySeconds * 1000:8.1f}ms "
+          f"patch={len(json.dumps(patch)) / len(json.dumps(newBlocks)):6.1%} of full")
+
+
+def main():
+    rnd = random.Random(0)
+    for n in [1000, 10000]:
+        doc = makeDocument(n)
+        edited = editDocument(doc, rnd)
+        bench(f"edit-{n}", doc, edited)
+        bench(f"rewrite-ids-{n}", doc, rewriteIds(edited))
+        bench(f"unchanged-{n}", doc, doc)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# python -m benchmarks.bench_flyweight
+# 统计大段AI输出渲染成 Block/Element 对象时，共享的空节点（EMPTY_TEXT/EMPTY_BLOCK）省掉了多少对象，
+# 从json读入的block里 type/display/constraint 字符串是否只有一份，以及转换的峰值内存。
+import gc
+import json
+import time
+import tracemalloc
+
+from benchmarks.corpus import longMarkdown
+from trickle_block_util import generator
+from trickle_block_util.generator import Block, createAssistantCommentBlocks
+from trickle_block_util.renderer import TrickleBlockRenderer, getParser
+
+
+def nodeCounts(blocks):
+    """返回 (节点引用数, 不同对象数)，没有共享节点时两者相等。"""
+    references = 0
+    distinct = set()
+    stack = list(blocks)
+    while stack:
+        node = stack.pop()
+        references += 1
+        distinct.add(id(node))
+        stack.extend(getattr(node, "blocks", ()))
+        stack.extend(node.elements)
+    return references, len(distinct)
+
+
+def renderTree(text: str):
+    tokens, state = getParser(hardWrap=True).parse(text)
+    return TrickleBlockRenderer().render_blocks(tokens, state)
+
+
+def peak(func, rounds: int = 3):
+    # 取几次里最小的峰值，减少gc时机带来的波动
+    best = None
+    for _ in range(rounds):
+        gc.collect()
+        tracemalloc.start()
+        func()
+        _, peakBytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        best = peakBytes if best is None else min(best, peakBytes)
+    return best
+
+
+def distinctStrings(blocks, fields):
+    values = {}
+    stack = list(blocks)
+    while stack:
+        node = stack.pop()
+        for field in fields:
+            value = getattr(node, field, None)
+            if value is not None:
+                values.setdefault(value, set()).add(id(value))
+        stack.extend(getattr(node, "blocks", ()))
+        stack.extend(node.elements)
+    return sum(len(ids) for ids in values.values()), len(values)
+
+
+def main():
+    text = longMarkdown(400) + "\n\n\n".join(
+        f"**bold {i}** and `code {i}` and *it* [l](https://www.trickle.so/{i})"
+        for i in range(2000))
+    print(f"input {len(text) / 1024:.0f}KB")
+
+    tree = renderTree(text)
+    references, distinct = nodeCounts(tree)
+    print(f"rendered tree: {references} node references, {distinct} objects, "
+          f"{references - distinct} shared "
+          f"({(references - distinct) / references:.0%} of nodes are EMPTY_TEXT/EMPTY_BLOCK)")
+
+    stored = json.loads(json.dumps(createAssistantCommentBlocks(text, useCache=False)))
+    loaded = [Block.fromJson(b) for b in stored]
+    objects, values = distinctStrings(loaded, ["type", "display", "constraint"])
+    print(f"fromJson: {values} distinct type/display/constraint values held by "
+          f"{objects} string objects")
+
+    tic = time.perf_counter()
+    createAssistantCommentBlocks(text, useCache=False)
+    seconds = time.perf_counter() - tic
+    print(f"createAssistantCommentBlocks: {seconds * 1000:.1f}ms, "
+          f"peak {peak(lambda: createAssistantCommentBlocks(text, useCache=False)) / 1e6:.1f}MB; "
+          f"render tree only: peak {peak(lambda: renderTree(text)) / 1e6:.1f}MB; "
+          f"fromJson: peak {peak(lambda: [Block.fromJson(b) for b in stored]) / 1e6:.1f}MB")
+    assert generator.EMPTY_TEXT.toJson()["id"] != generator.EMPTY_TEXT.toJson()["id"]
+
+
+if __name__ == "__main__":
+    main()
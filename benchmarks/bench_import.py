@@ -0,0 +1,62 @@
+# python -m benchmarks.bench_import
+# 冷启动: 用 python -X importtime 统计导入 generator 的耗时，并检查 mistune/tiktoken/pytz
+# 没有在导入时被加载。有模块被提前加载时返回 1。
+from typing import Dict, List, Tuple
+import subprocess
+import sys
+import time
+
+LAZY_MODULES = ["mistune", "tiktoken", "pytz", "pprint"]
+
+SCRIPTS = {
+    "import generator": "import trickle_block_util.generator",
+    "import + blocksToMarkdown":
+        "from trickle_block_util.generator import blocksToMarkdown\n"
+        "blocksToMarkdown([{'type': 'rich_texts', 'elements': "
+        "[{'type': 'text', 'text': 'hi'}]}])",
+    "import + createAssistantCommentBlocks":
+        "from trickle_block_util.generator import createAssistantCommentBlocks\n"
+        "createAssistantCommentBlocks('**hi**')",
+}
+
+
+def importTimes(script: str) -> Tuple[Dict[str, Tuple[int, int]], float]:
+    """返回 ({模块名: (self us, cumulative us)}, 进程总耗时秒)。"""
+    tic = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", script],
+                          capture_output=True, text=True, check=True)
+    seconds = time.perf_counter() - tic
+    out = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        selfUs, cumulativeUs, name = line[len("import time:"):].split("|")
+        out[name.strip()] = (int(selfUs), int(cumulativeUs))
+    return out, seconds
+
+
+def best(script: str, rounds: int = 5) -> Tuple[Dict[str, Tuple[int, int]], float]:
+    results = [importTimes(script) for _ in range(rounds)]
+    return min(results, key=lambda r: r[1])
+
+
+def main() -> int:
+    eager: List[str] = []
+    for label, script in SCRIPTS.items():
+        modules, seconds = best(script)
+        _, cumulative = modules.get("trickle_block_util.generator", (0, 0))
+        print(f"{label:<40} process={seconds * 1000:7.1f}ms "
+              f"generator import={cumulative / 1000:6.1f}ms modules={len(modules)}")
+        if label == "import generator":
+            eager = [m for m in LAZY_MODULES if m in modules]
+            heaviest = sorted(modules.items(), key=lambda kv: -kv[1][0])[:5]
+            for name, (selfUs, _) in heaviest:
+                print(f"    {name:<36} self={selfUs / 1000:6.1f}ms")
+    if eager:
+        print(f"loaded eagerly on import: {', '.join(eager)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
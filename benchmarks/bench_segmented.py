@@ -0,0 +1,63 @@
+# python -m benchmarks.bench_segmented [--workers N]
+# 比较几百KB输入整体一次解析和分段解析的耗时，结果不一致时返回 1。
+# 分段边界的各种情况在 tests/test_segmented.py 里检查。
+from typing import Dict, List
+import argparse
+import os
+import sys
+import time
+
+from benchmarks.corpus import longMarkdown
+from trickle_block_util import generator
+from trickle_block_util.cache import _reassignIds
+from trickle_block_util.segmented import createAssistantCommentBlocksSegmented, \
+    shutdownExecutor
+
+
+def normalized(blocks: List[Dict]) -> List[Dict]:
+    # 只有随机生成的id不同
+    _reassignIds(blocks, lambda: "id")
+    return blocks
+
+
+def singlePass(text: str) -> List[Dict]:
+    return generator._markdownToBlocks(text, None, None)
+
+
+def timed(func, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - tic
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="bench_segmented")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--sections", type=int, default=1500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    text = longMarkdown(args.sections)
+    single = singlePass(text)
+    parallel = createAssistantCommentBlocksSegmented(text, workers=args.workers)
+    same = normalized(parallel) == normalized(single)
+    if not same:
+        print("MISMATCH: long document")
+    try:
+        singleSeconds = timed(lambda: singlePass(text), args.repeat)
+        parallelSeconds = timed(lambda: createAssistantCommentBlocksSegmented(
+            text, workers=args.workers), args.repeat)
+    finally:
+        shutdownExecutor()
+    print(f"{len(text) / 1024:.0f}KB, {len(single)} blocks, workers={args.workers}: "
+          f"single {singleSeconds * 1000:.1f}ms, segmented {parallelSeconds * 1000:.1f}ms, "
+          f"speedup {singleSeconds / parallelSeconds:.2f}x")
+    return 0 if same else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+# python -m benchmarks.bench_threads [--workers N]
+# 多线程同时使用 parser/renderer/tokenizer 的结果要和单线程一样，不一样时返回 1；
+# 再比较单线程和 batch 线程池拼prompt、算token的耗时。
+# 普通CPython和 free-threaded CPython（python3.13t）都可以跑，输出里会注明GIL是否开启。
+from typing import Dict, List
+import argparse
+import sys
+import sysconfig
+import threading
+import time
+
+from benchmarks.corpus import commentThread, longMarkdown, sampleMessages
+from trickle_block_util import batch, generator, renderer, tokenizer
+from trickle_block_util.cache import _reassignIds
+
+
+def gilStatus() -> str:
+    # sys._is_gil_enabled 从3.13开始才有
+    isGilEnabled = getattr(sys, "_is_gil_enabled", None)
+    freeThreadedBuild = bool(sysconfig.get_config_var("Py_GIL_DISABLED"))
+    enabled = isGilEnabled() if isGilEnabled is not None else True
+    return f"python {sys.version.split()[0]}, free-threaded build: {freeThreadedBuild}, " \
+           f"GIL enabled: {enabled}"
+
+
+def normalized(blocks: List[Dict]) -> List[Dict]:
+    _reassignIds(blocks, lambda: "id")
+    return blocks
+
+
+def checkParserInit(threads: int) -> bool:
+    # 多个线程同时第一次调用 getParser 时只创建一个parser
+    renderer._parsers.clear()
+    barrier = threading.Barrier(threads)
+    parsers = []
+
+    def worker():
+        barrier.wait()
+        parsers.append(renderer.getParser(hardWrap=True))
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return len({id(p) for p in parsers}) == 1
+
+
+def checkSharedRenderer(messages: List[str], workers: int) -> bool:
+    # 同一个 parser 和 TrickleBlockRenderer 实例在多个线程里同时使用
+    parser = renderer.getParser(hardWrap=True)
+    shared = renderer.TrickleBlockRenderer()
+
+    def convert(message: str) -> List[Dict]:
+        tokens, state = parser.parse(message)
+        return normalized(shared(tokens, state))
+
+    serial = [convert(m) for m in messages]
+    return batch.mapBatch(convert, messages, workers) == serial
+
+
+def timed(func, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - tic
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def report(name: str, serial: float, threaded: float, workers: int):
+    print(f"{name:<24} serial {serial * 1000:9.1f}ms  threads={workers} "
+          f"{threaded * 1000:9.1f}ms  speedup {serial / threaded:5.2f}x")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="bench_threads")
+    parser.add_argument("--workers", type=int, default=batch.defaultWorkers())
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    print(gilStatus())
+
+    messages = list(sampleMessages().values()) * 20 + \
+        [longMarkdown(20, seed) for seed in range(20)]
+    checks = {
+        "getParser init": checkParserInit(max(args.workers, 8)),
+        "shared renderer": checkSharedRenderer(messages, args.workers),
+    }
+    failed = [name for name, ok in checks.items() if not ok]
+    for name, ok in checks.items():
+        print(f"{name}: {'ok' if ok else 'MISMATCH'}")
+
+    posts = [{"title": f"post {i}",
+              "blocks": generator.createAssistantCommentBlocks(
+                  longMarkdown(8, i), useCache=False)}
+             for i in range(args.posts)]
+    threads = [commentThread(12) for _ in range(max(1, args.posts // 10))]
+    try:
+        cases = {
+            "content prompts": lambda workers: batch.contentPromptsBatch(
+                posts, maxTokens=None, workers=workers),
+            "comment prompts": lambda workers: batch.commentPromptsBatch(
+                threads, maxTokens=None, workers=workers),
+        }
+        try:
+            tokenizer.getEncoding()
+        except Exception as e:
+            print(f"tokenizer unavailable, skipping token cases: {type(e).__name__}: {e}")
+        else:
+            texts = [generator.blocksToMarkdown(p["blocks"]) for p in posts]
+            cases["count tokens"] = lambda workers: batch.countTokensBatch(
+                texts, workers=workers)
+            cases["content prompts 1500"] = lambda workers: batch.contentPromptsBatch(
+                posts, maxTokens=1500, workers=workers)
+
+        for name, case in cases.items():
+            if case(args.workers) != case(1):
+                print(f"{name}: MISMATCH")
+                failed.append(name)
+            report(name, timed(lambda: case(1), args.repeat),
+                   timed(lambda: case(args.workers), args.repeat), args.workers)
+    finally:
+        batch.shutdownExecutor()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
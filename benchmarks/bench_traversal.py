@@ -0,0 +1,79 @@
+# python -m benchmarks.bench_traversal
+import time
+
+from trickle_block_util.generator import Block, Element, TrickleBlockRenderer
+from trickle_block_util.traversal import TraversalDepthError, maxDepth
+
+
+def nestedQuote(depth: int):
+    node = {"type": "rich_texts", "elements": [{"type": "text", "text": "leaf"}]}
+    for _ in range(depth - 1):
+        node = {"type": "quote", "blocks": [node]}
+    return node
+
+
+def nestedBold(depth: int):
+    node = {"type": "text", "text": "leaf"}
+    for _ in range(depth - 1):
+        node = {"type": "bold", "elements": [node]}
+    return node
+
+
+def nestedToken(depth: int):
+    node = {"type": "text", "raw": "leaf"}
+    for _ in range(depth - 1):
+        node = {"type": "emphasis", "children": [node]}
+    return node
+
+
+def nestedList(depth: int):
+    node = {"type": "list", "attrs": {"ordered": False}, "children": [
+        {"type": "list_item", "children": [
+            {"type": "block_text", "children": [{"type": "text", "raw": "leaf"}]}
+        ]}
+    ]}
+    for _ in range(depth - 1):
+        node = {"type": "list", "attrs": {"ordered": False}, "children": [
+            {"type": "list_item", "children": [
+                {"type": "block_text", "children": [{"type": "text", "raw": "item"}]},
+                node,
+            ]}
+        ]}
+    return node
+
+
+def timed(func, repeat: int = 20) -> float:
+    best = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - tic
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    renderer = TrickleBlockRenderer()
+    for depth in [10, 100, 1000]:
+        quote = nestedQuote(depth)
+        bold = Element(nestedBold(depth))
+        token = nestedToken(depth)
+        listToken = nestedList(depth)
+        results = {
+            "Block()": timed(lambda: Block(quote)),
+            "Element.toMarkdown": timed(lambda: bold.toMarkdown()),
+            "getRawText": timed(lambda: renderer.getRawText(token)),
+            "bulletpoint_list": timed(
+                lambda: renderer.render_bulletpoint_list(listToken, None)),
+        }
+        print(f"depth={depth:<5} " + " ".join(
+            f"{name}={seconds * 1000:8.3f}ms" for name, seconds in results.items()))
+
+    try:
+        Block(nestedQuote(maxDepth + 2))
+    except TraversalDepthError as e:
+        print(f"depth={maxDepth + 2}: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+from typing import Dict, List
+import ast
+import os
+import random
+
+from trickle_block_util import generator
+from trickle_block_util.generator import BlockType, ElementType
+
+
+# 基准测试用的语料，全部由固定的随机种子生成，保证每次运行一致
+
+def sampleMessages() -> Dict[str, str]:
+    # generator.py 的 __main__ 里那些 aimN 示例消息
+    path = os.path.abspath(generator.__file__)
+    tree = ast.parse(open(path, encoding="utf-8").read())
+    out = {}
+    for node in tree.body:
+        if not isinstance(node, ast.If):
+            continue
+        for stmt in node.body:
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 \
+                    and isinstance(stmt.targets[0], ast.Name) \
+                    and stmt.targets[0].id.startswith("aim") \
+                    and isinstance(stmt.value, ast.Constant):
+                out[stmt.targets[0].id] = stmt.value.value
+    return out
+
+
+def _text(text: str) -> Dict:
+    return {"id": "e", "type": ElementType.text, "text": text}
+
+
+def _wrap(elementType: str, text: str, value=None) -> Dict:
+    return {"id": "e", "type": elementType, "text": "", "value": value,
+            "elements": [_text(text)]}
+
+
+def allElements() -> List[Dict]:
+    return [
+        _text("plain "),
+        _wrap(ElementType.bold, "bold"),
+        _wrap(ElementType.italic, "italic"),
+        _wrap(ElementType.inline_code, "code"),
+        _wrap(ElementType.link, "link", "https://www.trickle.so/a?b=c"),
+        {"id": "e", "type": ElementType.url, "text": "https://www.trickle.so"},
+        {"id": "e", "type": ElementType.escape, "text": "\\*"},
+        {"id": "e", "type": ElementType.user, "text": "john", "value": "m1"},
+        {"id": "e", "type": ElementType.image,
+         "value": {"id": "i", "url": "https://img.trickle.so/1.png"}},
+        {"id": "e", "type": ElementType.linkToPost, "value": "p1"},
+        {"id": "e", "type": ElementType.math, "text": "x^2"},
+        _wrap(ElementType.underLine, "underline"),
+        _wrap(ElementType.lineThrough, "strike"),
+        _wrap(ElementType.backgroundColored, "bg"),
+        _wrap(ElementType.colored, "color"),
+    ]
+
+
+def _block(blockType: str, elements=None, blocks=None, indent=0,
+           userDefinedValue=None) -> Dict:
+    return {"id": "b", "type": blockType, "indent": indent,
+            "elements": elements if elements is not None else [],
+            "blocks": blocks or [], "userDefinedValue": userDefinedValue}
+
+
+def allTypesDocument() -> List[Dict]:
+    # 每种 BlockType 至少一个，rich_texts 里包含每种 ElementType
+    para = lambda t: _block(BlockType.text, [_text(t)])
+    return [
+        _block(BlockType.h1, [_text("Heading 1")]),
+        _block(BlockType.h2, [_text("Heading 2")]),
+        _block(BlockType.h3, [_text("Heading 3")]),
+        _block(BlockType.text, allElements()),
+        _block(BlockType.list, [_text("bullet")]),
+        _block(BlockType.list, [_text("nested bullet")], indent=1),
+        _block(BlockType.number_list, [_text("number")], userDefinedValue="1."),
+        _block(BlockType.checkbox, [_text("task")],
+               userDefinedValue={"status": "checked"}),
+        _block(BlockType.code, [_text("print('hello')\n")],
+               userDefinedValue={"language": "python"}),
+        _block(BlockType.quote, blocks=[para("quoted"), para("more")]),
+        _block(BlockType.hr),
+        _block(BlockType.webBookmark,
+               userDefinedValue={"url": "https://www.trickle.so/blog"}),
+        _block(BlockType.gallery, [allElements()[8]]),
+        _block(BlockType.embed, userDefinedValue={
+            "height": 300,
+            "src": '<iframe src="https://www.youtube.com/embed/x"></iframe>'}),
+        _block(BlockType.reference, [_text("reference")]),
+        _block(BlockType.vote, blocks=[
+            _block(BlockType.h1, [_text("Poll")]), para("pick one"),
+            _block(BlockType.nest, blocks=[
+                dict(para("a"), id="o1"), dict(para("b"), id="o2")])],
+            userDefinedValue={"vote-o1": ["m1", "m2"]}),
+        _block(BlockType.todos, blocks=[
+            _block(BlockType.h1, [_text("Todos")]), para("things"),
+            _block(BlockType.nest, blocks=[
+                _block(BlockType.checkbox, [_text("one")])])]),
+        _block(BlockType.file, userDefinedValue={"url": "https://f.trickle.so/a.pdf"}),
+        _block(BlockType.nest, blocks=[para("nested")]),
+        _block(BlockType.table, userDefinedValue={
+            "withHeadings": True, "content": [["a", "b"], ["1", "2"]]}),
+    ]
+
+
+def longMarkdown(sections: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    words = ["trickle", "block", "markdown", "render", "token", "budget",
+             "comment", "post", "workspace", "assistant"]
+    out = []
+    for i in range(sections):
+        sentence = lambda: " ".join(rnd.choice(words) for _ in range(12)) + "."
+        out.append(f"## Section {i}\n")
+        out.append(f"{sentence()} **{rnd.choice(words)}** and "
+                   f"[link](https://www.trickle.so/{i}) {sentence()}\n")
+        out.append("\n".join(f"- {sentence()}" for _ in range(4)) + "\n")
+        out.append(f"```python\nprint({i})\n```\n")
+    return "\n".join(out)
+
+
+def deepMarkdown(depth: int) -> str:
+    # mistune本身会限制嵌套层数，超过的部分按普通文本处理
+    return "\n".join("  " * i + f"- level {i}" for i in range(depth)) + "\n\n" + \
+        "".join("> " * (i + 1) + f"quote {i}\n" for i in range(depth))
+
+
+def deepBlocks(depth: int) -> List[Dict]:
+    node = _block(BlockType.text, [_text("leaf")])
+    for _ in range(depth - 1):
+        node = _block(BlockType.quote, blocks=[node])
+    return [node]
+
+
+def bigTable(rows: int, columns: int) -> List[Dict]:
+    content = [[f"h{c}" for c in range(columns)]] + \
+        [[f"r{r}c{c}" for c in range(columns)] for r in range(rows)]
+    return [_block(BlockType.table,
+                   userDefinedValue={"withHeadings": True, "content": content})]
+
+
+def cjkMarkdown(paragraphs: int, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    chars = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严"
+    out = []
+    for i in range(paragraphs):
+        text = "".join(rnd.choice(chars) for _ in range(120))
+        out.append(f"### 第{i}节\n\n{text[:60]}，**{text[60:70]}**，{text[70:]}。\n")
+    return "\n".join(out)
+
+
+def commentThread(comments: int) -> List[Dict]:
+    messages = list(sampleMessages().values())
+    out = []
+    for i in range(comments):
+        message = messages[i % len(messages)]
+        if i % 3 == 2:
+            # 引用前一条评论
+            message = "> " + messages[(i - 1) % len(messages)].split("\n")[0] + \
+                "\n\n" + message
+        out.append({
+            "commentId": i,
+            "commentAuthorName": f"user{i % 5}",
+            "commentBlocks": generator.createAssistantCommentBlocks(
+                message, useCache=False),
+        })
+    return out
@@ -0,0 +1,233 @@
+# python -m benchmarks.run [--quick] [--only NAME] [--save baseline.json]
+# python -m benchmarks.run --compare baseline.json [--threshold 0.2]
+#
+# 每个入口函数在固定语料上跑一遍，输出吞吐、延迟分位数和峰值内存。
+# --compare 时 p50 延迟或峰值内存比 baseline 差超过 threshold 就返回 1，可以直接放进CI。
+# baseline 和机器相关，请在同一台机器上生成和比较。
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from benchmarks import corpus
+from trickle_block_util import generator
+from trickle_block_util.generator import RenderProfile
+
+FORMAT_VERSION = 1
+
+
+def _percentile(sortedValues: List[float], q: float) -> float:
+    if not sortedValues:
+        return 0.0
+    i = min(len(sortedValues) - 1, int(round(q * (len(sortedValues) - 1))))
+    return sortedValues[i]
+
+
+def _cases(quick: bool) -> List[Tuple[str, Callable[[], Any], int]]:
+    """[(name, fn, 输入大小)]，语料在这里一次性生成好，不计入耗时。"""
+    scale = 1 if quick else 4
+    samples = corpus.sampleMessages()
+    markdowns = {
+        "samples": "\n\n".join(samples.values()),
+        "long": corpus.longMarkdown(50 * scale),
+        "deep": corpus.deepMarkdown(40),
+        "cjk": corpus.cjkMarkdown(25 * scale),
+    }
+    documents = {name: generator.createAssistantCommentBlocks(md, useCache=False)
+                 for name, md in markdowns.items()}
+    documents["allTypes"] = corpus.allTypesDocument()
+    documents["deepBlocks"] = corpus.deepBlocks(300)
+    documents["bigTable"] = corpus.bigTable(100 * scale, 8)
+    sizes = {name: len(json.dumps(blocks, ensure_ascii=False).encode("utf-8"))
+             for name, blocks in documents.items()}
+    comments = corpus.commentThread(10 * scale)
+    commentsSize = sum(sizes["samples"] // len(samples) for _ in comments)
+    statusComments = [{c["commentAuthorName"]: generator.blocksToMarkdown(
+        c["commentBlocks"])} for c in comments]
+
+    cases = []
+    for name, md in markdowns.items():
+        cases.append((
+            f"createAssistantCommentBlocks/{name}",
+            lambda md=md: generator.createAssistantCommentBlocks(md, useCache=False),
+            len(md.encode("utf-8")),
+        ))
+    for profile in (RenderProfile.default, RenderProfile.compact):
+        for name, blocks in documents.items():
+            cases.append((
+                f"blocksToMarkdown[{profile}]/{name}",
+                lambda blocks=blocks, profile=profile:
+                    generator.blocksToMarkdown(blocks, profile=profile),
+                sizes[name],
+            ))
+    cases += [
+        ("generateTrickleContentPrompt/long",
+         lambda: generator.generateTrickleContentPrompt(
+             "title", documents["long"], maxTokens=None),
+         sizes["long"]),
+        # 下面这些会用到 tiktoken，拿不到编码文件时只记录错误
+        ("generateTrickleContentPrompt/long+truncate",
+         lambda: generator.generateTrickleContentPrompt(
+             "title", documents["long"], maxTokens=1500),
+         sizes["long"]),
+        ("generateTrickleNormalCommentPrompt/thread",
+         lambda: generator.generateTrickleNormalCommentPrompt(
+             comments, maxTokens=None),
+         commentsSize),
+        ("generateTrickleNormalCommentPrompt/thread+dedup",
+         lambda: generator.generateTrickleNormalCommentPrompt(
+             comments, maxTokens=None, dedup=True),
+         commentsSize),
+        ("generateTrickleNormalCommentPrompt/thread+budget",
+         lambda: generator.generateTrickleNormalCommentPrompt(
+             comments, maxTokens=1000),
+         commentsSize),
+        ("generateTrickleStatusCommentPrompt/thread+dedup",
+         lambda: generator.generateTrickleStatusCommentPrompt(
+             statusComments, dedup=True),
+         commentsSize),
+        ("getTextTokens/long",
+         lambda: generator.getTextTokens(markdowns["long"]),
+         len(markdowns["long"].encode("utf-8"))),
+    ]
+    return cases
+
+
+def measure(fn: Callable[[], Any], inputSize: int, minSeconds: float,
+            minRounds: int) -> Dict[str, Any]:
+    # 预热一次（也用来捕获错误），再单独跑几次测峰值内存取最小值，tracemalloc 会拖慢计时
+    fn()
+    peak = None
+    for _ in range(3):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            fn()
+            _, roundPeak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak = roundPeak if peak is None else min(peak, roundPeak)
+
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < minRounds or time.perf_counter() - started < minSeconds:
+        tic = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - tic)
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        "rounds": len(latencies),
+        "inputBytes": inputSize,
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "opsPerSecond": len(latencies) / total if total else 0.0,
+        "bytesPerSecond": inputSize * len(latencies) / total if total else 0.0,
+        "peakMemory": peak,
+    }
+
+
+def runAll(quick: bool = False, only: Optional[str] = None) -> Dict[str, Any]:
+    # 确保测的是真实的转换，不是缓存命中
+    generator.disableConversionCache()
+    minSeconds, minRounds = (0.2, 5) if quick else (1.0, 20)
+    results = {}
+    for name, fn, inputSize in _cases(quick):
+        if only and only not in name:
+            continue
+        try:
+            results[name] = measure(fn, inputSize, minSeconds, minRounds)
+        except Exception as e:
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+        _printResult(name, results[name])
+    return {
+        "version": FORMAT_VERSION,
+        "quick": quick,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def _printResult(name: str, r: Dict[str, Any]):
+    if "error" in r:
+        print(f"{name:<58} ERROR {r['error'][:60]}", flush=True)
+        return
+    print(f"{name:<58} p50={r['p50'] * 1000:8.2f}ms p95={r['p95'] * 1000:8.2f}ms "
+          f"p99={r['p99'] * 1000:8.2f}ms {r['bytesPerSecond'] / 1e6:7.2f}MB/s "
+          f"peak={r['peakMemory'] / 1024:9.1f}KiB", flush=True)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any],
+            threshold: float) -> List[str]:
+    """返回回归列表，空列表表示没有回归。"""
+    if baseline.get("quick") != current.get("quick"):
+        return ["baseline and current run use different corpus sizes (--quick)"]
+    regressions = []
+    for name, old in baseline["results"].items():
+        new = current["results"].get(name)
+        if new is None:
+            # --only 过滤掉的不算
+            continue
+        if "error" in old:
+            continue
+        if "error" in new:
+            regressions.append(f"{name}: now fails with {new['error']}")
+            continue
+        for metric in ("p50", "peakMemory"):
+            if old[metric] and new[metric] > old[metric] * (1 + threshold):
+                regressions.append(
+                    f"{name}: {metric} {old[metric]:.6g} -> {new[metric]:.6g} "
+                    f"(+{(new[metric] / old[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--quick", action="store_true",
+                        help="smaller corpus and fewer rounds")
+    parser.add_argument("--only", help="run only cases whose name contains this")
+    parser.add_argument("--save", metavar="PATH", help="write results as a baseline")
+    parser.add_argument("--compare", metavar="PATH",
+                        help="compare with a baseline, exit 1 on regression")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed relative slowdown / memory growth")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("version") != FORMAT_VERSION:
+            print(f"unsupported baseline version {baseline.get('version')}",
+                  file=sys.stderr)
+            return 2
+        # 基线是用什么语料跑的，就用什么语料比
+        args.quick = baseline.get("quick", False)
+
+    current = runAll(quick=args.quick, only=args.only)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.save}")
+
+    if baseline is not None:
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over "
+                  f"{args.threshold * 100:.0f}%:")
+            for r in regressions:
+                print("  " + r)
+            return 1
+        print(f"\nno regressions over {args.threshold * 100:.0f}%")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
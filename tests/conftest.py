@@ -0,0 +1,24 @@
+import re
+
+import pytest
+
+from trickle_block_util import tokenizer
+
+
+class WordEncoding:
+    """tiktoken 在这里下载不了编码文件，测试里用按空白切分的"token"代替，decode 能还原原文。"""
+
+    def encode(self, text, **kwargs):
+        return re.findall(r"\s*\S+|\s+", text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+    def encode_batch(self, texts, **kwargs):
+        return [self.encode(t) for t in texts]
+
+
+@pytest.fixture
+def wordTokens(monkeypatch):
+    monkeypatch.setattr(tokenizer, "_encoding", WordEncoding())
+    return lambda text: len(WordEncoding().encode(text))
@@ -0,0 +1,34 @@
+import threading
+import time
+
+from trickle_block_util import batch
+
+
+def _slowSquare(x):
+    time.sleep(0.001)
+    return x * x
+
+
+def test_concurrent_batches_with_mixed_worker_counts():
+    items = list(range(40))
+    expected = [x * x for x in items]
+    errors = []
+
+    def run(workers):
+        try:
+            for _ in range(5):
+                assert batch.mapBatch(_slowSquare, items, workers=workers) == expected
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(2 + i % 3,)) for i in range(12)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        batch.shutdownExecutor()
+    assert errors == []
+    assert batch.mapBatch(_slowSquare, items, workers=2) == expected
+    batch.shutdownExecutor()
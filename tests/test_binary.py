@@ -0,0 +1,113 @@
+import json
+import random
+
+import pytest
+
+from trickle_block_util.binary import decodeBlocks, encodeBlocks, iterBlocks
+from trickle_block_util.generator import createAssistantCommentBlocks
+from trickle_block_util.traversal import DEFAULT_MAX_DEPTH, TraversalDepthError
+
+MARKDOWN = "# 标题\n\n**bold *it* `code`** [l](https://www.trickle.so)\n\n" \
+           "> quote\n> - item\n\n- [ ] task\n\n```python\nprint(1)\n```"
+
+
+def _blocks():
+    blocks = createAssistantCommentBlocks(MARKDOWN, useCache=False)
+    blocks.append({
+        "id": "t", "type": "table", "indent": 2, "isDeleted": False,
+        "userDefinedValue": {"content": [["a", 1.5, None], [True, -3, {"x": [1, []]}]],
+                             "withHeadings": True},
+        "customField": {"k": ["v", 2 ** 70]},
+        "blocks": [{"type": "quote", "blocks": [], "elements": []}],
+    })
+    return blocks
+
+
+def _nestedQuote(depth):
+    node = {"type": "rich_texts", "blocks": [],
+            "elements": [{"type": "text", "text": "leaf"}]}
+    for _ in range(depth - 1):
+        node = {"type": "quote", "blocks": [node], "elements": []}
+    return node
+
+
+def test_round_trip():
+    blocks = _blocks()
+    data = encodeBlocks(blocks)
+    assert decodeBlocks(data) == json.loads(json.dumps(blocks))
+    assert encodeBlocks(decodeBlocks(data)) == data
+    assert list(iterBlocks(data)) == decodeBlocks(data)
+
+
+def test_skip_children_omits_the_blocks_key():
+    blocks = _blocks()
+    top = list(iterBlocks(encodeBlocks(blocks), skipChildren=True))
+    assert [b["type"] for b in top] == [b["type"] for b in blocks]
+    assert "blocks" not in top[-1]
+    assert top[0]["blocks"] == []
+    assert {k: v for k, v in top[-1].items()} == \
+        {k: v for k, v in blocks[-1].items() if k != "blocks"}
+
+
+def _roundTrips(blocks):
+    # 很深的dict用 == 比较本身会递归超限，比较重新编码的结果
+    data = encodeBlocks(blocks)
+    decoded = decodeBlocks(data)
+    assert encodeBlocks(decoded) == data
+    return decoded
+
+
+def test_deep_nesting():
+    depth = DEFAULT_MAX_DEPTH - 1
+    node = _roundTrips([_nestedQuote(depth)])[0]
+    for _ in range(depth - 1):
+        assert node["type"] == "quote" and len(node["blocks"]) == 1
+        node = node["blocks"][0]
+    assert node["elements"][0]["text"] == "leaf"
+
+    bold = {"type": "text", "text": "leaf"}
+    for _ in range(depth - 2):
+        bold = {"type": "bold", "elements": [bold]}
+    node = _roundTrips([{"type": "rich_texts", "elements": [bold]}])[0]["elements"][0]
+    while node["type"] == "bold":
+        node = node["elements"][0]
+    assert node["text"] == "leaf"
+
+    value = "leaf"
+    for i in range(depth - 2):
+        value = [value] if i % 2 else {"v": value}
+    value = _roundTrips([{"type": "code", "userDefinedValue": value}])[0]["userDefinedValue"]
+    while not isinstance(value, str):
+        value = value[0] if isinstance(value, list) else value["v"]
+    assert value == "leaf"
+
+    with pytest.raises(TraversalDepthError):
+        encodeBlocks([_nestedQuote(DEFAULT_MAX_DEPTH + 2)])
+
+
+def test_truncated_input_raises_value_error():
+    data = encodeBlocks(_blocks())
+    for cut in range(len(data)):
+        with pytest.raises(ValueError):
+            decodeBlocks(data[:cut])
+    with pytest.raises(ValueError):
+        list(iterBlocks(data[:len(data) // 2]))
+    with pytest.raises(ValueError, match="unexpected data"):
+        decodeBlocks(data + b"\x00")
+
+
+def test_corrupt_input_raises_value_error():
+    data = encodeBlocks(_blocks())
+    with pytest.raises(ValueError, match="not a trickle block binary"):
+        decodeBlocks(b"XYZ" + data[3:])
+    with pytest.raises(ValueError, match="version"):
+        iterBlocks(data[:3] + b"\x09" + data[4:])
+    rng = random.Random(7)
+    for _ in range(300):
+        corrupt = bytearray(data)
+        for _ in range(3):
+            corrupt[rng.randrange(4, len(corrupt))] = rng.randrange(256)
+        try:
+            decodeBlocks(bytes(corrupt))
+        except ValueError:
+            pass
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from trickle_block_util import generator
+from trickle_block_util.cache import ConversionCache
+from trickle_block_util.generator import createAssistantCommentBlocks, \
+    disableConversionCache, enableConversionCache
+
+MARKDOWN = "# 标题\n\n**bold *it* `code`** [l](https://www.trickle.so)\n\n" \
+           "> quote\n> - item\n\n- [ ] task\n\n```python\nprint(1)\n```"
+
+
+@pytest.fixture
+def cache():
+    cache = enableConversionCache()
+    yield cache
+    disableConversionCache()
+
+
+def _ids(blocks):
+    out = []
+    stack = list(blocks)
+    while stack:
+        node = stack.pop()
+        if node.get('id') is not None:
+            out.append(node['id'])
+        value = node.get('value')
+        if type(value) is dict and value.get('id') is not None:
+            out.append(value['id'])
+        stack.extend(node.get('blocks') or [])
+        stack.extend(node.get('elements') or [])
+    return out
+
+
+def _withoutIds(blocks):
+    stack = list(blocks)
+    while stack:
+        node = stack.pop()
+        node.pop('id', None)
+        value = node.get('value')
+        if type(value) is dict:
+            value.pop('id', None)
+        stack.extend(node.get('blocks') or [])
+        stack.extend(node.get('elements') or [])
+    return blocks
+
+
+def test_lru_eviction_by_entries():
+    cache = ConversionCache(maxEntries=2)
+    for key in "ab":
+        cache.put(key, [{"key": key}])
+    assert cache.get("a", str) == [{"key": "a"}]
+    cache.put("c", [{"key": "c"}])
+    assert cache.get("b", str) is None
+    assert cache.get("a", str) == [{"key": "a"}]
+    assert cache.get("c", str) == [{"key": "c"}]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["entries"] == 2
+
+
+def test_lru_eviction_by_bytes():
+    entry = [{"text": "x" * 40}]
+    size = len(json.dumps(entry))
+    cache = ConversionCache(maxBytes=2 * size)
+    cache.put("a", entry)
+    cache.put("b", entry)
+    cache.put("c", entry)
+    assert cache.get("a", str) is None
+    assert cache.stats()["bytes"] == 2 * size
+    cache.put("big", [{"text": "x" * (3 * size)}])
+    assert cache.get("big", str) is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_hits_get_fresh_ids(cache):
+    first = createAssistantCommentBlocks(MARKDOWN)
+    second = createAssistantCommentBlocks(MARKDOWN)
+    third = createAssistantCommentBlocks(MARKDOWN)
+    assert cache.stats()["hits"] == 2
+    ids = [_ids(first), _ids(second), _ids(third)]
+    assert len(ids[0]) > len(first)
+    allIds = ids[0] + ids[1] + ids[2]
+    assert len(set(allIds)) == len(allIds)
+
+    expected = _withoutIds(createAssistantCommentBlocks(MARKDOWN, useCache=False))
+    assert _withoutIds(second) == expected
+    assert _withoutIds(third) == expected
+
+
+def test_hits_do_not_share_objects(cache):
+    createAssistantCommentBlocks(MARKDOWN)
+    hit = createAssistantCommentBlocks(MARKDOWN)
+    hit[0]['elements'].clear()
+    again = createAssistantCommentBlocks(MARKDOWN)
+    assert again[0]['elements']
+
+
+def test_disable_conversion_cache(cache):
+    createAssistantCommentBlocks(MARKDOWN)
+    disableConversionCache()
+    assert generator.conversionCache is None
+    createAssistantCommentBlocks(MARKDOWN)
+    assert cache.stats()["hits"] == 0
+    assert cache.stats()["misses"] == 1
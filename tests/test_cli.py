@@ -0,0 +1,35 @@
+import io
+import json
+import sys
+from multiprocessing.pool import ThreadPool
+
+from trickle_block_util import cli
+
+
+def test_imap_bounded_keeps_order_and_reads_lazily():
+    pulled = []
+
+    def tasks():
+        for i in range(100):
+            pulled.append(i)
+            yield i
+
+    with ThreadPool(4) as pool:
+        results = cli.imapBounded(pool, lambda x: x * 2, tasks(), window=3)
+        assert next(results) == 0
+        assert len(pulled) <= 4
+        assert list(results) == [x * 2 for x in range(1, 100)]
+
+
+def test_stdin_records_keep_their_order(monkeypatch):
+    records = [f"# title {i}" for i in range(50)]
+    stdin = io.TextIOWrapper(io.BytesIO(
+        "".join(json.dumps(r) + "\n" for r in records).encode("utf-8")))
+    monkeypatch.setattr(sys, "stdin", stdin)
+    output = io.StringIO()
+    progress = cli.run("-", output, cli.Direction.blocks, workers=2,
+                       linesPerChunk=3, progressInterval=0)
+    assert progress.records == 50 and progress.failures == 0
+    lines = output.getvalue().splitlines()
+    assert [json.loads(line)[0]["elements"][0]["text"] for line in lines] == \
+        [f"title {i}" for i in range(50)]
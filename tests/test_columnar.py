@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from trickle_block_util import columnar
+from trickle_block_util.columnar import ColumnarBlocks
+from trickle_block_util.generator import blocksToMarkdown, \
+    createAssistantCommentBlocks
+
+MARKDOWN = "# 标题\n\n**bold *it* `code`** [l](https://www.trickle.so)\n\n" \
+           "> quote\n> - item\n\n- [ ] task\n\n```python\nprint(1)\n```"
+
+
+def _blocks():
+    blocks = createAssistantCommentBlocks(MARKDOWN, useCache=False)
+    blocks.append({
+        "id": "t", "type": "list", "indent": 2, "isDeleted": True,
+        "isFirst": None, "updatedByRemote": False,
+        "elements": [{"type": "bold", "text": "", "elements": [
+            {"type": "text", "text": "嵌套"}, {"type": "text", "text": "b"}]}],
+        "blocks": [{"type": "quote", "blocks": [], "elements": []}],
+    })
+    blocks.append({"id": "bare"})
+    return blocks
+
+
+def test_round_trip():
+    blocks = _blocks()
+    store = ColumnarBlocks.fromDocuments([blocks, blocks[:2]])
+    rows = store.filterRows(topLevel=True)
+    expected = json.loads(json.dumps(blocks + blocks[:2]))
+    assert store.toBlockDicts(rows) == expected
+    assert store.toMarkdown(store.filterRows(topLevel=True, docIndex=0)) == \
+        blocksToMarkdown(blocks)
+
+    nested = store.filterRows(type="list", isDeleted=True)
+    assert store.text(nested[0]) == "嵌套b"
+    assert store.countCodeLangs() == {"python": 1}
+
+
+def test_payload_does_not_repeat_column_fields():
+    blocks = _blocks()
+    store = ColumnarBlocks.fromDocuments([blocks])
+    full = sum(len(json.dumps(b, ensure_ascii=False).encode('utf-8'))
+               for b in blocks)
+    assert len(store._payload) < full
+    assert "标题".encode('utf-8') not in store._payload
+
+
+@pytest.mark.parametrize("withNumpy", [True, False])
+def test_append_after_taking_a_column(monkeypatch, withNumpy):
+    if not withNumpy:
+        monkeypatch.setattr(columnar, "numpy", None)
+    elif columnar.numpy is None:
+        pytest.skip("numpy is not installed")
+    store = ColumnarBlocks.fromDocuments([_blocks()])
+    col = store.column('typeCode')
+    before = list(col)
+    store.addDocument(_blocks())
+    assert list(col) == before
+    assert len(store.column('typeCode')) == 2 * len(before)
+    assert store.countTypes() == {k: 2 * v for k, v in
+                                  ColumnarBlocks.fromDocuments([_blocks()])
+                                  .countTypes().items()}
+
+
+@pytest.mark.parametrize("indent", ["2", 1.5, True, 2 ** 40])
+def test_invalid_indent_leaves_the_store_unchanged(indent):
+    store = ColumnarBlocks.fromDocuments([_blocks()])
+    rows = len(store)
+    payload = bytes(store._payload)
+    bad = [{"type": "list", "elements": [{"type": "text", "text": "a"}],
+            "blocks": [{"type": "list", "indent": indent}]}]
+    with pytest.raises(ValueError):
+        store.addDocument(bad)
+    assert store.documentCount == 1
+    assert all(len(getattr(store, name)) == rows
+               for name in columnar._columnNames)
+    assert bytes(store._payload) == payload
+    assert store.addDocument([{"type": "list"}]) == 1
+    assert store.text(rows) == ""
+    assert store.toBlockDict(rows) == {"type": "list"}
@@ -0,0 +1,46 @@
+from trickle_block_util import dedup, generator
+from trickle_block_util.generator import generateTrickleNormalCommentPrompt
+
+PARAGRAPH = "The quick brown fox jumps over the lazy dog near the river bank today"
+
+
+def _paragraph(text):
+    return {"type": "rich_texts", "elements": [{"type": "text", "text": text}]}
+
+
+def _thread():
+    return [
+        {"commentId": 1, "commentAuthorName": "AI",
+         "commentBlocks": [_paragraph(PARAGRAPH)]},
+        {"commentId": 2, "commentAuthorName": "Ann",
+         "commentBlocks": [{"type": "quote", "blocks": [_paragraph(PARAGRAPH)]},
+                           _paragraph("I agree")]},
+    ]
+
+
+def _countWords(text):
+    return len(text.split())
+
+
+def test_budget_never_keeps_reference_to_dropped_comment(monkeypatch):
+    monkeypatch.setattr(generator, "getTextTokens", _countWords)
+    # 去重后 Ann 的评论放得下，AI 的评论放不下
+    maxTokens = _countWords(f"Ann: > {PARAGRAPH}\nI agree")
+    _, prompt = generateTrickleNormalCommentPrompt(_thread(), maxTokens=maxTokens,
+                                                   dedup=True)
+    assert "same as AI above" not in prompt
+    assert prompt == f"Ann: > {PARAGRAPH}\nI agree"
+
+    # 整个评论串都放得下时仍然去重
+    _, prompt = generateTrickleNormalCommentPrompt(_thread(), maxTokens=100, dedup=True)
+    assert prompt == f"AI: {PARAGRAPH}\nAnn: > (same as AI above)\nI agree"
+
+
+def test_report_tokenizes_only_when_read(monkeypatch):
+    calls = []
+    monkeypatch.setattr(dedup, "getTextTokens",
+                        lambda text: calls.append(text) or _countWords(text))
+    _, report = dedup.dedupCommentThread(_thread())
+    assert report["duplicates"] == 1 and calls == []
+    assert report["savedTokens"] == _countWords(PARAGRAPH) - 4
+    assert len(calls) == 2 and dict(report)["savedChars"] > 0
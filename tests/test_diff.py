@@ -0,0 +1,48 @@
+import copy
+import json
+
+from trickle_block_util.diff import applyPatch, diffBlocks
+from trickle_block_util.generator import createAssistantCommentBlocks
+
+ANSWER = "\n\n".join(
+    f"## Step {i}\n\nUse **bold {i}** and `code {i}` with [a link](https://www.trickle.so/{i}).\n\n"
+    f"- first item {i}\n- second item {i}"
+    for i in range(10))
+
+
+def _size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False))
+
+
+def test_patch_roundtrip():
+    old = createAssistantCommentBlocks(ANSWER, useCache=False)
+    new = copy.deepcopy(old)
+    new[3]["elements"][0]["text"] = "edited"
+    del new[5]
+    new.insert(0, copy.deepcopy(old[-1]))
+    assert applyPatch(old, diffBlocks(old, new)) == new
+
+
+def test_rewrite_with_fresh_ids_sends_only_changed_fields():
+    # AI重新生成同一个回答: 内容几乎一样，所有block和element的id都是新的
+    old = createAssistantCommentBlocks(ANSWER, useCache=False)
+    new = createAssistantCommentBlocks(ANSWER.replace("first item 4", "first entry 4"),
+                                       useCache=False)
+    patch = diffBlocks(old, new)
+    assert applyPatch(old, patch) == new
+    assert _size(patch) < _size(new) * 0.45
+    for op in patch["ops"]:
+        if op["op"] != "update":
+            continue
+        for _, elementDiff in op.get("elements", []):
+            # 只带变化的字段，不重发整个element
+            assert set(elementDiff.get("set", {})) <= {"id", "text", "value"}
+
+
+def test_version_1_patches_still_apply():
+    old = createAssistantCommentBlocks("hello **world**", useCache=False)
+    new = copy.deepcopy(old)
+    new[0]["elements"][1] = dict(new[0]["elements"][1], id="x")
+    patch = {"version": 1, "length": 1, "ops": [
+        {"op": "update", "index": 0, "elements": [[1, new[0]["elements"][1]]]}]}
+    assert applyPatch(old, patch) == new
@@ -0,0 +1,92 @@
+from trickle_block_util.document import BlockDocument
+from trickle_block_util.generator import EMPTY_BLOCK, Block, BlockType
+from trickle_block_util.renderer import TrickleBlockRenderer, getParser
+
+
+def _paragraph(text, blockId=None):
+    out = {"type": "rich_texts", "elements": [{"type": "text", "text": text}]}
+    if blockId is not None:
+        out["id"] = blockId
+    return out
+
+
+def test_len_counts_blocks_without_ids():
+    doc = BlockDocument([
+        _paragraph("a", "a"),
+        {"id": "q", "type": "quote", "blocks": [_paragraph("no id"), _paragraph("b", "b")]},
+        _paragraph("no id either"),
+    ])
+    assert len(doc) == 5
+    assert len(doc) == len(list(doc))
+    assert [b.id for b in doc] == ["a", "q", None, "b", None]
+    doc.delete("q")
+    assert len(doc) == len(list(doc)) == 2
+
+
+def test_document_over_blank_lines_owns_its_blocks():
+    tokens, state = getParser(hardWrap=True).parse("a\n\n\n\nb\n\n> q\n>\n> \n")
+    rendered = TrickleBlockRenderer().render_blocks(tokens, state)
+    quote = Block.copyDefault(type=BlockType.quote,
+                              blocks=[EMPTY_BLOCK, Block.raw("x"), EMPTY_BLOCK])
+    blocks = rendered + [EMPTY_BLOCK, quote, EMPTY_BLOCK]
+    assert sum(b is EMPTY_BLOCK for b in blocks) >= 3
+
+    doc = BlockDocument(blocks)
+    assert len(doc) == len(list(doc)) == len({id(b) for b in doc})
+    assert not any(b is EMPTY_BLOCK for b in doc)
+    assert EMPTY_BLOCK._parent is None
+    for b in doc:
+        assert doc.get(b.id) is b
+        assert doc.pathBlocks(b.id)[-1] is b
+    blank = quote.blocks[2]
+    assert doc.parent(blank.id) is quote and doc.index(blank.id) == 2
+
+    inserted = doc.insert(EMPTY_BLOCK, parentId=quote.id, index=0)
+    assert inserted is not EMPTY_BLOCK and quote.blocks[0] is inserted
+    assert doc.index(blank.id) == 3
+    doc.delete(blank.id)
+    doc.move(inserted.id)
+    assert doc.toJson()[-1]["elements"][0]["text"] == ""
+    assert len(doc) == len(list(doc))
+
+
+def test_insert_with_negative_index():
+    doc = BlockDocument([_paragraph(c, c) for c in "abc"])
+    inserted = doc.insert(EMPTY_BLOCK, index=-1)
+    assert [b.id for b in doc.blocks] == ["a", "b", inserted.id, "c"]
+    assert doc.index(inserted.id) == 2 and doc.index("c") == 3
+    first = doc.insert(_paragraph("z", "z"), index=-10)
+    assert doc.blocks[0] is first and doc.index("z") == 0
+    assert [doc.index(b.id) for b in doc.blocks] == [0, 1, 2, 3, 4]
+
+
+def _scanListParent(doc, b):
+    if b.indent <= 0:
+        return None
+    siblings = doc.blocks if b._parent is None else b._parent.blocks
+    for s in reversed(siblings[:siblings.index(b)]):
+        if s.indent < b.indent:
+            return s
+    return None
+
+
+def test_list_parents_follow_edits():
+    import random
+    rnd = random.Random(3)
+    doc = BlockDocument([dict(_paragraph(str(i), str(i)), type="list",
+                              indent=rnd.randrange(4)) for i in range(30)])
+    for step in range(200):
+        ids = [b.id for b in doc]
+        op = rnd.randrange(4)
+        if op == 0:
+            doc.insert(dict(_paragraph("n", f"n{step}"), type="list",
+                            indent=rnd.randrange(4)), index=rnd.randrange(-5, 35))
+        elif op == 1 and len(ids) > 5:
+            doc.delete(rnd.choice(ids))
+        elif op == 2:
+            doc.setIndent(rnd.choice(ids), rnd.randrange(4))
+        else:
+            doc.move(rnd.choice(ids), index=rnd.randrange(-5, 35))
+        for b in doc:
+            assert doc.listParent(b.id) is _scanListParent(doc, b)
+            assert doc.index(b.id) == doc.blocks.index(b)
@@ -0,0 +1,134 @@
+from trickle_block_util.generator import Block, Element, RenderProfile, \
+    blocksToMarkdown, blocksToMarkdownWithUrlRefs
+from trickle_block_util.traversal import DEFAULT_MAX_DEPTH
+
+
+def _text(text):
+    return {"type": "text", "text": text}
+
+
+def _block(blockType, elements=None, blocks=None, **fields):
+    out = {"type": blockType, "elements": elements or [], "blocks": blocks or []}
+    out.update(fields)
+    return out
+
+
+def test_compact_quote_keeps_code_indentation():
+    code = _block("code", [_text("def f():\n    return 1")],
+                  userDefinedValue={"language": "python"})
+    quote = _block("quote", blocks=[_block("rich_texts", [_text("  see  ")]), code])
+    out = blocksToMarkdown([quote], profile=RenderProfile.compact)
+    assert out == "> see\n> ```python\ndef f():\n    return 1\n```"
+
+
+def test_short_urls_are_quoted_like_the_default_path():
+    link = {"type": "link", "text": "", "value": "http://a.b/c d",
+            "elements": [_text("t")]}
+    blocks = [_block("rich_texts", [link]),
+              _block("file", userDefinedValue={"url": "http://a.b/f g"})]
+    out, mapping = blocksToMarkdownWithUrlRefs(blocks, minLength=100)
+    assert out == blocksToMarkdown(blocks)
+    assert "[t](http://a.b/c%20d)" in out and mapping == {}
+
+
+def test_embed_src_is_replaced_in_default_profile():
+    src = "https://www.youtube.com/embed/abc"
+    embed = _block("embed", userDefinedValue={
+        "height": 200, "src": f'<iframe src="{src}" allowfullscreen></iframe>'})
+    out, mapping = blocksToMarkdownWithUrlRefs([embed])
+    assert mapping == {"L1": src}
+    assert '<iframe src="L1" allowfullscreen></iframe>' in out
+
+
+def _nestedQuote(depth, leaf="leaf"):
+    node = _block("rich_texts", [_text(leaf)])
+    for _ in range(depth - 1):
+        node = _block("quote", blocks=[node])
+    return node
+
+
+def _nestedBold(depth, leaf="leaf"):
+    node = _text(leaf)
+    for _ in range(depth - 1):
+        node = {"type": "bold", "elements": [node]}
+    return node
+
+
+def test_content_hash_of_deep_trees():
+    depth = DEFAULT_MAX_DEPTH - 1
+    quote = Block(_nestedQuote(depth))
+    assert quote.contentHash() == Block(_nestedQuote(depth)).contentHash()
+    assert quote.contentHash() != Block(_nestedQuote(depth, "other")).contentHash()
+    bold = Element(_nestedBold(depth))
+    assert bold.contentHash() != Element(_nestedBold(depth, "other")).contentHash()
+
+
+def test_content_hash_is_invalidated_along_the_path():
+    quote = Block(_nestedQuote(50))
+    before = quote.contentHash()
+    leaf = quote
+    while leaf.blocks:
+        leaf = leaf.blocks[0]
+    leaf.elements[0].text = "changed"
+    leaf.elements[0].invalidateContentHash()
+    assert quote.contentHash() == Block(_nestedQuote(50, "changed")).contentHash()
+    assert quote.contentHash() != before
+
+
+def test_markdown_and_json_of_deep_trees():
+    depth = DEFAULT_MAX_DEPTH - 1
+    expected = "> " * (depth - 1) + "leaf"
+    assert blocksToMarkdown([_nestedQuote(depth)]) == expected
+    assert blocksToMarkdown([_nestedQuote(depth)], profile=RenderProfile.compact) == expected
+
+    quote = Block(_nestedQuote(depth))
+    assert Block(quote.toJson()).contentHash() == quote.contentHash()
+    bold = Element(_nestedBold(depth))
+    assert bold.toMarkdown() == "**" * (depth - 1) + "leaf" + "**" * (depth - 1)
+    assert Element(bold.toJson()).contentHash() == bold.contentHash()
+
+
+def test_web_bookmark_urls_follow_the_same_rules_with_url_refs():
+    blocks = [_block("webBookmark", userDefinedValue="http://insecure.example/a"),
+              _block("webBookmark", userDefinedValue="https://a.b/c d"),
+              _block("webBookmark", userDefinedValue={"url": "http://a.b/dict"}),
+              _block("webBookmark", userDefinedValue={})]
+    out, mapping = blocksToMarkdownWithUrlRefs(blocks, minLength=100)
+    assert out == blocksToMarkdown(blocks) and mapping == {}
+    out, mapping = blocksToMarkdownWithUrlRefs(blocks)
+    assert mapping == {"L1": "https://a.b/c d", "L2": "http://a.b/dict"}
+    assert out.split("\n") == ["[WebBookmark](https://#)", "[WebBookmark](L1)",
+                               "[WebBookmark](L2)", "[WebBookmark](https://#)"]
+
+
+def test_public_factories_return_mutable_objects():
+    text = Element.normalText("")
+    text.text = "a"
+    assert Element.normalText("").text == ""
+
+    blank = Block.raw("")
+    blank.elements[0].text = "b"
+    blank.indent = 1
+    default = Block.copyDefault()
+    default.elements[0].text = "c"
+    assert Block.raw("").toJson()["elements"][0]["text"] == ""
+    assert Block.raw("").indent == 0
+    assert Block.copyDefault().elements[0].text == ""
+    assert None not in {text.id, blank.id, blank.elements[0].id,
+                        default.elements[0].id}
+
+
+def test_conversion_still_shares_empty_nodes():
+    from trickle_block_util.generator import EMPTY_BLOCK, EMPTY_TEXT, \
+        createAssistantCommentBlocks
+    from trickle_block_util.renderer import TrickleBlockRenderer, getParser
+    markdown = "a\n\n\n\n> q\n\n---\n\n```\n```"
+    tokens, state = getParser(hardWrap=True).parse(markdown)
+    rendered = TrickleBlockRenderer().render_blocks(tokens, state)
+    assert any(b is EMPTY_BLOCK for b in rendered)
+    quote = next(b for b in rendered if b.type == "quote")
+    assert quote.elements[0] is EMPTY_TEXT
+
+    out = createAssistantCommentBlocks(markdown, useCache=False)
+    ids = [b["id"] for b in out] + [e["id"] for b in out for e in b["elements"]]
+    assert None not in ids and len(set(ids)) == len(ids)
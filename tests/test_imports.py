@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAZY_MODULES = ["mistune", "tiktoken", "pytz", "numpy"]
+
+SCRIPT = """
+import json, sys
+import trickle_block_util.generator
+loaded = [m for m in %r if m in sys.modules]
+from trickle_block_util.generator import TrickleBlockRenderer, textElementTypes, RAW_TEXT_CACHE
+from trickle_block_util import renderer
+print(json.dumps({
+    "loaded": loaded,
+    "shim": [TrickleBlockRenderer is renderer.TrickleBlockRenderer,
+             textElementTypes is renderer.textElementTypes,
+             RAW_TEXT_CACHE is renderer.RAW_TEXT_CACHE],
+}))
+""" % (LAZY_MODULES,)
+
+
+def _run(script):
+    # 新进程里跑，当前进程的 sys.modules 早被别的测试填满了
+    proc = subprocess.run([sys.executable, "-c", script],
+                          capture_output=True, text=True, check=True, cwd=ROOT)
+    return json.loads(proc.stdout)
+
+
+def test_import_generator_does_not_load_heavy_modules():
+    assert _run(SCRIPT)["loaded"] == []
+
+
+def test_moved_names_still_resolve_from_generator():
+    assert _run(SCRIPT)["shim"] == [True, True, True]
+
+
+def test_unknown_names_raise_attribute_error():
+    from trickle_block_util import generator
+    with pytest.raises(AttributeError):
+        generator.notARealName
@@ -0,0 +1,64 @@
+import time
+
+from trickle_block_util import traversal
+from trickle_block_util.generator import blocksToMarkdownWithLimits, \
+    createAssistantCommentBlocksWithLimits
+from trickle_block_util.limits import Limit, ConversionLimits, TRUNCATED_MARKER, \
+    estimateEmphasisWork
+
+NESTED_QUOTES = ">" * 15 + " x\n"
+NESTED_LIST = "".join("  " * i + "- item\n" for i in range(20))
+
+
+def _isFallback(blocks, text):
+    return len(blocks) == 1 and blocks[0]["type"] == "code" and \
+        blocks[0]["elements"][0]["text"] == text
+
+
+def test_quote_nesting_is_checked_by_the_tracker():
+    out, fired = createAssistantCommentBlocksWithLimits(
+        NESTED_QUOTES, useCache=False, limits=ConversionLimits(maxDepth=10))
+    assert fired == Limit.depth and _isFallback(out, NESTED_QUOTES)
+
+    out, fired = createAssistantCommentBlocksWithLimits(
+        NESTED_QUOTES, useCache=False, limits=ConversionLimits(maxDepth=20))
+    assert fired is None and out[0]["type"] == "quote"
+
+
+def test_traversal_depth_error_falls_back(monkeypatch):
+    monkeypatch.setattr(traversal, "maxDepth", 5)
+    for text in [NESTED_QUOTES, NESTED_LIST]:
+        out, fired = createAssistantCommentBlocksWithLimits(
+            text, useCache=False, limits=ConversionLimits(maxDepth=None))
+        assert fired == Limit.depth and _isFallback(out, text)
+
+    quote = {"type": "rich_texts", "elements": [{"type": "text", "text": "x"}]}
+    for _ in range(10):
+        quote = {"type": "quote", "blocks": [quote]}
+    out, fired = blocksToMarkdownWithLimits([quote], limits=ConversionLimits(maxDepth=None))
+    assert fired == Limit.depth and out == TRUNCATED_MARKER
+
+
+def test_nested_emphasis_is_rejected_before_parsing():
+    # 不检查时 mistune 要解析好几秒
+    text = '**a *b ' * 2000 + 'c* d**' * 2000
+    tic = time.perf_counter()
+    out, fired = createAssistantCommentBlocksWithLimits(
+        text, useCache=False, limits=ConversionLimits(maxSeconds=1.0))
+    assert time.perf_counter() - tic < 1.0
+    assert fired == Limit.seconds and _isFallback(out, text)
+
+
+def test_emphasis_work_estimate():
+    assert estimateEmphasisWork('**a *b ' * 100 + 'c* d**' * 100) > 100 * 100
+    # 配对的、空行隔开的、fenced code 里的、词中间的 _ 都不会堆积
+    benign = ['**bold** and *it* ' * 1000,
+              ''.join(f'- **a{i}** *b*\n' for i in range(1000)),
+              '\n\n'.join(['**a *b ' * 10 + 'c* d**' * 10] * 100),
+              '```\n' + '**a *b ' * 100 + '\n```\n' + 'c* d**' * 100,
+              'snake_case_name a_b ' * 1000]
+    for text in benign:
+        assert estimateEmphasisWork(text) <= 50000
+        out, fired = createAssistantCommentBlocksWithLimits(
+            text, useCache=False, limits=ConversionLimits(maxSeconds=1.0))
+        assert fired is None
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from trickle_block_util import metrics
+from trickle_block_util.generator import blocksToMarkdown, \
+    createAssistantCommentBlocks, getTextTokens
+from trickle_block_util.metrics import Stage, addMetricsHook, removeMetricsHook
+
+MARKDOWN = "# 标题\n\n- a\n- b\n\n```python\nprint(1)\n```"
+
+
+@pytest.fixture
+def records():
+    out = []
+    addMetricsHook(out.append)
+    yield out
+    removeMetricsHook(out.append)
+
+
+def test_stage_records_for_one_conversion(records, wordTokens):
+    tic = time.perf_counter()
+    blocks = createAssistantCommentBlocks(MARKDOWN, useCache=False)
+    elapsed = time.perf_counter() - tic
+
+    assert [r["stage"] for r in records] == [Stage.parse, Stage.renderBlocks]
+    parse, render = records
+    assert parse["inputSize"] == len(MARKDOWN)
+    assert parse["outputSize"] == render["inputSize"]
+    assert render["outputSize"] == len(blocks)
+    assert all(not r["failed"] for r in records)
+    assert all(type(r["seconds"]) is float for r in records)
+    assert 0 <= parse["seconds"] + render["seconds"] <= elapsed
+
+    del records[:]
+    markdown = blocksToMarkdown(blocks)
+    tokens = getTextTokens(markdown)
+    assert [r["stage"] for r in records] == [Stage.markdown, Stage.tokenize]
+    assert records[0]["outputSize"] == len(markdown)
+    assert records[1]["tokens"] == tokens
+
+
+def test_no_records_after_removing_the_hook(records):
+    removeMetricsHook(records.append)
+    assert not metrics.metricsEnabled()
+    createAssistantCommentBlocks(MARKDOWN, useCache=False)
+    assert records == []
+
+
+def test_failing_hook_does_not_break_conversion(records):
+    def broken(record):
+        raise RuntimeError("hook")
+
+    addMetricsHook(broken)
+    try:
+        blocks = createAssistantCommentBlocks(MARKDOWN, useCache=False)
+    finally:
+        removeMetricsHook(broken)
+    assert blocks
+    assert [r["stage"] for r in records] == [Stage.parse, Stage.renderBlocks]
@@ -0,0 +1,51 @@
+from trickle_block_util import outline
+from trickle_block_util.generator import RenderProfile, blocksToMarkdown
+from trickle_block_util.outline import OutlineLevel, blocksToOutline, fitOutline
+
+
+def _block(blockType, text, indent=0):
+    return {"type": blockType, "indent": indent, "blocks": [],
+            "elements": [{"type": "text", "text": text}]}
+
+
+BLOCKS = [
+    _block("rich_texts", "Intro first. Intro second."),
+    _block("h1", "Title"),
+    _block("rich_texts", "Body one. Body two is longer than the first sentence."),
+    _block("h2", "Section"),
+    _block("code", "print(1)"),
+    _block("list", "Point first. Point second."),
+    _block("h3", "Detail", indent=1),
+    {**_block("rich_texts", "Deleted sentence."), "isDeleted": True},
+    _block("h3", "Last"),
+]
+
+
+def test_heading_hierarchy():
+    assert blocksToOutline(BLOCKS) == "# Title\n## Section\n  ### Detail\n### Last"
+    assert blocksToOutline(BLOCKS, level=OutlineLevel.leads).split("\n") == [
+        "Intro first.", "# Title", "Body one.", "## Section", "Point first.",
+        "  ### Detail", "### Last"]
+    assert blocksToOutline(BLOCKS, level=OutlineLevel.full) == blocksToMarkdown(BLOCKS)
+
+
+def test_fit_picks_the_richest_level_within_budget(wordTokens):
+    levels = [OutlineLevel.headings, OutlineLevel.leads, OutlineLevel.full]
+    sizes = [wordTokens(blocksToOutline(BLOCKS, level=level)) for level in levels]
+    assert sizes == sorted(sizes)
+    for level, size in zip(levels, sizes):
+        assert fitOutline(BLOCKS, size) == (level, blocksToOutline(BLOCKS, level=level))
+    level, out = fitOutline(BLOCKS, sizes[1] - 1)
+    assert level == OutlineLevel.headings and wordTokens(out) <= sizes[1] - 1
+
+    level, out = fitOutline(BLOCKS, 3)
+    assert level == OutlineLevel.headings and out == "# Title\n##"
+
+
+def test_fallback_keeps_the_profile(wordTokens, monkeypatch):
+    profiles = []
+    render = outline.blocksToOutline
+    monkeypatch.setattr(outline, "blocksToOutline", lambda blocks, level, profile:
+                        profiles.append(profile) or render(blocks, level, profile))
+    fitOutline(BLOCKS, 1, profile=RenderProfile.compact)
+    assert profiles == [RenderProfile.compact, RenderProfile.compact]
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+from trickle_block_util import generator, segmented
+from trickle_block_util.cache import _reassignIds
+from trickle_block_util.segmented import createAssistantCommentBlocksSegmented, \
+    splitSegments
+
+TEXT = "\n\n".join(f"# part {i}\n\n- item {i}\n\n> quote {i}" for i in range(60))
+
+# 每一项都至少有一个空行，会被误切时结果就会不同
+EDGE_CASES = {
+    "fence with blank lines": "intro\n\n```python\na = 1\n\nb = 2\n```\n\nafter",
+    "fence with longer close": "````\n```\n\nnot closed\n````\n\nafter",
+    "tilde fence": "~~~\n\n# not a heading\n~~~\n\nafter",
+    "unclosed fence": "intro\n\n```\ncode\n\n# still code",
+    "fence in list item": "- item\n  ```\n  f()\n\n  ```\n\nafter",
+    "fence in ordered list item": "1. Step\n   ```bash\n   cmd\n\n   ```\n\nafter",
+    "list item ends its fence": "- item\n  ```\n```\n\n===",
+    "list item fence ends after blank": "- [ ] task\n  ```\n\ntext  \n  ```\n\ntext  ",
+    "fence breaks list item": "1. x\n  ```\n\nafter\n```\n\nafter",
+    "lazy line closes item fence": "-   x\n    ```\nlazy\n  ```\n\n```\n\nafter\n```",
+    "fence in nested list": "- a\n  - b\n    ```\n\n```\n\nafter\n```",
+    "tab after list marker": "-\ttab\n  ```\n\n```\n\nafter\n```",
+    "loose list": "- a\n\n- b\n\n- c\n\nafter",
+    "ordered list": "1. one\n\n2. two\n\n10. ten\n\nafter",
+    "ordered item after paragraph": "text\n2. x\n  ```\n\n```\n\nafter",
+    "list item continuation": "- item\n\n  continued\n\n      code in item\n\nafter",
+    "nested list": "- a\n  - b\n\n    - c\n\nafter",
+    "indented code": "    code\n\n    more code\n\nafter",
+    "lazy quote": "> q\n\nlazy\n\n> r\n> s\n\nafter",
+    "quote interrupted by list": "> q\n- item\n\n***\n\n# h\n\npara\n\nafter",
+    "quote interrupted by fence": "> q\n```\nx\n\n```\n\n---\n\nafter",
+    "setext heading": "Title\n===\n\n---\n\ntext  \nhard break",
+    "reference definition": "[a][x]\n\n[x]: https://www.trickle.so\n\nafter",
+    "html block": "<div>\n\nhtml\n\n</div>\n\nafter",
+}
+
+
+def _normalized(blocks):
+    _reassignIds(blocks, lambda: "id")
+    return blocks
+
+
+def _segmentedPass(text):
+    # 切成尽可能小的段，顺序解析，和并行的结果一样但更容易暴露边界问题
+    segments = splitSegments(text, 0) or [text]
+    out = []
+    for segment in segments:
+        out.extend(generator._markdownToBlocks(segment, None, None))
+    return out
+
+
+@pytest.mark.parametrize("name", list(EDGE_CASES))
+def test_segmented_matches_single_pass(name):
+    text = EDGE_CASES[name]
+    # 单独一份，以及重复多次、和普通段落拼在一起
+    for variant in [text, "\n\n".join([text] * 3), "para\n\n" + text + "\n\n# end"]:
+        assert _normalized(_segmentedPass(variant)) == \
+            _normalized(generator._markdownToBlocks(variant, None, None))
+
+
+def test_fences_in_list_items_still_split():
+    text = "1. Step\n   ```bash\n   cmd\n\n   ```\n\npara\n\n# h"
+    assert splitSegments(text, 0) == ["1. Step\n   ```bash\n   cmd\n\n   ```\n\n",
+                                      "para\n\n", "# h"]
+
+
+def test_concurrent_conversions_with_mixed_worker_counts():
+    expected = _normalized(generator._markdownToBlocks(TEXT, None, None))
+    errors = []
+
+    def run(workers):
+        try:
+            for _ in range(3):
+                out = createAssistantCommentBlocksSegmented(TEXT, workers=workers,
+                                                            minSegmentBytes=256)
+                assert _normalized(out) == expected
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(2 + i % 2,)) for i in range(6)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        segmented.shutdownExecutor()
+    assert errors == []
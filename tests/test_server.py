@@ -0,0 +1,117 @@
+import socket
+import threading
+
+import pytest
+
+from trickle_block_util import server, tokenizer
+from trickle_block_util.limits import ConversionLimits
+from trickle_block_util.server import MicroBatcher, RequestKind, SidecarClient, \
+    createServer
+
+
+def test_unix_socket_path_must_be_a_socket(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("keep me")
+    with pytest.raises(FileExistsError):
+        createServer(unixSocket=str(path), warm=False)
+    assert path.read_text() == "keep me"
+
+
+def test_stale_unix_socket_is_replaced(tmp_path):
+    path = str(tmp_path / "trickle.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    server = createServer(unixSocket=path, warm=False)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = SidecarClient(unixSocket=path)
+    try:
+        assert client.toBlocks("hello")[0]["type"] == "rich_texts"
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_tokens_do_not_wait_behind_conversions(monkeypatch):
+    monkeypatch.setattr(tokenizer, "encodeBatch", lambda texts: [t.split() for t in texts])
+    release = threading.Event()
+    monkeypatch.setitem(server._converters, RequestKind.blocks,
+                        lambda payload, limits: release.wait(10) and [])
+    batcher = MicroBatcher()
+    try:
+        conversion = batcher.submit(RequestKind.blocks, {"markdown": "x"})
+        assert batcher.submit(RequestKind.tokens, ["a b c"]).result(timeout=2) == [3]
+        assert not conversion.done()
+        release.set()
+        assert conversion.result(timeout=2) == []
+    finally:
+        release.set()
+        batcher.close()
+
+
+def test_conversions_use_limits():
+    batcher = MicroBatcher(limits=ConversionLimits(maxDepth=2))
+    try:
+        blocks = batcher.submit(RequestKind.blocks, {"markdown": ">>>> x"}).result()
+        assert len(blocks) == 1 and blocks[0]["type"] == "code"
+    finally:
+        batcher.close()
+
+
+def test_failed_token_batch_only_fails_the_offending_request(monkeypatch):
+    def encodeBatch(texts):
+        if "bad" in texts:
+            raise ValueError("bad text")
+        return [t.split() for t in texts]
+
+    monkeypatch.setattr(tokenizer, "encodeBatch", encodeBatch)
+    batcher = MicroBatcher(maxWait=0.5, maxBatch=3)
+    try:
+        futures = [batcher.submit(RequestKind.tokens, texts)
+                   for texts in (["a b"], ["bad"], ["c", "d e f"])]
+        assert futures[0].result(timeout=2) == [2]
+        with pytest.raises(ValueError):
+            futures[1].result(timeout=2)
+        assert futures[2].result(timeout=2) == [1, 3]
+        stats = batcher.stats.snapshot(0)
+        assert stats["batches"] == 1 and stats["maxBatchSize"] == 3
+        assert stats["errors"] == 1
+    finally:
+        batcher.close()
+
+
+def test_conversions_are_not_counted_as_batches():
+    batcher = MicroBatcher()
+    try:
+        batcher.submit(RequestKind.blocks, {"markdown": "x"}).result(timeout=5)
+        stats = batcher.stats.snapshot(0)
+        assert stats["batches"] == 0 and stats["requests"] == {"blocks": 1}
+    finally:
+        batcher.close()
+
+
+def test_large_request_bodies_are_rejected():
+    import http.client
+    server = createServer(port=0, warm=False, maxBodyBytes=1000)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    conn = http.client.HTTPConnection(host, port, timeout=5)
+    try:
+        conn.request("POST", "/blocks", body=b'{"markdown": "' + b"x" * 4000 + b'"}')
+        response = conn.getresponse()
+        assert response.status == 413 and b"exceeds 1000" in response.read()
+        assert response.getheader("Connection") == "close"
+
+        client = SidecarClient(port=port)
+        try:
+            assert client.toBlocks("hello")[0]["type"] == "rich_texts"
+        finally:
+            client.close()
+    finally:
+        conn.close()
+        server.shutdown()
+        server.server_close()
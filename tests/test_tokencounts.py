@@ -0,0 +1,68 @@
+from trickle_block_util import tokencounts
+from trickle_block_util.generator import blocksToMarkdown, \
+    createAssistantCommentBlocks, getTextTokens
+from trickle_block_util.tokencounts import TOKEN_COUNTS, annotateCommentTokenCounts, \
+    annotateTokenCounts, annotationKey, estimateTokens
+
+MARKDOWN = "# 标题\n\n**bold *it* `code`** and more words\n\n" \
+           "> quote line\n> - item\n\n- [ ] task\n\n```python\nprint(1)\n```"
+
+
+def _blocks():
+    return createAssistantCommentBlocks(MARKDOWN, useCache=False)
+
+
+def test_annotations_match_get_text_tokens(wordTokens):
+    blocks = _blocks()
+    assert annotateTokenCounts(blocks) == len(blocks)
+    key = annotationKey()
+    for b in blocks:
+        assert b[TOKEN_COUNTS][key]["tokens"] == \
+            getTextTokens(blocksToMarkdown([b]))
+
+    tokens, stats = estimateTokens(blocks)
+    assert stats == {"reused": len(blocks), "tokenized": 0}
+    assert tokens == sum(b[TOKEN_COUNTS][key]["tokens"] for b in blocks) + \
+        len(blocks) - 1
+    assert annotateTokenCounts(blocks) == 0
+
+
+def test_annotations_are_invalidated_when_blocks_change(wordTokens):
+    blocks = _blocks()
+    annotateTokenCounts(blocks)
+    changed = blocks[1]
+    changed['elements'].append({"type": "text", "text": " extra words here"})
+
+    tokens, stats = estimateTokens(blocks)
+    assert stats == {"reused": len(blocks) - 1, "tokenized": 1}
+    assert annotateTokenCounts(blocks) == 1
+    assert changed[TOKEN_COUNTS][annotationKey()]["tokens"] == \
+        getTextTokens(blocksToMarkdown([changed]))
+    assert estimateTokens(blocks)[1]["tokenized"] == 0
+
+
+def test_comment_annotations_render_each_comment_once(wordTokens, monkeypatch):
+    calls = []
+    render = tokencounts._blockMarkdownEntries
+
+    def counting(blocks, *args):
+        calls.append(len(blocks))
+        return render(blocks, *args)
+
+    monkeypatch.setattr(tokencounts, "_blockMarkdownEntries", counting)
+    comments = [{"commentAuthorName": "ann", "commentBlocks": _blocks()},
+                {"commentAuthorName": "bo", "commentBlocks": _blocks()[:2]}]
+    blockCount = len(comments[0]['commentBlocks']) + 2
+    assert annotateCommentTokenCounts(comments) == blockCount + 2
+    assert len(calls) == len(comments)
+
+    key = annotationKey()
+    for comment in comments:
+        commentStr = f"{comment['commentAuthorName']}: " + \
+            blocksToMarkdown(comment['commentBlocks'])
+        assert comment[TOKEN_COUNTS][key]["tokens"] == getTextTokens(commentStr)
+    assert annotateCommentTokenCounts(comments) == 0
+
+    comments[1]['commentBlocks'][0]['elements'].append(
+        {"type": "text", "text": " changed"})
+    assert annotateCommentTokenCounts(comments) == 2
@@ -0,0 +1,87 @@
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from trickle_block_util.generator import RenderProfile, generateTrickleContentPrompt, \
+    generateTrickleNormalCommentPrompt, getTextTokens
+
+
+# 多个post一起拼prompt、算token时用线程池并行。
+# tiktoken 的 encode/decode 执行时释放GIL，普通CPython上token计算也能用上多核；
+# 在 free-threaded（无GIL）的CPython上markdown渲染部分也可以并行。
+# parser、renderer、tokenizer 和 metrics hook 都可以在多个线程里同时使用。
+#
+#   prompts = contentPromptsBatch([{"title": t, "blocks": b} for t, b in posts])
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# 每种线程数一个线程池。不同线程数的调用可能同时在进行，换线程数时不能关掉别人正在用的池
+_executors: Dict[int, ThreadPoolExecutor] = {}
+_executorLock = threading.Lock()
+
+
+def defaultWorkers() -> int:
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def _getExecutor(workers: int) -> ThreadPoolExecutor:
+    with _executorLock:
+        executor = _executors.get(workers)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers,
+                                          thread_name_prefix="trickle-batch")
+            _executors[workers] = executor
+        return executor
+
+
+def shutdownExecutor():
+    # 关掉所有线程池，调用方要保证这时没有进行中的 mapBatch
+    with _executorLock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown()
+
+
+def mapBatch(func: Callable[[T], R], items: Sequence[T],
+             workers: Optional[int] = None) -> List[R]:
+    """按顺序返回 [func(item)]。items 分成每个线程几段提交，单个item很小时也不会被调度开销拖慢；
+    只有一个item或 workers=1 时直接在当前线程里执行。"""
+    workers = workers or defaultWorkers()
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    chunks = min(len(items), workers * 4)
+    size = -(-len(items) // chunks)
+    executor = _getExecutor(workers)
+    parts = executor.map(lambda start: [func(item) for item in items[start:start + size]],
+                         range(0, len(items), size))
+    out: List[R] = []
+    for part in parts:
+        out.extend(part)
+    return out
+
+
+def countTokensBatch(texts: Sequence[str], workers: Optional[int] = None) -> List[int]:
+    """[getTextTokens(text)]"""
+    return mapBatch(getTextTokens, texts, workers)
+
+
+def contentPromptsBatch(posts: Sequence[Dict], maxTokens: Optional[int] = 1500,
+                        profile: str = RenderProfile.default,
+                        workers: Optional[int] = None) -> List[str]:
+    """posts: [{"title": str, "blocks": list}]，返回每个post的 generateTrickleContentPrompt。"""
+    return mapBatch(lambda post: generateTrickleContentPrompt(
+        post.get("title"), post["blocks"], maxTokens=maxTokens, profile=profile),
+        posts, workers)
+
+
+def commentPromptsBatch(threads: Sequence[List[Dict]], maxTokens: Optional[int] = 1000,
+                        profile: str = RenderProfile.default, dedup: bool = False,
+                        workers: Optional[int] = None) -> List[Tuple[Dict, str]]:
+    """threads: 每个post的评论列表（格式同 generateTrickleNormalCommentPrompt），
+    返回每个post的 (commentPromptWithIds, commentPrompt)。"""
+    return mapBatch(lambda comments: generateTrickleNormalCommentPrompt(
+        comments, maxTokens=maxTokens, profile=profile, dedup=dedup),
+        threads, workers)
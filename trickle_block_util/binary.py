@@ -0,0 +1,580 @@
+from typing import List, Dict, Any, Iterator, Optional, Union
+import struct
+
+from trickle_block_util.traversal import checkDepth
+
+
+# block树的二进制格式，用于缓存（redis）和存储，比 Block.toJson 的json小很多:
+#   - field名和 type/display/constraint 的值放进字符串表，只写下标
+#   - 整数用 zigzag varint
+#   - 每个已知field用2个bit标记: 不存在 / 默认值(省略) / True / 有值
+#   - 子 blocks/elements 带长度前缀，解码时可以整棵子树跳过
+#
+# 文件结构:
+#   MAGIC(3) VERSION(1) 字符串表(varint个数 + 每个varint长度+utf8) 顶层节点列表
+# 节点列表: varint个数 + 每个节点(varint字节长度 + 节点内容)
+# 节点: varint字段标记 + varint额外字段个数 + 额外字段(key下标 + 值) + 有值的已知字段
+#
+# 编码和解码都用显式栈，不依赖python递归，嵌套深度的上限同 traversal.py。
+# 截断或损坏的数据解码时抛出 ValueError。
+MAGIC = b"TBK"
+FORMAT_VERSION = 1
+
+BLOCK_FIELDS = ["id", "type", "isFirst", "indent", "blocks", "display",
+                "elements", "isCurrent", "constraint", "lastEditedBy",
+                "lastEditedTime", "updatedByRemote", "computedValue",
+                "userDefinedValue", "isDeleted", "seqNum", "version"]
+ELEMENT_FIELDS = ["id", "type", "text", "elements", "isCurrent", "value"]
+
+_NO_DEFAULT = object()
+BLOCK_DEFAULTS = {
+    "isFirst": False,
+    "indent": 0,
+    "blocks": [],
+    "display": "block",
+    "elements": [],
+    "isCurrent": False,
+    "constraint": "free",
+    "lastEditedBy": None,
+    "lastEditedTime": None,
+    "updatedByRemote": False,
+    "computedValue": None,
+    "userDefinedValue": None,
+    "isDeleted": None,
+    "seqNum": 0,
+    "version": 0,
+}
+ELEMENT_DEFAULTS = {
+    "text": "",
+    "elements": [],
+    "isCurrent": False,
+    "value": None,
+}
+# 这些field的值重复度很高，放进字符串表
+INTERNED_FIELDS = {"type", "display", "constraint"}
+
+# 字段标记
+FIELD_ABSENT = 0
+FIELD_DEFAULT = 1
+FIELD_TRUE = 2
+FIELD_VALUE = 3
+
+# 值的类型tag
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_STR_REF = 6
+TAG_LIST = 7
+TAG_DICT = 8
+TAG_BLOCKS = 9
+TAG_ELEMENTS = 10
+
+_double = struct.Struct("<d")
+
+
+def _isDefault(value, default) -> bool:
+    # 0 == False，所以类型也要一致
+    return default is not _NO_DEFAULT and type(value) is type(default) \
+        and value == default
+
+
+def _writeVarint(out: bytearray, n: int):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+# 编码栈上的操作
+_OP_VALUE = 0       # (op, value, depth)
+_OP_KEY = 1         # (op, key)  dict/额外字段的key，出栈时才放进字符串表，保持字符串表的顺序
+_OP_STR_REF = 2     # (op, str)
+_OP_NODES = 3       # (op, nodes, 从第几个开始, fields, defaults, depth)
+_OP_END_NODE = 4    # (op,)  节点写完，带上长度前缀写进父节点的buffer
+_OP_NODE_HEADER = 5  # (op, tag, nodes, depth)  子节点列表的tag和个数
+
+_CONTAINER_TYPES = (list, tuple, dict)
+
+
+class _Encoder:
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self.stringIndex: Dict[str, int] = {}
+
+    def ref(self, s: str) -> int:
+        i = self.stringIndex.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(s)
+            self.stringIndex[s] = i
+        return i
+
+    def writeValue(self, out: bytearray, value):
+        self._write(out, [(_OP_VALUE, value, 0)])
+
+    def writeNodes(self, out: bytearray, nodes: list, fields: List[str],
+                   defaults: Dict[str, Any]):
+        self._writeNodeCount(out, nodes, 0)
+        self._write(out, [(_OP_NODES, nodes, 0, fields, defaults, 0)])
+
+    def _writeNodeCount(self, out: bytearray, nodes: list, depth: int):
+        _writeVarint(out, len(nodes))
+        if nodes:
+            checkDepth(depth)
+
+    def _write(self, out: bytearray, todo: list):
+        # 按写出的顺序处理，标量和没有嵌套的节点直接写，遇到容器才压栈。
+        # 每个节点先写进自己的buffer，写完才知道长度前缀
+        buffers = [out]
+        while todo:
+            item = todo.pop()
+            op = item[0]
+            buf = buffers[-1]
+            if op == _OP_VALUE:
+                self._writeValue(buf, item[1], item[2], todo)
+            elif op == _OP_KEY:
+                _writeVarint(buf, self.ref(str(item[1])))
+            elif op == _OP_STR_REF:
+                buf.append(TAG_STR_REF)
+                _writeVarint(buf, self.ref(item[1]))
+            elif op == _OP_NODE_HEADER:
+                buf.append(item[1])
+                self._writeNodeCount(buf, item[2], item[3])
+            elif op == _OP_NODES:
+                nodeOut = self._writeNodesFrom(buf, item, todo)
+                if nodeOut is not None:
+                    buffers.append(nodeOut)
+            else:
+                nodeOut = buffers.pop()
+                parent = buffers[-1]
+                _writeVarint(parent, len(nodeOut))
+                parent += nodeOut
+
+    def _writeNodesFrom(self, out: bytearray, item: tuple, todo: list):
+        # 从第start个节点开始依次写。某个节点有子节点要压栈时，剩下的节点排在它后面，
+        # 返回这个节点的buffer，由 _write 接着写它的子节点
+        _, nodes, start, fields, defaults, depth = item
+        for i in range(start, len(nodes)):
+            nodeOut = bytearray()
+            deferred = self._writeNode(nodeOut, nodes[i], fields, defaults, depth,
+                                       inlineChildren=True)
+            if deferred is None:
+                _writeVarint(out, len(nodeOut))
+                out += nodeOut
+                continue
+            if i + 1 < len(nodes):
+                todo.append((_OP_NODES, nodes, i + 1, fields, defaults, depth))
+            todo.append((_OP_END_NODE,))
+            todo.extend(reversed(deferred))
+            return nodeOut
+        return None
+
+    def _writeFlatNodes(self, out: bytearray, item: tuple) -> int:
+        # 依次写没有嵌套的节点，返回第一个需要压栈的节点的下标
+        _, nodes, start, fields, defaults, depth = item
+        for i in range(start, len(nodes)):
+            nodeOut = bytearray()
+            if self._writeNode(nodeOut, nodes[i], fields, defaults, depth) is not None:
+                # 这个节点之后由 _write 从头重新写，字符串表的顺序不受影响
+                return i
+            _writeVarint(out, len(nodeOut))
+            out += nodeOut
+        return len(nodes)
+
+    def _writeValue(self, out: bytearray, value, depth: int, todo: list):
+        # 标量直接写；list/dict写好tag和长度，子值压栈
+        if value is None:
+            out.append(TAG_NONE)
+        elif value is False:
+            out.append(TAG_FALSE)
+        elif value is True:
+            out.append(TAG_TRUE)
+        elif type(value) is int:
+            out.append(TAG_INT)
+            _writeVarint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif type(value) is float:
+            out.append(TAG_FLOAT)
+            out += _double.pack(value)
+        elif type(value) is str:
+            encoded = value.encode("utf-8")
+            out.append(TAG_STR)
+            _writeVarint(out, len(encoded))
+            out += encoded
+        elif type(value) in (list, tuple):
+            out.append(TAG_LIST)
+            _writeVarint(out, len(value))
+            if value:
+                checkDepth(depth + 1)
+                todo.extend([(_OP_VALUE, v, depth + 1) for v in reversed(value)])
+        elif type(value) is dict:
+            out.append(TAG_DICT)
+            _writeVarint(out, len(value))
+            if value:
+                checkDepth(depth + 1)
+            for k, v in reversed(list(value.items())):
+                todo.append((_OP_VALUE, v, depth + 1))
+                todo.append((_OP_KEY, k))
+        else:
+            raise TypeError(f"can not encode value of type {type(value).__name__}")
+
+    def _writeNode(self, out: bytearray, node: Dict, fields: List[str],
+                   defaults: Dict[str, Any], depth: int,
+                   inlineChildren: bool = False) -> Optional[list]:
+        """写一个节点。第一个非空的容器值之前的内容直接写出，从它开始的部分按写出顺序
+        返回操作列表；整个节点都写完时返回None。
+        inlineChildren: 子节点没有嵌套（比如block下面的普通文本element）时也直接写，只展开一层"""
+        marks = 0
+        values = []
+        for i, field in enumerate(fields):
+            if field not in node:
+                continue
+            value = node[field]
+            if value is True:
+                mark = FIELD_TRUE
+            elif _isDefault(value, defaults.get(field, _NO_DEFAULT)):
+                mark = FIELD_DEFAULT
+            else:
+                mark = FIELD_VALUE
+                values.append((field, value))
+            marks |= mark << (i * 2)
+        _writeVarint(out, marks)
+
+        extras = [k for k in node if k not in defaults and k not in ("id", "type")]
+        _writeVarint(out, len(extras))
+
+        deferred = None
+        for k in extras:
+            value = node[k]
+            if deferred is None and (type(value) not in _CONTAINER_TYPES or not value):
+                _writeVarint(out, self.ref(k))
+                self._writeValue(out, value, depth + 1, None)
+                continue
+            if deferred is None:
+                deferred = []
+            deferred.append((_OP_KEY, k))
+            deferred.append((_OP_VALUE, value, depth + 1))
+
+        for field, value in values:
+            valueType = type(value)
+            if deferred is None and valueType is not list and valueType is not dict \
+                    and valueType is not tuple:
+                # 最常见的情况: 前面都已经写出，值是标量
+                if valueType is str and field in INTERNED_FIELDS:
+                    out.append(TAG_STR_REF)
+                    _writeVarint(out, self.ref(value))
+                else:
+                    self._writeValue(out, value, depth + 1, None)
+                continue
+            if field == "blocks" and _isNodeList(value):
+                op = (_OP_NODES, value, 0, BLOCK_FIELDS, BLOCK_DEFAULTS, depth + 1)
+                tag = TAG_BLOCKS
+            elif field == "elements" and _isNodeList(value):
+                op = (_OP_NODES, value, 0, ELEMENT_FIELDS, ELEMENT_DEFAULTS, depth + 1)
+                tag = TAG_ELEMENTS
+            else:
+                if deferred is None and not value:
+                    # 空的list/dict
+                    self._writeValue(out, value, depth + 1, None)
+                    continue
+                if deferred is None:
+                    deferred = []
+                if valueType is str and field in INTERNED_FIELDS:
+                    deferred.append((_OP_STR_REF, value))
+                else:
+                    deferred.append((_OP_VALUE, value, depth + 1))
+                continue
+            # 子节点列表: tag和个数已经可以写了（前面没有等待的内容时），节点本身压栈
+            if deferred is None:
+                out.append(tag)
+                self._writeNodeCount(out, value, depth + 1)
+                start = self._writeFlatNodes(out, op) if inlineChildren else 0
+                if start == len(value):
+                    continue
+                op = op[:2] + (start,) + op[3:]
+                deferred = []
+            else:
+                deferred.append((_OP_NODE_HEADER, tag, value, depth + 1))
+            deferred.append(op)
+        return deferred
+
+
+def _isNodeList(value) -> bool:
+    return type(value) is list and all(type(v) is dict for v in value)
+
+
+def encodeBlocks(blocks: List[Dict]) -> bytes:
+    encoder = _Encoder()
+    body = bytearray()
+    encoder.writeNodes(body, blocks, BLOCK_FIELDS, BLOCK_DEFAULTS)
+    out = bytearray(MAGIC)
+    out.append(FORMAT_VERSION)
+    _writeVarint(out, len(encoder.strings))
+    for s in encoder.strings:
+        encoded = s.encode("utf-8")
+        _writeVarint(out, len(encoded))
+        out += encoded
+    out += body
+    return bytes(out)
+
+
+# 解码栈上的帧，都是 [类型, 要填的容器, 剩余个数, depth, ...]
+_FRAME_LIST = 0     # [.., ]
+_FRAME_DICT = 1     # [.., ]
+_FRAME_NODES = 2    # [.., fields, defaults]
+_FRAME_NODE = 3     # [.., 剩余额外字段个数, 剩余有值字段（倒序）]
+
+_CONTAINER_TAGS = {TAG_LIST, TAG_DICT, TAG_BLOCKS, TAG_ELEMENTS}
+
+# skipChildren 时跳过的子blocks，对应的key不出现在结果里
+_SKIPPED = object()
+
+
+class _Decoder:
+
+    def __init__(self, data: Union[bytes, bytearray, memoryview],
+                 skipChildren: bool = False):
+        self.data = bytes(data)
+        self.pos = 0
+        self.skipChildren = skipChildren
+        if self.data[:3] != MAGIC:
+            raise ValueError("not a trickle block binary")
+        if len(self.data) < 4 or self.data[3] != FORMAT_VERSION:
+            version = self.data[3] if len(self.data) > 3 else None
+            raise ValueError(f"unsupported binary format version: {version}")
+        self.pos = 4
+        with _corruptAsValueError(self):
+            self.strings = [self.readStr() for _ in range(self.readVarint())]
+
+    def readVarint(self) -> int:
+        data = self.data
+        pos = self.pos
+        shift = 0
+        n = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return n
+
+    def _advance(self, length: int) -> int:
+        # 返回原来的位置，长度超出数据时说明数据被截断了
+        start = self.pos
+        if start + length > len(self.data):
+            raise ValueError(f"truncated trickle block binary at {start}")
+        self.pos = start + length
+        return start
+
+    def readStr(self) -> str:
+        length = self.readVarint()
+        start = self._advance(length)
+        return self.data[start:start + length].decode("utf-8")
+
+    def readValue(self):
+        stack = []
+        value = self._startValue(stack, 0)
+        self._fill(stack)
+        return value
+
+    def readNodes(self, fields, defaults) -> List[Dict]:
+        stack = []
+        out = self._startNodes(stack, fields, defaults, 0)
+        self._fill(stack)
+        return out
+
+    def iterNodes(self, fields, defaults) -> Iterator[Dict]:
+        for _ in range(self.readVarint()):
+            self.readVarint()
+            yield self.readNode(fields, defaults)
+
+    def readNode(self, fields: List[str], defaults: Dict[str, Any]) -> Dict:
+        stack = []
+        out = self._startNode(stack, fields, defaults, 0)
+        self._fill(stack)
+        return out
+
+    def _fill(self, stack: list):
+        # 每次从栈顶的帧读一个子值；子值是容器时先放进父容器，再压一帧去填
+        strings = self.strings
+        while stack:
+            frame = stack[-1]
+            if frame[2] == 0:
+                stack.pop()
+                continue
+            frame[2] -= 1
+            kind = frame[0]
+            if kind == _FRAME_LIST:
+                frame[1].append(self._startValue(stack, frame[3]))
+            elif kind == _FRAME_DICT:
+                k = strings[self.readVarint()]
+                frame[1][k] = self._startValue(stack, frame[3])
+            elif kind == _FRAME_NODES:
+                self.readVarint()
+                frame[1].append(self._startNode(stack, frame[4], frame[5], frame[3],
+                                                inlineChildren=True))
+            else:
+                if frame[4] > 0:
+                    frame[4] -= 1
+                    k = strings[self.readVarint()]
+                else:
+                    k = frame[5].pop()
+                value = self._startValue(stack, frame[3] + 1, inlineChildren=True)
+                if value is _SKIPPED:
+                    del frame[1][k]
+                else:
+                    frame[1][k] = value
+
+    def _startValue(self, stack: list, depth: int, inlineChildren: bool = False):
+        # 标量直接返回；容器返回一个空的容器，压一帧，之后由 _fill 填
+        tag = self.data[self.pos]
+        self.pos += 1
+        if tag == TAG_NONE:
+            return None
+        elif tag == TAG_FALSE:
+            return False
+        elif tag == TAG_TRUE:
+            return True
+        elif tag == TAG_INT:
+            n = self.readVarint()
+            return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+        elif tag == TAG_FLOAT:
+            start = self._advance(8)
+            return _double.unpack_from(self.data, start)[0]
+        elif tag == TAG_STR:
+            return self.readStr()
+        elif tag == TAG_STR_REF:
+            return self.strings[self.readVarint()]
+        elif tag == TAG_LIST or tag == TAG_DICT:
+            out = [] if tag == TAG_LIST else {}
+            count = self.readVarint()
+            if count:
+                checkDepth(depth + 1)
+                stack.append([_FRAME_LIST if tag == TAG_LIST else _FRAME_DICT,
+                              out, count, depth + 1])
+            return out
+        elif tag == TAG_BLOCKS:
+            if self.skipChildren:
+                self._skipNodes()
+                return _SKIPPED
+            return self._startNodes(stack, BLOCK_FIELDS, BLOCK_DEFAULTS, depth,
+                                    inlineChildren)
+        elif tag == TAG_ELEMENTS:
+            return self._startNodes(stack, ELEMENT_FIELDS, ELEMENT_DEFAULTS, depth,
+                                    inlineChildren)
+        raise ValueError(f"unknown value tag {tag} at {self.pos - 1}")
+
+    def _skipNodes(self):
+        for _ in range(self.readVarint()):
+            self._advance(self.readVarint())
+
+    def _startNodes(self, stack: list, fields, defaults, depth: int,
+                    inlineChildren: bool = False) -> List[Dict]:
+        # inlineChildren: 没有嵌套的子节点（比如block下面的普通文本element）直接读，只展开一层
+        out = []
+        count = self.readVarint()
+        if not count:
+            return out
+        checkDepth(depth)
+        frame = [_FRAME_NODES, out, count, depth, fields, defaults]
+        while inlineChildren and frame[2]:
+            frame[2] -= 1
+            self.readVarint()
+            childStack = []
+            out.append(self._startNode(childStack, fields, defaults, depth))
+            if childStack:
+                # 这个子节点还没读完，剩下的兄弟节点排在它后面
+                if frame[2]:
+                    stack.append(frame)
+                stack.extend(childStack)
+                return out
+        if frame[2]:
+            stack.append(frame)
+        return out
+
+    def _startNode(self, stack: list, fields: List[str], defaults: Dict[str, Any],
+                   depth: int, inlineChildren: bool = False) -> Dict:
+        marks = self.readVarint()
+        extraCount = self.readVarint()
+        # 已知字段按顺序先放好（有值的先占位），额外字段排在后面
+        out = {}
+        valueFields = []
+        for i, field in enumerate(fields):
+            mark = (marks >> (i * 2)) & 3
+            if mark == FIELD_ABSENT:
+                continue
+            elif mark == FIELD_DEFAULT:
+                default = defaults[field]
+                out[field] = [] if type(default) is list else default
+            elif mark == FIELD_TRUE:
+                out[field] = True
+            else:
+                out[field] = None
+                valueFields.append(field)
+        # 标量值直接读，遇到第一个容器时把剩下的部分压一帧
+        data = self.data
+        valueFields.reverse()
+        while extraCount or valueFields:
+            if extraCount:
+                extraCount -= 1
+                k = self.strings[self.readVarint()]
+            else:
+                k = valueFields.pop()
+            if data[self.pos] in _CONTAINER_TAGS and (extraCount or valueFields):
+                stack.append([_FRAME_NODE, out, extraCount + len(valueFields), depth,
+                              extraCount, valueFields])
+                extraCount = 0
+                valueFields = []
+            value = self._startValue(stack, depth + 1, inlineChildren)
+            if value is _SKIPPED:
+                del out[k]
+            else:
+                out[k] = value
+        return out
+
+
+class _corruptAsValueError:
+    # 截断或损坏的数据在读的过程中会表现为 IndexError/KeyError 等，统一成 ValueError
+
+    def __init__(self, decoder: _Decoder):
+        self.decoder = decoder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is not None and issubclass(excType, (IndexError, KeyError,
+                                                        struct.error)):
+            raise ValueError(f"corrupt trickle block binary at "
+                             f"{self.decoder.pos}: {exc!r}") from exc
+        return False
+
+
+def decodeBlocks(data: Union[bytes, bytearray, memoryview]) -> List[Dict]:
+    decoder = _Decoder(data)
+    with _corruptAsValueError(decoder):
+        out = decoder.readNodes(BLOCK_FIELDS, BLOCK_DEFAULTS)
+    if decoder.pos != len(decoder.data):
+        raise ValueError(f"unexpected data after the last block at {decoder.pos}")
+    return out
+
+
+def iterBlocks(data: Union[bytes, bytearray, memoryview],
+               skipChildren: bool = False) -> Iterator[Dict]:
+    """逐个解码顶层block。skipChildren=True时直接跳过子blocks，有子blocks的block结果里
+    没有 "blocks" 这个key（没有子blocks的block仍然是 "blocks": []），
+    只需要顶层内容（比如统计type）的时候不用解码整棵树。"""
+    decoder = _Decoder(data, skipChildren=skipChildren)
+    return _iterCheckedNodes(decoder)
+
+
+def _iterCheckedNodes(decoder: _Decoder) -> Iterator[Dict]:
+    # 文件头在 iterBlocks 调用时就检查，节点在迭代时解码
+    with _corruptAsValueError(decoder):
+        yield from decoder.iterNodes(BLOCK_FIELDS, BLOCK_DEFAULTS)
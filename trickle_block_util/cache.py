@@ -0,0 +1,87 @@
+from typing import List, Dict, Any, Callable, Optional
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+
+
+# 重试、重新生成、同一条回复发到多个post时，createAssistantCommentBlocks 会反复转换同样的消息。
+# 这里缓存转换结果的骨架（json），命中后解析出一份新的拷贝并重新生成所有id。
+
+def _reassignIds(blocks: List[Dict], idGenerator: Callable[[], str]):
+    stack = list(blocks)
+    while stack:
+        node = stack.pop()
+        if 'id' in node:
+            node['id'] = idGenerator()
+        value = node.get('value')
+        if type(value) is dict and 'id' in value:
+            value['id'] = idGenerator()
+        stack.extend(node.get('blocks') or [])
+        stack.extend(node.get('elements') or [])
+
+
+class ConversionCache:
+    """有大小限制的LRU缓存: maxEntries 条、maxBytes 字节（按骨架json的长度计算）。"""
+
+    def __init__(self, maxEntries: int = 256, maxBytes: int = 16 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(message: str, options: Optional[Dict[str, Any]] = None) -> str:
+        digest = hashlib.sha256(message.encode('utf-8'))
+        if options:
+            digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key: str, idGenerator: Callable[[], str]) -> Optional[List[Dict]]:
+        with self._lock:
+            skeleton = self._entries.get(key)
+            if skeleton is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        blocks = json.loads(skeleton)
+        _reassignIds(blocks, idGenerator)
+        return blocks
+
+    def put(self, key: str, blocks: List[Dict]):
+        skeleton = json.dumps(blocks, ensure_ascii=False)
+        size = len(skeleton)
+        if size > self.maxBytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = skeleton
+            self._bytes += size
+            while len(self._entries) > self.maxEntries or self._bytes > self.maxBytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,242 @@
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+from collections import deque
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+
+from trickle_block_util.generator import RenderProfile, blocksToMarkdown, \
+    createAssistantCommentBlocks, truncateText
+
+
+# 批量转换 NDJSON:
+#   trickle-block-util blocks.ndjson --to markdown --profile compact --max-tokens 1500 -o out.ndjson
+#   trickle-block-util answers.ndjson --to blocks -o blocks.ndjson
+# 输入每行一条记录: --to markdown 时是 block 数组，--to blocks 时是 markdown 字符串（json编码）。
+# 输出和输入的非空行一一对应、顺序不变，转换失败的记录输出 {"error": ..., "line": 行号}。
+# 大文件用 mmap 打开，按行偏移切成块分给多个进程，每个进程自己 mmap 同一个文件只读对应的字节范围。
+
+class Direction:
+    markdown = "markdown"
+    blocks = "blocks"
+
+
+# 每个 worker 进程里打开的输入文件
+_inputMap: Optional[mmap.mmap] = None
+
+# 每个worker最多同时有几块在处理或等待写出，标准输入再快也只读这么多块到内存里
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+
+def _initWorker(path: Optional[str]):
+    global _inputMap
+    if path is not None:
+        with open(path, "rb") as f:
+            _inputMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def indexChunks(buf: Union[mmap.mmap, bytes], linesPerChunk: int
+                ) -> Iterator[Tuple[int, int, int]]:
+    """按行偏移切块，yield (起始字节, 结束字节, 起始行号)，行号从1开始。"""
+    start = 0
+    line = 1
+    size = len(buf)
+    while start < size:
+        end = start
+        lines = 0
+        while lines < linesPerChunk and end < size:
+            nl = buf.find(b"\n", end)
+            end = size if nl == -1 else nl + 1
+            lines += 1
+        yield start, end, line
+        line += lines
+        start = end
+
+
+def convertRecord(record, direction: str, profile: str,
+                  maxTokens: Optional[int]):
+    if direction == Direction.markdown:
+        if not isinstance(record, list):
+            raise ValueError("expected a block array")
+        out = blocksToMarkdown(record, profile=profile)
+        if maxTokens is not None:
+            out = truncateText(out, maxTokens)
+        return out
+    if not isinstance(record, str):
+        raise ValueError("expected a markdown string")
+    return createAssistantCommentBlocks(record, useCache=False)
+
+
+def convertChunk(task) -> Tuple[List[str], List[Tuple[int, str]], int]:
+    """task: (start, end, 起始行号, 原始字节或None, direction, profile, maxTokens)
+    返回 (输出行, [(行号, 错误)], 输入字节数)。"""
+    start, end, firstLine, data, direction, profile, maxTokens = task
+    if data is None:
+        data = _inputMap[start:end]
+    outputs = []
+    failures = []
+    for i, raw in enumerate(data.split(b"\n")):
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            result = convertRecord(json.loads(raw), direction, profile, maxTokens)
+            outputs.append(json.dumps(result, ensure_ascii=False))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            failures.append((firstLine + i, error))
+            outputs.append(json.dumps({"error": error, "line": firstLine + i},
+                                      ensure_ascii=False))
+    return outputs, failures, len(data)
+
+
+def _stdinChunks(stream, linesPerChunk: int) -> Iterator[Tuple[int, int, int, bytes]]:
+    # 标准输入没法mmap，按行读够一块就交给worker
+    line = 1
+    pending = []
+    for raw in stream:
+        pending.append(raw)
+        if len(pending) == linesPerChunk:
+            yield 0, 0, line, b"".join(pending)
+            line += len(pending)
+            pending = []
+    if pending:
+        yield 0, 0, line, b"".join(pending)
+
+
+def imapBounded(pool, func: Callable, tasks: Iterable, window: int) -> Iterator:
+    """和 pool.imap 一样按提交顺序返回结果，但最多只有 window 个任务已提交还没取走结果。
+    pool.imap 会在后台线程里把 tasks 一次读完，标准输入很大时整个输入都会堆在内存里。"""
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+class Progress:
+
+    def __init__(self, interval: float, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.lastReport = self.started
+        self.records = 0
+        self.failures = 0
+        self.inputBytes = 0
+
+    def update(self, records: int, failures: List[Tuple[int, str]], inputBytes: int):
+        self.records += records
+        self.failures += len(failures)
+        self.inputBytes += inputBytes
+        for line, error in failures:
+            print(f"line {line}: {error}", file=self.stream)
+        now = time.perf_counter()
+        if self.interval > 0 and now - self.lastReport >= self.interval:
+            self.lastReport = now
+            self.report()
+
+    def report(self, final: bool = False):
+        seconds = max(time.perf_counter() - self.started, 1e-9)
+        print(f"{'done' if final else 'progress'}: {self.records} records, "
+              f"{self.failures} failed, {self.records / seconds:.0f} records/s, "
+              f"{self.inputBytes / seconds / 1e6:.2f} MB/s, {seconds:.1f}s",
+              file=self.stream, flush=True)
+
+
+def run(inputPath: str, output, direction: str, profile: str = RenderProfile.default,
+        maxTokens: Optional[int] = None, workers: int = 1,
+        linesPerChunk: int = 200, progressInterval: float = 2.0) -> Progress:
+    progress = Progress(progressInterval)
+    options = (direction, profile, maxTokens)
+
+    inputMap = None
+    if inputPath == "-":
+        tasks = (chunk + options for chunk in _stdinChunks(sys.stdin.buffer,
+                                                            linesPerChunk))
+        workerPath = None
+    else:
+        with open(inputPath, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                progress.report(final=True)
+                return progress
+            inputMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        tasks = ((start, end, line, None) + options
+                 for start, end, line in indexChunks(inputMap, linesPerChunk))
+        workerPath = inputPath
+
+    try:
+        if workers <= 1:
+            _initWorker(workerPath)
+            results = map(convertChunk, tasks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(workers, initializer=_initWorker,
+                                        initargs=(workerPath,))
+            # 按提交顺序返回结果，读输入的速度跟着写输出的速度走
+            results = imapBounded(pool, convertChunk, tasks,
+                                  workers * CHUNKS_IN_FLIGHT_PER_WORKER)
+        try:
+            for outputs, failures, inputBytes in results:
+                for line in outputs:
+                    output.write(line)
+                    output.write("\n")
+                progress.update(len(outputs), failures, inputBytes)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    finally:
+        if inputMap is not None:
+            inputMap.close()
+    progress.report(final=True)
+    return progress
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="trickle-block-util",
+        description="Convert NDJSON records between trickle blocks and markdown.")
+    parser.add_argument("input", help="NDJSON file, or - for stdin")
+    parser.add_argument("-o", "--output", default="-",
+                        help="output NDJSON file, default stdout")
+    parser.add_argument("--to", dest="direction", required=True,
+                        choices=[Direction.markdown, Direction.blocks],
+                        help="markdown: block arrays -> markdown strings; "
+                             "blocks: markdown strings -> block arrays")
+    parser.add_argument("--profile", default=RenderProfile.default,
+                        choices=[RenderProfile.default, RenderProfile.compact])
+    parser.add_argument("--max-tokens", type=int, default=None,
+                        help="truncate each markdown output to this many tokens")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-lines", type=int, default=200,
+                        help="records per task sent to a worker")
+    parser.add_argument("--progress", type=float, default=2.0,
+                        help="seconds between progress reports, 0 to disable")
+    args = parser.parse_args(argv)
+
+    if args.max_tokens is not None and args.direction != Direction.markdown:
+        parser.error("--max-tokens only applies to --to markdown")
+
+    if args.output == "-":
+        output = sys.stdout
+    else:
+        output = open(args.output, "w", encoding="utf-8")
+    try:
+        progress = run(args.input, output, args.direction, profile=args.profile,
+                       maxTokens=args.max_tokens, workers=args.workers,
+                       linesPerChunk=max(1, args.chunk_lines),
+                       progressInterval=args.progress)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if progress.failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
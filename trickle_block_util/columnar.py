@@ -0,0 +1,367 @@
+from typing import List, Dict, Iterable, Optional
+from array import array
+from collections import Counter
+import json
+
+from trickle_block_util.generator import Block, BlockType, RenderProfile, \
+    blocksToMarkdown
+
+try:
+    import numpy
+except ImportError:  # numpy是可选的，没有的话用纯python过滤
+    numpy = None
+
+
+# 分析任务要扫几百万个block（统计type、找删除的block、按语言取code block），
+# 每个都建一个 Block 对象太慢。这里把多个文档展开成若干平行的数组，一行一个block（先序遍历）。
+
+FLAG_IS_FIRST = 1
+FLAG_IS_CURRENT = 2
+FLAG_UPDATED_BY_REMOTE = 4
+FLAG_IS_DELETED = 8
+
+_flagFields = [
+    ("isFirst", FLAG_IS_FIRST),
+    ("isCurrent", FLAG_IS_CURRENT),
+    ("updatedByRemote", FLAG_UPDATED_BY_REMOTE),
+    ("isDeleted", FLAG_IS_DELETED),
+]
+
+# stored 列标记哪些字段没进payload、转回时从列里还原
+_flagBits = dict(_flagFields)
+
+_STORED_TYPE = 1
+_STORED_INDENT = 2
+_STORED_FLAG_SHIFT = 2  # bool flag 字段用 flag << 2
+
+_INDENT_MIN = -2 ** 31
+_INDENT_MAX = 2 ** 31 - 1
+
+_columnNames = ('docIndex', 'typeCode', 'indent', 'flags', 'stored', 'parent',
+                'subtreeSize', 'codeLang', 'textStart', 'textLength',
+                'payloadStart', 'payloadLength')
+
+
+def _elementsText(elements: list) -> str:
+    # 只取纯文本，不带markdown标记
+    parts: List[str] = []
+    stack = list(reversed(elements))
+    while stack:
+        e = stack.pop()
+        if type(e) is not dict:
+            continue
+        if e.get('text'):
+            parts.append(e['text'])
+        children = e.get('elements')
+        if children:
+            stack.extend(reversed(children))
+    return "".join(parts)
+
+
+def _elementsWithoutText(elements: list) -> list:
+    # 拷贝一份，非空的 text 换成长度，文本已经在共享buffer里了
+    out = list(elements)
+    stack = [out]
+    while stack:
+        items = stack.pop()
+        for i, e in enumerate(items):
+            if type(e) is not dict:
+                continue
+            e = items[i] = dict(e)
+            text = e.get('text')
+            if text and type(text) is str:
+                e['text'] = len(text)
+            children = e.get('elements')
+            if children and type(children) is list:
+                children = e['elements'] = list(children)
+                stack.append(children)
+    return out
+
+
+def _restoreElementTexts(elements: list, text: str):
+    # 和 _elementsText 同样的先序，按长度把文本切回去
+    pos = 0
+    stack = list(reversed(elements))
+    while stack:
+        e = stack.pop()
+        if type(e) is not dict:
+            continue
+        length = e.get('text')
+        if type(length) is int and length > 0:
+            e['text'] = text[pos:pos + length]
+            pos += length
+        children = e.get('elements')
+        if children and type(children) is list:
+            stack.extend(reversed(children))
+
+
+class ColumnarBlocks:
+    """多个文档的block平铺成列存储。
+
+    每一行一个block，列: docIndex、type编码、indent、flags、父节点行号(-1是顶层)、
+    子树大小、纯文本在共享buffer里的位置、code block的语言编码(-1不是code)。
+    行转回 Block/markdown 用的是另外存的json，不含子blocks，也不重复存列里已有的
+    type/indent/flags 和纯文本。
+    """
+
+    def __init__(self):
+        self.typeNames: List[str] = [v for k, v in vars(BlockType).items()
+                                     if not k.startswith('_')]
+        self.typeCodes: Dict[str, int] = {t: i for i, t in
+                                          enumerate(self.typeNames)}
+        self.langNames: List[str] = []
+        self.langCodes: Dict[str, int] = {}
+
+        self.docIndex = array('q')
+        self.typeCode = array('H')
+        self.indent = array('i')
+        self.flags = array('B')
+        self.stored = array('B')
+        self.parent = array('q')
+        self.subtreeSize = array('q')
+        self.codeLang = array('h')
+        self.textStart = array('q')
+        self.textLength = array('q')
+        self.payloadStart = array('q')
+        self.payloadLength = array('q')
+
+        self._textParts: List[str] = []
+        self._textSize = 0
+        self._text: Optional[str] = None
+        self._payload = bytearray()
+        self.documentCount = 0
+
+    @classmethod
+    def fromDocuments(cls, documents: Iterable[List[Dict]]):
+        out = cls()
+        for blocks in documents:
+            out.addDocument(blocks)
+        return out
+
+    def __len__(self):
+        return len(self.typeCode)
+
+    def _code(self, names: List[str], codes: Dict[str, int], name: str) -> int:
+        code = codes.get(name)
+        if code is None:
+            code = len(names)
+            names.append(name)
+            codes[name] = code
+        return code
+
+    def addDocument(self, blocks: List[Dict]) -> int:
+        docIndex = self.documentCount
+        rowCount = len(self)
+        payloadSize = len(self._payload)
+        textPartCount = len(self._textParts)
+        textSize = self._textSize
+        try:
+            # 先序遍历，(block, 父行号, None)；子树处理完后 (None, None, 行号) 回填子树大小
+            stack = [(b, -1, None) for b in reversed(blocks)]
+            while stack:
+                b, parentRow, finishedRow = stack.pop()
+                if finishedRow is not None:
+                    self.subtreeSize[finishedRow] = len(self.typeCode) - finishedRow
+                    continue
+                row = len(self.typeCode)
+                self._addRow(b, docIndex, parentRow)
+                stack.append((None, None, row))
+                stack.extend([(c, row, None) for c in reversed(b.get('blocks') or [])])
+        except BaseException:
+            # 出错的文档整个不要，已经加进去的行撤掉，各列保持等长
+            for name in _columnNames:
+                del getattr(self, name)[rowCount:]
+            del self._payload[payloadSize:]
+            del self._textParts[textPartCount:]
+            self._textSize = textSize
+            self._text = None
+            raise
+        self.documentCount += 1
+        return docIndex
+
+    def _addRow(self, b: Dict, docIndex: int, parentRow: int):
+        # 会出错的先算完再往列里加
+        blkType = b.get('type') or ""
+        indent = b.get('indent') or 0
+        if type(indent) is not int or not _INDENT_MIN <= indent <= _INDENT_MAX:
+            raise ValueError(f"invalid block indent: {indent!r}")
+        text = _elementsText(b.get('elements') or [])
+
+        flags = 0
+        stored = 0
+        payload = {}
+        for k, v in b.items():
+            if k == 'blocks':
+                payload[k] = []
+            elif k == 'type' and type(v) is str:
+                stored |= _STORED_TYPE
+            elif k == 'indent' and type(v) is int:
+                stored |= _STORED_INDENT
+            elif k == 'elements' and type(v) is list:
+                payload[k] = _elementsWithoutText(v)
+            elif k in _flagBits and type(v) is bool:
+                stored |= _flagBits[k] << _STORED_FLAG_SHIFT
+            else:
+                payload[k] = v
+        for field, flag in _flagFields:
+            if b.get(field):
+                flags |= flag
+        encoded = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+        lang = -1
+        if blkType == BlockType.code:
+            userDefinedValue = b.get('userDefinedValue')
+            language = userDefinedValue.get("language", "plain") \
+                if type(userDefinedValue) is dict else "plain"
+            lang = self._code(self.langNames, self.langCodes, language)
+
+        self.docIndex.append(docIndex)
+        self.typeCode.append(self._code(self.typeNames, self.typeCodes, blkType))
+        self.indent.append(indent)
+        self.flags.append(flags)
+        self.stored.append(stored)
+        self.parent.append(parentRow)
+        self.subtreeSize.append(1)
+        self.codeLang.append(lang)
+
+        self.textStart.append(self._textSize)
+        self.textLength.append(len(text))
+        self._textParts.append(text)
+        self._textSize += len(text)
+        self._text = None
+
+        self.payloadStart.append(len(self._payload))
+        self.payloadLength.append(len(encoded))
+        self._payload += encoded
+
+    # ---------- 查询 ----------
+
+    def column(self, name: str):
+        """返回一列的拷贝，有numpy时是 ndarray。
+
+        不给视图：视图占着底层 array 的buffer，之后 addDocument 会 BufferError。
+        """
+        col = getattr(self, name)
+        if numpy is not None:
+            return numpy.array(col, dtype=col.typecode)
+        return array(col.typecode, col)
+
+    def _view(self, name: str):
+        # 内部查询用的不拷贝视图，不能留到函数外面
+        col = getattr(self, name)
+        return numpy.frombuffer(col, dtype=col.typecode) if len(col) else \
+            numpy.zeros(0, dtype=col.typecode)
+
+    def text(self, row: int) -> str:
+        if self._text is None:
+            self._text = "".join(self._textParts)
+            self._textParts = [self._text]
+        start = self.textStart[row]
+        return self._text[start:start + self.textLength[row]]
+
+    def filterRows(self, type: Optional[str] = None,
+                   isDeleted: Optional[bool] = None,
+                   codeLang: Optional[str] = None,
+                   docIndex: Optional[int] = None,
+                   topLevel: bool = False) -> List[int]:
+        typeCode = None
+        if type is not None:
+            typeCode = self.typeCodes.get(type)
+            if typeCode is None:
+                return []
+        langCode = None
+        if codeLang is not None:
+            langCode = self.langCodes.get(codeLang)
+            if langCode is None:
+                return []
+
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            if typeCode is not None:
+                mask &= self._view('typeCode') == typeCode
+            if isDeleted is not None:
+                deleted = (self._view('flags') & FLAG_IS_DELETED) != 0
+                mask &= deleted if isDeleted else ~deleted
+            if langCode is not None:
+                mask &= self._view('codeLang') == langCode
+            if docIndex is not None:
+                mask &= self._view('docIndex') == docIndex
+            if topLevel:
+                mask &= self._view('parent') == -1
+            return numpy.flatnonzero(mask).tolist()
+
+        out = []
+        for row in range(len(self)):
+            if typeCode is not None and self.typeCode[row] != typeCode:
+                continue
+            if isDeleted is not None and \
+                    bool(self.flags[row] & FLAG_IS_DELETED) != isDeleted:
+                continue
+            if langCode is not None and self.codeLang[row] != langCode:
+                continue
+            if docIndex is not None and self.docIndex[row] != docIndex:
+                continue
+            if topLevel and self.parent[row] != -1:
+                continue
+            out.append(row)
+        return out
+
+    def countTypes(self, includeDeleted: bool = True) -> Dict[str, int]:
+        if numpy is not None:
+            codes = self._view('typeCode')
+            if not includeDeleted:
+                codes = codes[(self._view('flags') & FLAG_IS_DELETED) == 0]
+            counts = numpy.bincount(codes, minlength=len(self.typeNames))
+            return {self.typeNames[i]: int(c) for i, c in enumerate(counts) if c}
+        counter = Counter()
+        for row in range(len(self)):
+            if includeDeleted or not self.flags[row] & FLAG_IS_DELETED:
+                counter[self.typeCode[row]] += 1
+        return {self.typeNames[code]: c for code, c in counter.items()}
+
+    def countCodeLangs(self) -> Dict[str, int]:
+        if numpy is not None:
+            codes = self._view('codeLang')
+            counts = numpy.bincount(codes[codes >= 0],
+                                    minlength=len(self.langNames))
+            return {self.langNames[i]: int(c) for i, c in enumerate(counts) if c}
+        counter = Counter(c for c in self.codeLang if c >= 0)
+        return {self.langNames[code]: c for code, c in counter.items()}
+
+    # ---------- 转回 Block ----------
+
+    def _payloadOf(self, row: int) -> Dict:
+        start = self.payloadStart[row]
+        node = json.loads(self._payload[start:start + self.payloadLength[row]])
+        stored = self.stored[row]
+        if stored & _STORED_TYPE:
+            node['type'] = self.typeNames[self.typeCode[row]]
+        if stored & _STORED_INDENT:
+            node['indent'] = self.indent[row]
+        for field, flag in _flagFields:
+            if stored & flag << _STORED_FLAG_SHIFT:
+                node[field] = bool(self.flags[row] & flag)
+        elements = node.get('elements')
+        if self.textLength[row] and type(elements) is list:
+            _restoreElementTexts(elements, self.text(row))
+        return node
+
+    def toBlockDict(self, row: int) -> Dict:
+        # 子树在先序遍历里是连续的 [row, row + subtreeSize)
+        nodes = {}
+        for r in range(row, row + self.subtreeSize[row]):
+            node = self._payloadOf(r)
+            nodes[r] = node
+            if r != row:
+                nodes[self.parent[r]]['blocks'].append(node)
+        return nodes[row]
+
+    def toBlockDicts(self, rows: Iterable[int]) -> List[Dict]:
+        return [self.toBlockDict(row) for row in rows]
+
+    def toBlocks(self, rows: Iterable[int]) -> List[Block]:
+        return [Block(d) for d in self.toBlockDicts(rows)]
+
+    def toMarkdown(self, rows: Iterable[int],
+                   profile=RenderProfile.default) -> str:
+        return blocksToMarkdown(self.toBlockDicts(rows), profile=profile)
@@ -0,0 +1,199 @@
+from typing import List, Dict, Tuple, Any, Optional
+from collections.abc import Mapping
+
+from trickle_block_util.generator import Block, BlockType, RenderProfile, \
+    getTextTokens
+
+
+# 评论串里经常引用（quote）前面的评论，或者重复贴AI的回复，
+# 这里把重复出现的内容替换成一个简短的引用，省掉重复的token。
+
+# 多项式滚动hash: H(a + b) = H(a) * BASE^len(b) + H(b)
+# 拼接的hash可以直接由两部分的hash算出来，quote的hash不用再扫一遍子block的文本
+MOD = (1 << 61) - 1
+BASE = 1000003
+
+
+def rollingHash(text: str) -> int:
+    h = 0
+    for ch in text:
+        h = (h * BASE + ord(ch)) % MOD
+    return h
+
+
+def combineHash(leftHash: int, rightHash: int, rightLength: int) -> int:
+    return (leftHash * pow(BASE, rightLength, MOD) + rightHash) % MOD
+
+
+quotePrefix = "> "
+quotePrefixHash = rollingHash(quotePrefix)
+lineBreakHash = rollingHash("\n")
+
+
+def backReference(author: str) -> str:
+    return f"(same as {author} above)"
+
+
+class _Fingerprints:
+    """记录已经出现过的段落，key是 (hash, 长度)，命中后再比较一次原文避免hash碰撞。"""
+
+    def __init__(self, minChars: int):
+        self.minChars = minChars
+        self.seen: Dict[Tuple[int, int], Tuple[Any, str]] = {}
+        self.duplicates = 0
+        self.removed: List[str] = []
+        self.backReferences: List[str] = []
+
+    def lookup(self, fingerprint: Tuple[int, int], content) -> Optional[str]:
+        # 返回第一次出现时的作者，没出现过返回None
+        if fingerprint[1] < self.minChars:
+            return None
+        first = self.seen.get(fingerprint)
+        if first is not None and first[0] == content:
+            return first[1]
+        return None
+
+    def record(self, fingerprint: Tuple[int, int], content, author: str):
+        if fingerprint[1] >= self.minChars and fingerprint not in self.seen:
+            self.seen[fingerprint] = (content, author)
+
+    def replace(self, text: str, author: str) -> str:
+        ref = backReference(author)
+        self.duplicates += 1
+        self.removed.append(text)
+        self.backReferences.append(ref)
+        return ref
+
+    def report(self) -> "DedupReport":
+        return DedupReport(self.duplicates, self.removed, self.backReferences)
+
+
+class DedupReport(Mapping):
+    """{"duplicates", "savedChars", "savedTokens"}。savedTokens 第一次读取时才调用tokenizer，
+    只要去重结果、不看报告的调用方不用为它付出tokenize的开销。"""
+
+    def __init__(self, duplicates: int, removed: List[str], backReferences: List[str]):
+        self._removedText = "\n".join(removed)
+        self._refText = "\n".join(backReferences)
+        self._values = {
+            "duplicates": duplicates,
+            "savedChars": len(self._removedText) - len(self._refText),
+        }
+
+    def __getitem__(self, key):
+        if key == "savedTokens" and key not in self._values:
+            savedTokens = 0
+            if self._values["duplicates"] > 0:
+                savedTokens = getTextTokens(self._removedText) - \
+                    getTextTokens(self._refText)
+            self._values[key] = savedTokens
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(["duplicates", "savedChars", "savedTokens"])
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _quoteFingerprint(childFingerprints: List[Tuple[int, int]]):
+    h = 0
+    length = 0
+    for i, (childHash, childLength) in enumerate(childFingerprints):
+        if i > 0:
+            h = combineHash(h, lineBreakHash, 1)
+            length += 1
+        h = combineHash(h, quotePrefixHash, len(quotePrefix))
+        h = combineHash(h, childHash, childLength)
+        length += len(quotePrefix) + childLength
+    return (h, length)
+
+
+def _dedupBlock(blk: Block, author: str, fingerprints: _Fingerprints,
+                profile) -> str:
+    if blk.type != BlockType.quote:
+        text = blk.toMarkdown(profile)
+        fingerprint = (rollingHash(text), len(text))
+        firstAuthor = fingerprints.lookup(fingerprint, text)
+        if firstAuthor is not None:
+            return fingerprints.replace(text, firstAuthor)
+        fingerprints.record(fingerprint, text, author)
+        return text
+
+    # quote: 整体重复就整体替换，否则逐个子block(段落)检查
+    childTexts = [b.toMarkdown(profile) for b in blk.blocks]
+    childFingerprints = [(rollingHash(t), len(t)) for t in childTexts]
+    fingerprint = _quoteFingerprint(childFingerprints)
+    content = tuple(childTexts)
+    firstAuthor = fingerprints.lookup(fingerprint, content)
+    if firstAuthor is not None:
+        return fingerprints.replace(blk.toMarkdown(profile), firstAuthor)
+    fingerprints.record(fingerprint, content, author)
+
+    lines = []
+    for text, childFingerprint in zip(childTexts, childFingerprints):
+        firstAuthor = fingerprints.lookup(childFingerprint, text)
+        if firstAuthor is not None:
+            text = fingerprints.replace(text, firstAuthor)
+        else:
+            fingerprints.record(childFingerprint, text, author)
+        lines.append(quotePrefix + text)
+    indent = " " if profile == RenderProfile.compact else "  "
+    return indent * blk.indent + "\n".join(lines)
+
+
+def dedupCommentThread(comments: list, minChars: int = 40,
+                       profile=RenderProfile.default):
+    '''
+        comments: generateTrickleNormalCommentPrompt 使用的格式
+        [{'commentId': 123456,
+          'commentBlocks': commentblocks,
+          'commentAuthorName': 'John'}, ...]
+
+        返回 ({commentId: markdown}, report)
+    '''
+    fingerprints = _Fingerprints(minChars)
+    out = {}
+    for comment in comments:
+        if comment['commentBlocks'] is None:
+            continue
+        author = comment['commentAuthorName']
+        lines: List[str] = []
+        for perBlk in comment['commentBlocks']:
+            blk = Block(perBlk)
+            if blk.isDeleted:
+                continue
+            lines.append(_dedupBlock(blk, author, fingerprints, profile))
+        out[comment["commentId"]] = "\n".join(lines)
+    return out, fingerprints.report()
+
+
+def dedupTexts(texts: List[Tuple[str, str]], minChars: int = 40):
+    '''
+        texts: [(author, markdown), ...]，按段落（行）去重，
+        "> " 开头的引用行和前面的原文比较。
+
+        返回 ([(author, markdown), ...], report)
+    '''
+    fingerprints = _Fingerprints(minChars)
+    out = []
+    for author, text in texts:
+        lines = []
+        for line in str(text).split("\n"):
+            prefix = ""
+            content = line
+            while content.startswith(quotePrefix):
+                prefix += quotePrefix
+                content = content[len(quotePrefix):]
+            fingerprint = (rollingHash(content), len(content))
+            firstAuthor = fingerprints.lookup(fingerprint, content)
+            if firstAuthor is not None:
+                content = fingerprints.replace(content, firstAuthor)
+            else:
+                fingerprints.record(fingerprint, content, author)
+            lines.append(prefix + content)
+        out.append((author, "\n".join(lines)))
+    return out, fingerprints.report()
@@ -0,0 +1,190 @@
+from typing import List, Dict, Any, Optional
+from bisect import bisect_left
+
+from trickle_block_util.generator import Block
+from trickle_block_util.traversal import checkDepth
+
+
+# block列表的diff/patch，AI改写文章后只把变化的部分同步给前端
+#
+# patch格式:
+# {
+#     "version": 1,
+#     "length": <新列表长度>,
+#     "ops": [
+#         {"op": "delete", "index": <旧下标>},
+#         {"op": "move", "from": <旧下标>, "to": <新下标>},
+#         {"op": "insert", "to": <新下标>, "block": {...}},
+#         {"op": "update", "index": <新下标>, <节点diff>},
+#     ]
+# }
+# 没出现在 delete/move 里的旧block按原来的相对顺序填到剩下的位置上。
+#
+# 节点diff只包含变化的字段，子节点个数不变时逐个下标递归比较:
+#   {"set": {字段: 新值}, "unset": [字段],
+#    "elements": [[<下标>, <节点diff>], ...], "blocks": [[<下标>, <节点diff>], ...]}
+# AI改写后id全是新的时，每个element只需要带上新id，不用整个重发。
+# version 1 的 elements 里是 [<下标>, <完整的element>]，applyPatch 仍然支持。
+PATCH_VERSION = 2
+_SUPPORTED_VERSIONS = {1, PATCH_VERSION}
+_CHILD_FIELDS = ('elements', 'blocks')
+
+
+def _matchBlocks(oldBlocks: List[Dict], newBlocks: List[Dict]) -> List[Optional[int]]:
+    # 先按id匹配，剩下的再按内容hash匹配（AI重新生成的block id都是新的）
+    oldById = {}
+    for i, b in enumerate(oldBlocks):
+        bid = b.get('id')
+        if bid is not None and bid not in oldById:
+            oldById[bid] = i
+
+    matched: List[Optional[int]] = [None] * len(newBlocks)
+    usedOld = set()
+    for j, b in enumerate(newBlocks):
+        i = oldById.get(b.get('id'))
+        if i is not None and i not in usedOld:
+            matched[j] = i
+            usedOld.add(i)
+
+    if len(usedOld) == len(oldBlocks) or len(usedOld) == len(newBlocks):
+        return matched
+
+    # 只有没匹配上的block才需要算hash
+    oldByHash: Dict[str, List[int]] = {}
+    for i in range(len(oldBlocks) - 1, -1, -1):
+        if i not in usedOld:
+            oldByHash.setdefault(Block(oldBlocks[i]).contentHash(), []).append(i)
+    for j, b in enumerate(newBlocks):
+        if matched[j] is not None:
+            continue
+        candidates = oldByHash.get(Block(b).contentHash())
+        if candidates:
+            matched[j] = candidates.pop()
+    return matched
+
+
+def _longestIncreasing(sequence: List[int]) -> set:
+    # patience sorting求最长递增子序列，返回子序列里的值，这些block不需要move
+    tails: List[int] = []
+    tailPositions: List[int] = []
+    previous = [-1] * len(sequence)
+    for pos, value in enumerate(sequence):
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tailPositions.append(pos)
+        else:
+            tails[k] = value
+            tailPositions[k] = pos
+        previous[pos] = tailPositions[k - 1] if k > 0 else -1
+    out = set()
+    pos = tailPositions[-1] if tailPositions else -1
+    while pos != -1:
+        out.add(sequence[pos])
+        pos = previous[pos]
+    return out
+
+
+def _isNodeList(value) -> bool:
+    return type(value) is list and all(type(v) is dict for v in value)
+
+
+def _diffNode(oldNode: Dict, newNode: Dict, depth: int = 0) -> Dict[str, Any]:
+    checkDepth(depth)
+    update: Dict[str, Any] = {}
+    setFields = {}
+    for k, v in newNode.items():
+        if k in oldNode and oldNode[k] == v:
+            continue
+        oldChildren = oldNode.get(k)
+        if k in _CHILD_FIELDS and _isNodeList(v) and _isNodeList(oldChildren) \
+                and len(v) == len(oldChildren):
+            update[k] = [[i, _diffNode(oldChildren[i], c, depth + 1)]
+                         for i, c in enumerate(v) if c != oldChildren[i]]
+        else:
+            setFields[k] = v
+    if setFields:
+        update['set'] = setFields
+    unsetFields = [k for k in oldNode if k not in newNode]
+    if unsetFields:
+        update['unset'] = unsetFields
+    return update
+
+
+def diffBlocks(oldBlocks: List[Dict], newBlocks: List[Dict]) -> Dict[str, Any]:
+    matched = _matchBlocks(oldBlocks, newBlocks)
+    keep = _longestIncreasing([i for i in matched if i is not None])
+
+    ops: List[Dict[str, Any]] = []
+    matchedOld = set(i for i in matched if i is not None)
+    for i in range(len(oldBlocks) - 1, -1, -1):
+        if i not in matchedOld:
+            ops.append({"op": "delete", "index": i})
+    for j, i in enumerate(matched):
+        if i is None:
+            ops.append({"op": "insert", "to": j, "block": newBlocks[j]})
+        elif i not in keep:
+            ops.append({"op": "move", "from": i, "to": j})
+    for j, i in enumerate(matched):
+        if i is None or oldBlocks[i] == newBlocks[j]:
+            continue
+        update = _diffNode(oldBlocks[i], newBlocks[j])
+        update["op"] = "update"
+        update["index"] = j
+        ops.append(update)
+    return {"version": PATCH_VERSION, "length": len(newBlocks), "ops": ops}
+
+
+def _applyUpdate(node: Dict, op: Dict[str, Any], version: int,
+                 depth: int = 0) -> Dict:
+    checkDepth(depth)
+    out = dict(node)
+    for k in op.get('unset', []):
+        out.pop(k, None)
+    out.update(op.get('set', {}))
+    for k in _CHILD_FIELDS:
+        if k not in op:
+            continue
+        children = list(out[k])
+        for i, childOp in op[k]:
+            if version == 1:
+                children[i] = childOp
+            else:
+                children[i] = _applyUpdate(children[i], childOp, version, depth + 1)
+        out[k] = children
+    return out
+
+
+def applyPatch(oldBlocks: List[Dict], patch: Dict[str, Any]) -> List[Dict]:
+    # 不修改 oldBlocks，没有变化的block直接复用原来的dict
+    version = patch.get("version")
+    if version not in _SUPPORTED_VERSIONS:
+        raise ValueError(f"unsupported patch version: {patch.get('version')}")
+    out: List[Optional[Dict]] = [None] * patch["length"]
+    removed = set()
+    placed = set()
+    for op in patch["ops"]:
+        if op["op"] == "delete":
+            removed.add(op["index"])
+        elif op["op"] == "move":
+            removed.add(op["from"])
+            out[op["to"]] = oldBlocks[op["from"]]
+            placed.add(op["to"])
+        elif op["op"] == "insert":
+            out[op["to"]] = op["block"]
+            placed.add(op["to"])
+
+    # 剩下的旧block按顺序填进空位
+    j = 0
+    for i, b in enumerate(oldBlocks):
+        if i in removed:
+            continue
+        while j in placed:
+            j += 1
+        out[j] = b
+        j += 1
+
+    for op in patch["ops"]:
+        if op["op"] == "update":
+            out[op["index"]] = _applyUpdate(out[op["index"]], op, version)
+    return out
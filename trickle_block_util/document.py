@@ -0,0 +1,227 @@
+from typing import Dict, Iterator, List, Optional, Union
+
+from trickle_block_util.generator import Block
+
+
+def _computeListParents(siblings: List[Block]) -> Dict[int, Optional[Block]]:
+    # 每个block往前第一个 indent 更小的兄弟，单调栈一遍算完
+    out: Dict[int, Optional[Block]] = {}
+    stack: List[Block] = []
+    for b in siblings:
+        while stack and stack[-1].indent >= b.indent:
+            stack.pop()
+        out[id(b)] = stack[-1] if stack and b.indent > 0 else None
+        stack.append(b)
+    return out
+
+
+class BlockDocument:
+    """带索引的block列表: id -> block O(1) 查找、父节点/兄弟节点导航、深度和路径。
+
+    支持两种层级:
+      - 嵌套: quote/vote/todos 等把子block放在 blocks 里，parent() / depth() / path()
+      - 平铺: 列表用 indent 表示层级，listParent() 是前面第一个 indent 更小的兄弟，
+        depth(logical=True) / path(logical=True) 会把 indent 层级也算进去
+    insert/delete/move 会同步更新索引，并清掉受影响路径上的 contentHash 缓存。
+    父节点用的是 Block._parent，兄弟中的位置按对象记录，没有id的子block也能导航。
+    平铺列表的父节点按兄弟列表缓存，修改 indent 要用 setIndent，直接改属性不会更新缓存。
+    共享的 EMPTY_BLOCK 加进文档时会换成文档自己的副本（带新id），insert 返回的是这个副本。
+    """
+
+    def __init__(self, blocks: List[Union[Dict, Block]]):
+        self.blocks: List[Block] = [
+            b if isinstance(b, Block) else Block(b) for b in blocks
+        ]
+        self._byId: Dict[str, Block] = {}
+        # id(Block对象) -> 在兄弟中的下标
+        self._position: Dict[int, int] = {}
+        # id(兄弟列表) -> {id(block): listParent}，第一次查询时整段算出，这段兄弟有修改时清掉
+        self._listParents: Dict[int, Dict[int, Optional[Block]]] = {}
+        for i, b in enumerate(self.blocks):
+            self._index(b, None, i)
+
+    # ---------- 索引维护 ----------
+
+    def _index(self, block: Block, parent: Optional[Block], position: int) -> Block:
+        # 返回实际放进文档里的block，共享的 EMPTY_BLOCK 会换成文档自己的副本
+        block = self._own(block, parent, position)
+        stack = [(block, parent, position)]
+        while stack:
+            b, p, pos = stack.pop()
+            b = self._own(b, p, pos)
+            b._parent = p
+            if b.id is not None:
+                self._byId[b.id] = b
+            self._position[id(b)] = pos
+            for i, child in enumerate(b.blocks):
+                stack.append((child, b, i))
+        return block
+
+    def _own(self, block: Block, parent: Optional[Block], position: int) -> Block:
+        # 共享实例不能设置 _parent，出现多次时 id(b) 也会冲突，换成一个副本
+        if not block._shared:
+            return block
+        block = Block(block.toJson())
+        self._siblingsOf(parent)[position] = block
+        return block
+
+    def _unindex(self, block: Block):
+        stack = [block]
+        while stack:
+            b = stack.pop()
+            if b.id is not None and self._byId.get(b.id) is b:
+                del self._byId[b.id]
+            self._position.pop(id(b), None)
+            self._listParents.pop(id(b.blocks), None)
+            stack.extend(b.blocks)
+
+    def _reposition(self, siblings: List[Block], start: int):
+        for i in range(start, len(siblings)):
+            self._position[id(siblings[i])] = i
+
+    def _siblingsOf(self, parent: Optional[Block]) -> List[Block]:
+        return self.blocks if parent is None else parent.blocks
+
+    def _require(self, blockId: str) -> Block:
+        b = self._byId.get(blockId)
+        if b is None:
+            raise KeyError(blockId)
+        return b
+
+    # ---------- 查询 ----------
+
+    def __len__(self):
+        # 所有索引过的block，包括没有id的
+        return len(self._position)
+
+    def __iter__(self) -> Iterator[Block]:
+        # 先序遍历所有block，包括嵌套的子block
+        stack = list(reversed(self.blocks))
+        while stack:
+            b = stack.pop()
+            yield b
+            stack.extend(reversed(b.blocks))
+
+    def __contains__(self, blockId: str):
+        return blockId in self._byId
+
+    def get(self, blockId: str) -> Optional[Block]:
+        return self._byId.get(blockId)
+
+    def parent(self, blockId: str) -> Optional[Block]:
+        return self._require(blockId)._parent
+
+    def children(self, blockId: str) -> List[Block]:
+        return list(self._require(blockId).blocks)
+
+    def index(self, blockId: str) -> int:
+        return self._position[id(self._require(blockId))]
+
+    def siblings(self, blockId: str) -> List[Block]:
+        return list(self._siblingsOf(self.parent(blockId)))
+
+    def nextSibling(self, blockId: str) -> Optional[Block]:
+        b = self._require(blockId)
+        siblings = self._siblingsOf(b._parent)
+        i = self._position[id(b)] + 1
+        return siblings[i] if i < len(siblings) else None
+
+    def previousSibling(self, blockId: str) -> Optional[Block]:
+        b = self._require(blockId)
+        siblings = self._siblingsOf(b._parent)
+        i = self._position[id(b)] - 1
+        return siblings[i] if i >= 0 else None
+
+    def _listParentOf(self, b: Block) -> Optional[Block]:
+        # 平铺的列表: 往前第一个 indent 更小的兄弟
+        if b.indent <= 0:
+            return None
+        siblings = self._siblingsOf(b._parent)
+        parents = self._listParents.get(id(siblings))
+        if parents is None:
+            parents = _computeListParents(siblings)
+            self._listParents[id(siblings)] = parents
+        return parents[id(b)]
+
+    def _logicalParentOf(self, b: Block) -> Optional[Block]:
+        listParent = self._listParentOf(b)
+        if listParent is not None:
+            return listParent
+        return b._parent
+
+    def listParent(self, blockId: str) -> Optional[Block]:
+        return self._listParentOf(self._require(blockId))
+
+    def logicalParent(self, blockId: str) -> Optional[Block]:
+        return self._logicalParentOf(self._require(blockId))
+
+    def pathBlocks(self, blockId: str, logical: bool = False) -> List[Block]:
+        # 从顶层到这个block
+        out = []
+        b = self._require(blockId)
+        while b is not None:
+            out.append(b)
+            b = self._logicalParentOf(b) if logical else b._parent
+        out.reverse()
+        return out
+
+    def path(self, blockId: str, logical: bool = False) -> List[str]:
+        # 路径上没有id的block是None
+        return [b.id for b in self.pathBlocks(blockId, logical=logical)]
+
+    def depth(self, blockId: str, logical: bool = False) -> int:
+        return len(self.pathBlocks(blockId, logical=logical)) - 1
+
+    # ---------- 修改 ----------
+
+    def insert(self, block: Union[Dict, Block], parentId: Optional[str] = None,
+               index: Optional[int] = None) -> Block:
+        if not isinstance(block, Block):
+            block = Block(block)
+        parent = self._require(parentId) if parentId is not None else None
+        siblings = self._siblingsOf(parent)
+        # 负数下标和 list.insert 一样从末尾算，换成实际位置再记录
+        if index is None or index > len(siblings):
+            index = len(siblings)
+        elif index < 0:
+            index = max(0, len(siblings) + index)
+        siblings.insert(index, block)
+        self._listParents.pop(id(siblings), None)
+        block = self._index(block, parent, index)
+        self._reposition(siblings, index + 1)
+        if parent is not None:
+            parent.invalidateContentHash()
+        return block
+
+    def delete(self, blockId: str) -> Block:
+        block = self._require(blockId)
+        parent = block._parent
+        siblings = self._siblingsOf(parent)
+        index = self._position[id(block)]
+        siblings.pop(index)
+        self._listParents.pop(id(siblings), None)
+        self._unindex(block)
+        self._reposition(siblings, index)
+        block._parent = None
+        if parent is not None:
+            parent.invalidateContentHash()
+        return block
+
+    def move(self, blockId: str, parentId: Optional[str] = None,
+             index: Optional[int] = None) -> Block:
+        block = self._require(blockId)
+        if parentId is not None and any(
+                b is block for b in self.pathBlocks(parentId)):
+            raise ValueError(f"can not move block {blockId} into its own subtree")
+        block = self.delete(blockId)
+        return self.insert(block, parentId=parentId, index=index)
+
+    def setIndent(self, blockId: str, indent: int) -> Block:
+        block = self._require(blockId)
+        block.indent = indent
+        self._listParents.pop(id(self._siblingsOf(block._parent)), None)
+        block.invalidateContentHash()
+        return block
+
+    def toJson(self) -> List[Dict]:
+        return [b.toJson() for b in self.blocks]
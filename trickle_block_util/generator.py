@@ -1,27 +1,61 @@
 from typing import List, Optional, Union, Dict, Any
 import json
-import time
+import logging
+import re
+import sys
 import datetime
-import pytz
+import hashlib
 import uuid
 import urllib.parse
-import tiktoken
 
-import mistune
-from mistune.renderers.markdown import MarkdownRenderer
-from mistune.core import BaseRenderer, BlockState
-import pprint
+from trickle_block_util.cache import ConversionCache
+from trickle_block_util.limits import ConversionLimits, LimitExceeded, \
+    LimitTracker, TRUNCATED_MARKER, asLimitExceeded, reportLimit
+from trickle_block_util.metrics import Stage, stageTimer
+from trickle_block_util.traversal import TraversalDepthError, checkDepth, foldTree
+from trickle_block_util import tokenizer as _tokenizer
 
 
 # mistune==3.0.0rc5
+# mistune、tiktoken、pytz 都在第一次用到时才导入，只用 blocksToMarkdown 的调用方不用加载它们。
+# 常驻的服务可以在启动时调用 warmUp() 提前加载。
+
+logger = logging.getLogger(__name__)
+
+# 移到 renderer.py 的名字，仍然可以从这里导入
+_rendererNames = {"TrickleBlockRenderer", "textElementTypes", "RAW_TEXT_CACHE"}
+
+
+def __getattr__(name):
+    if name in _rendererNames:
+        from trickle_block_util import renderer
+        return getattr(renderer, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def warmUp(tokenizer: bool = True):
+    """提前加载 mistune/renderer（以及 tiktoken 编码），避免第一个请求承担加载时间。"""
+    from trickle_block_util.renderer import getParser
+    getParser(hardWrap=True)
+    if tokenizer:
+        _tokenizer.getEncoding()
+
 
 def markdownToJson(text) -> List[Dict]:
+    import mistune
     markdown = mistune.create_markdown(renderer='ast')
     markdownJson = markdown(text)
     return markdownJson
 
 
-def timestampToIso(timestamp, timezone=pytz.timezone('America/Los_Angeles')):
+DEFAULT_TIMEZONE = 'America/Los_Angeles'
+
+
+def timestampToIso(timestamp, timezone=None):
+    # timezone: tzinfo，默认 DEFAULT_TIMEZONE
+    if timezone is None:
+        import pytz
+        timezone = pytz.timezone(DEFAULT_TIMEZONE)
     dt = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
     local_dt = dt.astimezone(timezone)
     return local_dt.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
@@ -38,10 +72,96 @@ def timestampToIso(timestamp, timezone=pytz.timezone('America/Los_Angeles')):
 #     "total_tokens": 105
 #   }
 
-def generateUUID():
+def _uuid1():
     return str(uuid.uuid1())
 
 
+_idGenerator = _uuid1
+
+
+def setIdGenerator(idGenerator=None):
+    # 替换生成 block/element id 的函数，传None恢复默认的uuid1
+    global _idGenerator
+    _idGenerator = idGenerator if idGenerator is not None else _uuid1
+
+
+def generateUUID():
+    return _idGenerator()
+
+
+# 内容hash，不包含 id、isCurrent、编辑时间这些和内容无关（或者每次都会变）的字段
+def _digest(parts) -> str:
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False,
+                           separators=(',', ':'), default=str)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _buildTree(root, data):
+    # 用显式栈创建子 Block/Element，嵌套很深的数据也不会递归超限
+    stack = [(root, data, 0)]
+    while stack:
+        node, nodeData, depth = stack.pop()
+        checkDepth(depth)
+        node._setFields(nodeData)
+        if isinstance(node, Block):
+            node.blocks = [Block.__new__(Block) for _ in nodeData.get('blocks', [])]
+            for b, bData in zip(node.blocks, nodeData.get('blocks', [])):
+                b._parent = node
+                stack.append((b, bData, depth + 1))
+        node.elements = [Element.__new__(Element)
+                         for _ in nodeData.get('elements', [])]
+        for e, eData in zip(node.elements, nodeData.get('elements', [])):
+            e._parent = node
+            stack.append((e, eData, depth + 1))
+
+
+def _intern(value):
+    # type/display/constraint 只有很少几种取值，从json读进来时每个节点都是一份新的字符串
+    return sys.intern(value) if type(value) is str else value
+
+
+def _adopt(parent, children: List) -> List:
+    # copyDefault 直接把子节点挂到新节点下，不再 toJson 之后重新解析一遍；
+    # 共享的空节点不属于任何一个父节点，不设置 _parent
+    children = list(children)
+    for child in children:
+        if not child._shared:
+            child._parent = parent
+    return children
+
+
+def _hashChildren(node):
+    # 已经有缓存的子树不再进入
+    if node._contentHash is not None:
+        return None
+    blocks = getattr(node, 'blocks', None)
+    return list(node.elements) + list(blocks) if blocks else node.elements
+
+
+def _combineHash(node, childHashes: List[str]) -> str:
+    # contentHash 用 foldTree 自底向上计算，嵌套很深也不会递归超限
+    if node._contentHash is None:
+        node._contentHash = node._hashFromChildren(childHashes)
+    return node._contentHash
+
+
+def _jsonChildren(node):
+    blocks = getattr(node, 'blocks', None)
+    return list(node.elements) + list(blocks) if blocks else node.elements
+
+
+def _combineJson(node, childJson: List[Dict]) -> Dict:
+    # toJson 也用 foldTree 自底向上拼，嵌套很深也不会递归超限
+    return node._jsonFromChildren(childJson)
+
+
+def _withoutIds(value):
+    # image等element的value里也带了随机生成的id
+    if type(value) == dict and 'id' in value:
+        return {k: v for k, v in value.items() if k != 'id'}
+    return value
+
+
 class BlockType:
     h1 = "h1"
     h2 = "h2"
@@ -82,6 +202,56 @@ class ElementType:
     colored = "colored"
 
 
+class RenderProfile:
+    # default: 和前端显示尽量一致的markdown
+    default = "default"
+    # compact: 给AI用的省token版本，去掉空行、缩进、embed和bookmark的样板内容
+    compact = "compact"
+
+
+def quoteUrl(url: str) -> str:
+    return urllib.parse.quote(url, safe=':/')
+
+
+class UrlReferences:
+    """把url替换成 L1、L2 这样的短引用，减少发给AI的token，AI返回后再还原成真实url。"""
+    prefix = "L"
+
+    def __init__(self, mapping: Optional[Dict[str, str]] = None,
+                 minLength: int = 0):
+        self.minLength = minLength
+        self.urls: Dict[str, str] = {}
+        self.refs: Dict[str, str] = {}
+        if mapping:
+            for ref, url in mapping.items():
+                self.urls[ref] = url
+                self.refs[url] = ref
+
+    @classmethod
+    def fromValue(cls, value):
+        # 既可以直接传UrlReferences，也可以传之前保存下来的 {"L1": url} 映射
+        if value is None or isinstance(value, UrlReferences):
+            return value
+        return cls(mapping=value)
+
+    def add(self, url: str) -> str:
+        # 太短不值得替换的url和不替换时一样做quote
+        if len(url) < self.minLength:
+            return quoteUrl(url)
+        ref = self.refs.get(url)
+        if ref is None:
+            ref = self.prefix + str(len(self.urls) + 1)
+            self.urls[ref] = url
+            self.refs[url] = ref
+        return ref
+
+    def resolve(self, ref: str) -> str:
+        return self.urls.get(ref.strip("[]"), ref)
+
+    def toDict(self) -> Dict[str, str]:
+        return dict(self.urls)
+
+
 class Element:
     id: str
     text: str
@@ -89,35 +259,68 @@ class Element:
     elements: List
     isCurrent: bool
     value = None
+    # contentHash的缓存，和所属的 Element/Block，修改内容后由 invalidateContentHash 沿父节点清掉
+    _contentHash: Optional[str] = None
+    _parent = None
+    # EMPTY_TEXT 这样多处共享的不可变实例
+    _shared = False
 
     def __init__(self, data):
+        _buildTree(self, data)
+
+    def _setFields(self, data):
+        # elements 由 _buildTree 创建
         self.id = data.get('id')
         self.text = data.get('text', "")
-        self.type = data.get('type')
-        self.elements = [Element.fromJson(e) for e in data.get('elements', [])]
+        self.type = _intern(data.get('type'))
         self.isCurrent = data.get('isCurrent', False)
         self.value = data.get('value', None)
 
-    def getValue(self) -> str:
+    def contentHash(self) -> str:
+        if self._contentHash is None:
+            foldTree(self, _hashChildren, _combineHash)
+        return self._contentHash
+
+    def _hashFromChildren(self, childHashes: List[str]) -> str:
+        return _digest([
+            self.type,
+            self.text,
+            _withoutIds(self.value),
+            childHashes,
+        ])
+
+    def invalidateContentHash(self):
+        node = self
+        while node is not None:
+            node._contentHash = None
+            node = node._parent
+
+    def getValue(self, urlRefs: Optional[UrlReferences] = None) -> str:
+        if urlRefs is not None:
+            rawUrl = self.value.get("url", "") if type(
+                self.value) == dict else self.value
+            if type(rawUrl) == str and rawUrl != "":
+                return urlRefs.add(rawUrl)
         if type(self.value) == str:
-            return urllib.parse.quote(self.value, safe=':/')
+            return quoteUrl(self.value)
         elif type(self.value) == dict and self.type == ElementType.image:
-            return urllib.parse.quote(self.value.get("url", ""), safe=':/')
+            return quoteUrl(self.value.get("url", ""))
         return ""
 
     @classmethod
     def copyDefault(cls, type=ElementType.text, text=None, elements=None,
                     isCurrent=False, value=None):
-        if not elements:
-            elements = []
-        return cls({
+        out = cls({
             "id": generateUUID(),
             "type": type,
             "text": text,
-            "elements": [e.toJson() for e in elements],
+            "elements": [],
             "isCurrent": isCurrent,
             "value": value
         })
+        if elements:
+            out.elements = _adopt(out, elements)
+        return out
 
     @classmethod
     def normalText(cls, text):
@@ -191,14 +394,16 @@ class Element:
         return cls(data)
 
     def toJson(self):
-        _elements = []
-        if len(self.elements) > 0:
-            _elements = [e.toJson() for e in self.elements]
+        if not self.elements:
+            return self._jsonFromChildren([])
+        return foldTree(self, _jsonChildren, _combineJson)
+
+    def _jsonFromChildren(self, childJson: List[Dict]) -> Dict:
         return {
             "id": self.id,
             "type": self.type,
             "text": self.text,
-            "elements": _elements,
+            "elements": childJson,
             "isCurrent": self.isCurrent,
             "value": self.value
         }
@@ -211,50 +416,67 @@ class Element:
             ElementType.inline_code,
             ElementType.link
         ]:
-            out = [
-                      Element.normalText(text="").toJson(),
-                  ] + out + [
-                      Element.normalText(text="").toJson(),
-                  ]
+            out = [EMPTY_TEXT.toJson()] + out + [EMPTY_TEXT.toJson()]
         return out
 
-    def toMarkdown(self):
-        if self.type == ElementType.text:
+    def toMarkdown(self, urlRefs: Optional[UrlReferences] = None):
+        if self.type not in markdownContainerTypes:
+            return self._toMarkdownFromParts([], urlRefs)
+        return foldTree(
+            self,
+            _markdownChildren,
+            lambda e, parts: e._toMarkdownFromParts(parts, urlRefs)
+        )
+
+    def _toMarkdownFromParts(self, parts: List[str],
+                             urlRefs: Optional[UrlReferences] = None):
+        # parts 是子element已经转好的markdown
+        if self.type in markdownWrappers:
+            prefix, suffix = markdownWrappers[self.type]
+            return prefix + "".join(parts) + suffix
+        elif self.type == ElementType.link:
+            return "[" + "".join(parts) + "](" + self.getValue(urlRefs) + ")"
+        elif self.type == ElementType.text:
             return self.text
         elif self.type == ElementType.url:
             return self.text
-        elif self.type == ElementType.inline_code:
-            return "`" + "".join([e.toMarkdown() for e in self.elements]) + "`"
-        elif self.type == ElementType.bold:
-            return "**" + "".join(
-                [e.toMarkdown() for e in self.elements]) + "**"
-        elif self.type == ElementType.italic:
-            return "*" + "".join([e.toMarkdown() for e in self.elements]) + "*"
-        elif self.type == ElementType.link:
-            return "[" + "".join([e.toMarkdown() for e in
-                                  self.elements]) + "](" + self.getValue() + ")"
         elif self.type == ElementType.escape:
             return self.text
         elif self.type == ElementType.user:
             return "@" + self.text
         elif self.type == ElementType.image:
-            return "![](" + self.getValue() + ")"
+            return "![](" + self.getValue(urlRefs) + ")"
         elif self.type == ElementType.linkToPost:
             return "[A link to other post]"
         elif self.type == ElementType.math:
             return "$" + self.text + "$"
-        elif self.type == ElementType.underLine:
-            return "".join([e.toMarkdown() for e in self.elements])
-        elif self.type == ElementType.lineThrough:
-            return "~" + "".join([e.toMarkdown() for e in self.elements]) + "~"
-        elif self.type == ElementType.backgroundColored:
-            return "".join([e.toMarkdown() for e in self.elements])
-        elif self.type == ElementType.colored:
-            return "".join([e.toMarkdown() for e in self.elements])
         else:
             return self.text
 
 
+# 这些element的markdown是 前缀 + 子element + 后缀
+markdownWrappers = {
+    ElementType.inline_code: ("`", "`"),
+    ElementType.bold: ("**", "**"),
+    ElementType.italic: ("*", "*"),
+    ElementType.underLine: ("", ""),
+    ElementType.lineThrough: ("~", "~"),
+    ElementType.backgroundColored: ("", ""),
+    ElementType.colored: ("", ""),
+}
+markdownContainerTypes = set(markdownWrappers) | {ElementType.link}
+
+
+def _markdownChildren(e: Element):
+    if e.type in markdownContainerTypes:
+        return e.elements
+    return None
+
+
+# iframe的src属性: (src=", url, ")
+_embedSrc = re.compile(r'(src=["\'])([^"\']+)(["\'])')
+
+
 class Block:
     id: str
     type: str
@@ -273,19 +495,25 @@ class Block:
     computedValue = None
     userDefinedValue = None
     isDeleted: Optional[bool] = None
+    _contentHash: Optional[str] = None
+    _parent = None
+    # EMPTY_BLOCK 这样多处共享的不可变实例
+    _shared = False
 
     def __init__(self, data):
+        _buildTree(self, data)
+
+    def _setFields(self, data):
+        # blocks 和 elements 由 _buildTree 创建
         self.id = data.get('id')
-        self.type = data.get('type')
-        self.blocks = [Block.fromJson(b) for b in data.get('blocks', [])]
+        self.type = _intern(data.get('type'))
         self.indent = data.get('indent', 0)
         self.seqNum = data.get('seqNum', 0)
-        self.display = data.get('display', "block")
+        self.display = _intern(data.get('display', "block"))
         self.isFirst = data.get('isFirst', False)
         self.version = data.get('version', 0)
-        self.elements = [Element.fromJson(e) for e in data.get('elements', [])]
         self.isCurrent = data.get('isCurrent', False)
-        self.constraint = data.get('constraint', "free")
+        self.constraint = _intern(data.get('constraint', "free"))
         self.lastEditedBy = data.get('lastEditedBy', None)
         self.lastEditedTime = data.get('lastEditedTime', None)
         self.updatedByRemote = data.get('updatedByRemote', False)
@@ -293,18 +521,49 @@ class Block:
         self.userDefinedValue = data.get('userDefinedValue', None)
         self.isDeleted = data.get('isDeleted', None)
 
-
     @classmethod
     def fromJson(cls, data: dict):
         return cls(data)
 
+    # Merkle风格的内容hash: 由自身字段和子 element/block 的hash组成，
+    # 结果会缓存，修改某个节点后调用它的 invalidateContentHash，只有这条路径会重新计算
+    def contentHash(self) -> str:
+        if self._contentHash is None:
+            foldTree(self, _hashChildren, _combineHash)
+        return self._contentHash
+
+    def _hashFromChildren(self, childHashes: List[str]) -> str:
+        # childHashes: 先是 elements，再是 blocks，见 _hashChildren
+        elementCount = len(self.elements)
+        return _digest([
+            self.type,
+            self.indent,
+            self.display,
+            self.constraint,
+            self.computedValue,
+            self.userDefinedValue,
+            self.isDeleted,
+            childHashes[:elementCount],
+            childHashes[elementCount:],
+        ])
+
+    def invalidateContentHash(self):
+        node = self
+        while node is not None:
+            node._contentHash = None
+            node = node._parent
+
     def toJson(self):
-        _blocks = []
-        if len(self.blocks) > 0:
-            _blocks = [b.toJson() for b in self.blocks]
-        _elements = []
-        if len(self.elements) > 0:
-            _elements = [e.toJson() for e in self.elements]
+        # 大部分block没有子block，element也没有嵌套，不需要走 foldTree
+        if not self.blocks and not any([e.elements for e in self.elements]):
+            return self._jsonFromChildren([e.toJson() for e in self.elements])
+        return foldTree(self, _jsonChildren, _combineJson)
+
+    def _jsonFromChildren(self, childJson: List[Dict]) -> Dict:
+        # childJson: 先是 elements，再是 blocks，见 _jsonChildren
+        elementCount = len(self.elements)
+        _elements = childJson[:elementCount]
+        _blocks = childJson[elementCount:]
         return {
             "id": self.id,
             "type": self.type,
@@ -327,19 +586,16 @@ class Block:
                     isCurrent=False, constraint="free",
                     blocks=None, elements=None, computedValue=None,
                     userDefinedValue=None):
-        if not blocks:
-            blocks = []
-        _elements = elements if elements is not None else [
-            Element.normalText(text="")
-        ]
-        return cls({
+        # 传入的 blocks/elements 直接成为新block的子节点，不会复制
+        _elements = elements if elements is not None else [Element.normalText("")]
+        out = cls({
             "id": generateUUID(),
             "type": type,
             "isFirst": False,
             "indent": indent,
-            "blocks": [b.toJson() for b in blocks],
+            "blocks": [],
             "display": display,
-            "elements": [e.toJson() for e in _elements],
+            "elements": [],
             "isCurrent": False,
             "constraint": "free",
             "lastEditedBy": None,
@@ -348,6 +604,10 @@ class Block:
             "computedValue": computedValue,
             "userDefinedValue": userDefinedValue
         })
+        if blocks:
+            out.blocks = _adopt(out, blocks)
+        out.elements = _adopt(out, _elements)
+        return out
 
     @classmethod
     def raw(cls, text):
@@ -430,23 +690,27 @@ class Block:
             return self.userDefinedValue.get("language", "plain")
         return "plain"
 
-    def getWebBookmarkUrl(self) -> str:
-        if self.userDefinedValue != None and type(
-                self.userDefinedValue) is dict:
-            return urllib.parse.quote(
-                self.userDefinedValue.get("url", "https://#"), safe=':/')
-        if self.userDefinedValue != None and type(self.userDefinedValue) is str \
-            and self.userDefinedValue.startswith("https://"):
-            return urllib.parse.quote(
-                self.userDefinedValue, safe=':/')
-
-        return "https://#"
-
-    def getFileUrl(self) -> str:
+    def getWebBookmarkUrl(self, urlRefs: Optional[UrlReferences] = None) -> str:
+        # 有没有urlRefs都按同样的规则取url: dict里的url，或者以 https:// 开头的字符串
+        rawUrl = None
+        if type(self.userDefinedValue) is dict:
+            rawUrl = self.userDefinedValue.get("url")
+        elif type(self.userDefinedValue) is str and \
+                self.userDefinedValue.startswith("https://"):
+            rawUrl = self.userDefinedValue
+        if rawUrl is None:
+            return "https://#"
+        if urlRefs is not None:
+            return urlRefs.add(rawUrl)
+        return quoteUrl(rawUrl)
+
+    def getFileUrl(self, urlRefs: Optional[UrlReferences] = None) -> str:
+        if urlRefs is not None and type(self.userDefinedValue) is dict and \
+                self.userDefinedValue.get("url"):
+            return urlRefs.add(self.userDefinedValue["url"])
         if self.userDefinedValue != None and type(
                 self.userDefinedValue) is dict:
-            return urllib.parse.quote(
-                self.userDefinedValue.get("url", "https://#"), safe=':/')
+            return quoteUrl(self.userDefinedValue.get("url", "https://#"))
         return "https://#"
 
     def getEmbedValue(self) -> tuple:
@@ -457,25 +721,52 @@ class Block:
                     self.userDefinedValue.get("src", defaultEmbed))
         return (300, defaultEmbed)
 
+    def getEmbedHtml(self, urlRefs: Optional[UrlReferences] = None) -> str:
+        # 有urlRefs时iframe的src也换成短引用
+        html = self.getEmbedValue()[1]
+        if urlRefs is None:
+            return html
+        return _embedSrc.sub(
+            lambda m: m.group(1) + urlRefs.add(m.group(2)) + m.group(3), html, count=1)
+
+    def getEmbedSrcUrl(self, urlRefs: Optional[UrlReferences] = None) -> str:
+        embedValues = self.getEmbedValue()
+        matched = _embedSrc.search(embedValues[1])
+        if matched and urlRefs is not None:
+            return urlRefs.add(matched.group(2))
+        if matched:
+            return quoteUrl(matched.group(2))
+        return ""
+
     def getPollCounts(self, bid):
         if self.userDefinedValue != None and type(
                 self.userDefinedValue) is dict:
             return len(self.userDefinedValue.get("vote-" + bid, []))
         return 0
 
-    def voteToMarkdown(self):
+    def _childMarkdownParts(self, profile, urlRefs) -> List[str]:
+        # 没有经过 toMarkdown 的 foldTree 直接调用 voteToMarkdown/toDosToMarkdown 时用
+        return [_blockMarkdown(n, [], profile, urlRefs)
+                if isinstance(n, Element) else n.toMarkdown(profile, urlRefs)
+                for n in _blockMarkdownChildren(self)]
+
+    def voteToMarkdown(self, profile=RenderProfile.default, urlRefs=None,
+                       parts: Optional[List[str]] = None):
+        # parts: 标题element、描述、各个选项已经转好的markdown，见 _blockMarkdownChildren
         if len(self.blocks) != 3:
             return ""
+        if parts is None:
+            parts = self._childMarkdownParts(profile, urlRefs)
         h1 = self.blocks[0]
-        desc = self.blocks[1]
         options = self.blocks[2]
+        titleCount = len(h1.elements)
         out = "\n"
-        out = "## Poll Title: " + "".join([e.toMarkdown() for e in h1.elements])
-        out = out + "\n" + "Poll Description: " + desc.toMarkdown()
+        out = "## Poll Title: " + "".join(parts[:titleCount])
+        out = out + "\n" + "Poll Description: " + parts[titleCount]
         out = out + "\n" + "| option | poll counts |"
         out = out + "\n" + "| ------------ | ------------ |"
-        for op in options.blocks:
-            out = out + "\n" + "| " + op.toMarkdown() + " | " + str(
+        for op, opMarkdown in zip(options.blocks, parts[titleCount + 1:]):
+            out = out + "\n" + "| " + opMarkdown + " | " + str(
                 self.getPollCounts(op.id)) + " |"
         out = out + "\n"
         return out
@@ -484,504 +775,230 @@ class Block:
         # table内容藏在了 blocks的userDefinedValue的content中。
         tableContent = self.userDefinedValue.get('content')
         withHeadings = self.userDefinedValue.get('withHeadings')
-        out = "\n"
         # 添加表头， tableContent[0]就是表头:
-        headings = tableContent.pop(0)
-        for perhead in headings:
-            out = out + " | " + f'{perhead}'
-        out = out + " |" + "\n"
-        for _ in headings:
-            out = out + " | " + "------------ "
-        out = out + " |" + "\n"
-
-        for perRow in tableContent:
-            for perColum in perRow:
-                out = out + " | " + f'{perColum}'
-            out = out + " |" + "\n"
+        # 不能pop，blocks可能会被多次转换
+        headings = tableContent[0]
+        # 每行拼好再一次join，大表格不会反复复制前面的字符串
+        lines = [
+            "".join([f" | {perhead}" for perhead in headings]) + " |",
+            "".join([" | ------------ " for _ in headings]) + " |",
+        ]
+        for perRow in tableContent[1:]:
+            lines.append("".join([f" | {perColum}" for perColum in perRow]) + " |")
 
-        return out
+        return "\n" + "\n".join(lines) + "\n"
 
-    def toDosToMarkdown(self):
+    def toDosToMarkdown(self, profile=RenderProfile.default, urlRefs=None,
+                        parts: Optional[List[str]] = None):
+        # parts 同 voteToMarkdown
         if len(self.blocks) != 3:
             return ""
-        h1 = self.blocks[0]
-        desc = self.blocks[1]
-        options = self.blocks[2]
+        if parts is None:
+            parts = self._childMarkdownParts(profile, urlRefs)
+        titleCount = len(self.blocks[0].elements)
         out = "\n"
-        out = "## Tasks Title: " + "".join(
-            [e.toMarkdown() for e in h1.elements])
-        out = out + "\n" + "Tasks Description: " + desc.toMarkdown()
-        for op in options.blocks:
-            out = out + "\n" + op.toMarkdown()
+        out = "## Tasks Title: " + "".join(parts[:titleCount])
+        out = out + "\n" + "Tasks Description: " + parts[titleCount]
+        for opMarkdown in parts[titleCount + 1:]:
+            out = out + "\n" + opMarkdown
         out = out + "\n"
         return out
 
-    def toMarkdown(self):
+    def toMarkdown(self, profile=RenderProfile.default,
+                   urlRefs: Optional[UrlReferences] = None):
+        if self.type not in markdownBlockContainerTypes:
+            return self._toMarkdownFromParts([], profile, urlRefs)
+        return foldTree(
+            self,
+            _blockMarkdownChildren,
+            lambda n, parts: _blockMarkdown(n, parts, profile, urlRefs)
+        )
+
+    def _toMarkdownFromParts(self, parts: List[str], profile=RenderProfile.default,
+                             urlRefs: Optional[UrlReferences] = None):
+        # parts 是子节点已经转好的markdown，只有 markdownBlockContainerTypes 用到
+        compact = profile == RenderProfile.compact
         out = ""
         if self.type == BlockType.h1:
-            out = "# " + "".join([e.toMarkdown() for e in self.elements])
+            out = "# " + "".join([e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.h2:
-            out = "## " + "".join([e.toMarkdown() for e in self.elements])
+            out = "## " + "".join([e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.h3:
-            out = "### " + "".join([e.toMarkdown() for e in self.elements])
+            out = "### " + "".join([e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.text:
-            out = "".join([e.toMarkdown() for e in self.elements])
+            out = "".join([e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.list:
-            out = "- " + "".join([e.toMarkdown() for e in self.elements])
+            out = "- " + "".join([e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.number_list:
             out = self.getNumberPrefix() + " " + "".join(
-                [e.toMarkdown() for e in self.elements])
+                [e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.checkbox:
             out = "- [" + (
                 " " if self.getCheckboxValue() == "unchecked" else "x") + "] " + "".join(
-                [e.toMarkdown() for e in self.elements])
+                [e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.code:
             out = "```" + self.getCodeLang() + "\n" + "".join(
-                [e.toMarkdown() for e in self.elements]) + "\n```"
+                [e.toMarkdown(urlRefs) for e in self.elements]) + "\n```"
         elif self.type == BlockType.quote:
-            out = "\n".join(["> " + b.toMarkdown() for b in self.blocks])
+            out = "\n".join(["> " + part for part in parts])
+        elif self.type == BlockType.webBookmark and compact and urlRefs is None:
+            out = "<" + self.getWebBookmarkUrl(urlRefs) + ">"
         elif self.type == BlockType.webBookmark:
-            out = "[WebBookmark](" + self.getWebBookmarkUrl() + ")"
+            out = "[WebBookmark](" + self.getWebBookmarkUrl(urlRefs) + ")"
+        elif self.type == BlockType.embed and compact:
+            srcUrl = self.getEmbedSrcUrl(urlRefs)
+            out = "[Embed](" + srcUrl + ")" if srcUrl else "[Embed]"
         elif self.type == BlockType.embed:
             embedValues = self.getEmbedValue()
             out = "```html\n<html><body style='height: " + str(
-                embedValues[0]) + "px'>" + embedValues[
-                1] + "</body></html>" + "\n```"
+                embedValues[0]) + "px'>" + self.getEmbedHtml(urlRefs) + \
+                "</body></html>" + "\n```"
         elif self.type == BlockType.gallery:
-            out = "".join([e.toMarkdown() for e in self.elements])
+            out = "".join([e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.reference:
-            out = "".join([e.toMarkdown() for e in self.elements])
+            out = "".join([e.toMarkdown(urlRefs) for e in self.elements])
         elif self.type == BlockType.hr:
             out = "---"
         elif self.type == BlockType.vote:
-            out = self.voteToMarkdown()
+            out = self.voteToMarkdown(profile, urlRefs, parts)
         elif self.type == BlockType.todos:
-            out = self.toDosToMarkdown()
+            out = self.toDosToMarkdown(profile, urlRefs, parts)
         elif self.type == BlockType.file:
-            out = "[Attachment](" + self.getFileUrl() + ")"
+            out = "[Attachment](" + self.getFileUrl(urlRefs) + ")"
 
         elif self.type == BlockType.table:
             out = self.tableToMarkdown()
-        
+
+        if compact:
+            # 代码块里的空白是有意义的，只去掉首尾的空行；
+            # quote/vote/todos 里的子block已经各自按compact处理过，不能再逐行strip（会破坏代码的缩进）
+            if self.type in compactContainerTypes:
+                out = out.strip("\n")
+            else:
+                out = "\n".join([line.strip() for line in out.strip().split("\n")])
+            # 缩进只保留层级，每层一个空格
+            return " " * self.indent + out
+
         # append indent
         out = "".join(["  " for _ in range(self.indent)]) + out
         return out
 
 
-class TrickleBlockRenderer(MarkdownRenderer):
-    """A renderer to convert markdown to Trickle Block."""
-    NAME = 'TrickleBlock'
+# 这些block的markdown里包含子block的markdown，用 foldTree 先转子节点再拼起来
+markdownBlockContainerTypes = {BlockType.quote, BlockType.vote, BlockType.todos}
 
-    def __call__(self, tokens, state: BlockState) -> List[Block]:
-        out = []
-        blocks = self.render_blocks(tokens, state)
-        for b in blocks:
-            out = out + b.render()
-        return out
 
-    elementType = ['emphasis', 'strong', 'link', 'image', 'codespan',
-                   'inline_html', 'linebreak']
-
-    def getRawText(self, token: Dict[str, Any], depth: int = 1) -> str:
-
-        out = ''
-        if len(token.get("children", [])) > 0:
-            for perSubToken in token.get("children", []):
-                # print(f"{depth}: {perSubToken}")
-                rText = self.getRawText(perSubToken, depth=depth+1)
-                # print(f"{depth}: {rText=}, {out=}") 
-                out = out + rText
-            return out
-        if token.get("raw") is not None:
-            return token["raw"]
-        if token.get("type") == 'softbreak' and token.get("raw") is None:
-            return '\n'
-        if token.get("type") in self.elementType and token.get("raw") is None and token.get("type") != 'link':
-            return ''
-        # if token["type"] == "block_text":
-        #     out = out + "\n"
-        return out
+def _blockMarkdownChildren(node):
+    # quote 是子block；vote/todos 是标题的element、描述block和各个选项block
+    if isinstance(node, Element):
+        return None
+    if node.type == BlockType.quote:
+        return node.blocks
+    if node.type in (BlockType.vote, BlockType.todos) and len(node.blocks) == 3:
+        h1, desc, options = node.blocks
+        return list(h1.elements) + [desc] + list(options.blocks)
+    return None
 
-    def render_children(self, token, state: BlockState):
-        children = token['children']
-        return self.render_tokens(children, state)
 
-    def _get_element_method(self, name):
-        if name == "text":
-            return self.text
-        elif name == "emphasis":
-            return self.emphasis
-        elif name == "strong":
-            return self.strong
-        elif name == "link":
-            return self.link
-        elif name == "image":
-            return self.image
-        elif name == "codespan":
-            return self.codespan
-        elif name == "inline_html":
-            return self.inline_html
-        elif name == "softbreak":
-            return self.softbreak
-        elif name == "linebreak":
-            return self.linebreak
-        elif name == "block_text":
-            return self.block_text
-        else:
-            return self.defalut_element_render
-
-    def defalut_element_render(self, token: Dict[str, Any],
-                               state: BlockState) -> List[Element]:
-        text = self.getRawText(token)
-        # print(f'defalut_element_render: {text=}')
-        return [Element.normalText(
-            text=text
-        )]
-
-    def _combine_text_and_lineBreak_elements(self, elements):
-        i = 0
-        newElements = []
-        newElementStr = ''
-        unionType = ['text', 'linebreak', 'softbreak']
-        while i < len(elements):
-            # 是text或者linebreak类型的话就累加
-            if elements[i].type in unionType:
-                newElementStr = newElementStr + elements[i].text
-
-            # 一旦发现不是text或者linebreak类型， 就应该保存起来
-            else:
+def _blockMarkdown(node, parts: List[str], profile, urlRefs):
+    if isinstance(node, Element):
+        return node.toMarkdown(urlRefs)
+    return node._toMarkdownFromParts(parts, profile, urlRefs)
 
-                if newElementStr:
-                    rawStr = newElementStr
-                    newElements.append(Element.normalText(text=rawStr))
-                    newElementStr = ''
 
-                newElements.append(elements[i])
+class _SharedEmptyText(Element):
+    """空文本element的共享实例，只在转换内部使用: renderer 渲染出的空文本、block的默认element、
+    span前后的占位element都是它，不分配新对象也不生成id；toJson 时才生成一个新的id，
+    输出里每个element的id仍然不同。公开的 Element.normalText("") 仍然返回新对象。"""
+    _shared = True
 
-            if i == len(elements) - 1 and newElementStr:
-                rawStr = newElementStr
-                newElements.append(Element.normalText(text=rawStr))
-            i = i + 1
+    def __init__(self):
+        # 绕过 __setattr__，创建之后不能再修改
+        self.__dict__.update(id=None, text="", type=ElementType.text, elements=(),
+                             isCurrent=False, value=None)
+        self.__dict__["_contentHash"] = \
+            Element({"type": ElementType.text, "text": ""}).contentHash()
 
-        return newElements
+    def __setattr__(self, name, value):
+        raise AttributeError(f"shared empty element is immutable, can't set {name}")
 
-    def _combine_text_and_lineBreak_tokens(self, tokens: List[Dict]):
+    def __reduce__(self):
+        # copy/deepcopy/pickle 都得到同一个实例
+        return "EMPTY_TEXT"
 
-        newTokens = []
-        newTokenStr = ''
-        unionType = ['text', 'linebreak', 'softbreak']
-        for t in tokens:
-            if t['type'] == 'linebreak':
-                t['raw'] = '\n'
+    def invalidateContentHash(self):
+        pass
 
-            if t['type'] == 'softbreak':
-                t['raw'] = '\n'
-        i = 0
-        while i < len(tokens):
+    def _jsonFromChildren(self, childJson):
+        out = Element._jsonFromChildren(self, childJson)
+        out["id"] = generateUUID()
+        return out
 
-            # 是text或者linebreak类型的话就累加
-            if tokens[i]['type'] in unionType:
-                newTokenStr = newTokenStr + tokens[i]['raw']
 
-            # 一旦发现不是text或者linebreak类型， 就应该保存起来
-            else:
+EMPTY_TEXT = _SharedEmptyText()
 
-                if newTokenStr:
-                    rawStr = newTokenStr
-                    newTokens.append({'raw': rawStr, 'type': 'text'})
-                    newTokenStr = ''
-
-                newTokens.append(tokens[i])
-
-            if i == len(tokens) - 1 and newTokenStr:
-                rawStr = newTokenStr
-                newTokens.append({'raw': rawStr, 'type': 'text'})
-            i = i + 1
-
-        return newTokens
-
-    def render_elements(self, tokens: List[Dict], state: BlockState) -> List[
-        Element]:
-        elements = []
-        newTokens = self._combine_text_and_lineBreak_tokens(tokens)
-        for t in newTokens:
-            func = self._get_element_method(t["type"])
-            elements = elements + func(t, state)
-        newElements = self._combine_text_and_lineBreak_elements(elements)
-        return newElements
-
-    def _get_block_method(self, name):
-        if name == "heading":
-            return self.heading
-        elif name == "paragraph":
-            return self.paragraph
-        elif name == "block_code":
-            return self.block_code
-        elif name == "list":
-            return self.list
-        elif name == "block_quote":
-            return self.block_quote
-        elif name == "blank_line":
-            return self.blank_line
-        else:
-            return self.defalut_block_render
-
-    def render_blocks(self, tokens: List[Dict], state: BlockState) -> List[
-        Block]:
-        blocks = []
-        for b in tokens:
-            # print(f'render_blocks:')
-            # pprint.pprint(b)
-            func = self._get_block_method(b["type"])
-            blocks = blocks + func(b, state)
-        return blocks
-
-    def defalut_block_render(self, token: Dict[str, Any], state: BlockState) -> \
-    List[Block]:
-        text = self.getRawText(token)
-        return [Block.raw(text=text)]
-
-    def text(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
-        # {'raw': 'Headline 1', 'type': 'text'}
-        return [Element.normalText(
-            text=token.get("raw", "")
-        )]
-
-    def emphasis(self, token: Dict[str, Any], state: BlockState) -> List[
-        Element]:
-        # {'children': [{'raw': 'Python', 'type': 'text'}],'type': 'emphasis'}
-        return [Element.italic(
-            elements=self.render_elements(token.get("children", []), state)
-        )]
-
-    def strong(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
-        # {'children': [{'raw': 'hello world', 'type': 'text'}],'type': 'strong'}
-        return [Element.bold(
-            elements=self.render_elements(token.get("children", []), state)
-        )]
-
-    def link(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
-        url = token.get('attrs',{}).get('url','https://#')
-        rawText = self.getRawText(token=token)
-        if rawText == "":
-            rawText = url
-        return [Element.link(
-            text=rawText,
-            value=url
-        )]
-
-    def image(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
-        return [Element.image(
-            text="",
-            value=token.get('attrs',{}).get('url','https://#')
-        )]
-
-    def codespan(self, token: Dict[str, Any], state: BlockState) -> List[
-        Element]:
-        # {'raw': '类', 'type': 'codespan'}
-        return [Element.inlineCode(
-            text=token.get("raw", "")
-        )]
-
-    def inline_html(self, token: Dict[str, Any], state: BlockState) -> List[
-        Element]:
-        return [Element.inlineCode(
-            text=token.get("raw", "")
-        )]
-
-    def block_text(self, token: Dict[str, Any], state: BlockState) -> List[
-        Element]:
-        return self.render_elements(token.get("children", []),
-                                    state)  # + [Element.normalText(text="\n")]
-
-    def softbreak(self, token: Dict[str, Any], state: BlockState) -> List[
-        Element]:
-        return [Element.normalText(
-            text="\n"
-        )]
-
-    def linebreak(self, token: Dict[str, Any], state: BlockState) -> List[
-        Element]:
-        return [
-            Element.normalText(
-                text="  \n"
-            )
-        ]
 
-    def blank_line(self, token: Dict[str, Any], state: BlockState) -> List[
-        Block]:
-        # {'type': 'blank_line'}
-        return [Block.raw(text="")]
-        # return []
-
-    def paragraph(self, token: Dict[str, Any], state: BlockState) -> List[
-        Block]:
-        out = []
-        otherTokens = []
-        childrenTokens = token.get("children", [])
-        for perC in childrenTokens:
-            if perC.get("type","") == ElementType.image:
-                if len(otherTokens) > 0:
-                    out.append(Block.copyDefault(
-                        type=BlockType.text,
-                        elements=self.render_elements(otherTokens, state)
-                    ))
-                    otherTokens = []
-                out.append(Block.gallery(
-                    elements=self.render_elements([perC], state)
-                ))
-            else:
-                otherTokens.append(perC)
-        if len(otherTokens) > 0:
-            out.append(Block.copyDefault(
-                type=BlockType.text,
-                elements=self.render_elements(otherTokens, state)
-            ))
+class _SharedEmptyBlock(Block):
+    """空行block的共享实例，renderer 渲染出的空行都是它，toJson 时才生成id，见 _SharedEmptyText。
+    公开的 Block.raw("") 仍然返回新对象。"""
+    _shared = True
+
+    def __init__(self):
+        block = Block.copyDefault()
+        block.contentHash()
+        block.id = None
+        block.blocks = ()
+        block.elements = (EMPTY_TEXT,)
+        self.__dict__.update(block.__dict__)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"shared empty block is immutable, can't set {name}")
+
+    def __reduce__(self):
+        return "EMPTY_BLOCK"
+
+    def invalidateContentHash(self):
+        pass
+
+    def _jsonFromChildren(self, childJson):
+        out = Block._jsonFromChildren(self, childJson)
+        out["id"] = generateUUID()
         return out
 
-    def heading(self, token: Dict[str, Any], state: BlockState) -> List[Block]:
-        # {'attrs': {'level': 1},
-        # 'children': [{'raw': 'Headline 1', 'type': 'text'}],
-        # 'style': 'axt',
-        # 'type': 'heading'}
-        hLevel = token.get("attrs", {}).get("level", 3)
-        if hLevel == 1:
-            bType = BlockType.h1
-        elif hLevel == 2:
-            bType = BlockType.h2
-        else:
-            bType = BlockType.h3
-        return [Block.copyDefault(
-            type=bType,
-            elements=self.render_elements(token.get("children", []), state)
-        )]
-
-    def thematic_break(self, token: Dict[str, Any], state: BlockState) -> List[
-        Block]:
-        return [Block.raw(text=token.get("raw", ""))]
-
-    def block_code(self, token: Dict[str, Any], state: BlockState) -> List[
-        Block]:
-        # {'attrs': {'info': 'python'},
-        # 'marker': '```',
-        # 'raw': 'class HelloWorld:\n'
-        #         '    def __init__(self):\n'
-        #         '        self.message = "Hello, World!"\n'
-        #         '\n'
-        #         '    def __str__(self):\n'
-        #         '        return self.message\n'
-        #         '\n'
-        #         'if __name__ == "__main__":\n'
-        #         '    hw = HelloWorld()\n'
-        #         '    print(hw)\n',
-        # 'style': 'fenced',
-        # 'type': 'block_code'}
-        return [Block.copyDefault(
-            type=BlockType.code,
-            elements=[
-                Element.normalText(
-                    text=token.get("raw", "")
-                )
-            ],
-            userDefinedValue={
-                "language": token.get("attrs", {}).get("info", "plain")
-            }
-        )]
-
-    def block_quote(self, token: Dict[str, Any], state: BlockState) -> List[
-        Block]:
-        # {'children': [{'children': [{'raw': 'Quote Message:', 'type': 'text'}],
-        #         'type': 'paragraph'},
-        #        {'attrs': {'depth': 1, 'ordered': False},
-        #         'bullet': '-',
-        #         'children': [{'children': [{'children': [{'raw': 'point 1',
-        #                                                   'type': 'text'}],
-        #                                     'type': 'block_text'}],
-        #                       'type': 'list_item'},
-        #                      {'children': [{'children': [{'raw': 'point 2',
-        #                                                   'type': 'text'}],
-        #                                     'type': 'block_text'}],
-        #                       'type': 'list_item'}],
-        #         'tight': True,
-        #         'type': 'list'}],
-        # 'type': 'block_quote'}
-        return [Block.copyDefault(
-            type=BlockType.quote,
-            blocks=self.render_blocks(token.get("children", []), state)
-        )]
-
-    def block_html(self, token: Dict[str, Any], state: BlockState) -> List[
-        Block]:
-        return [Block.copyDefault(
-            type=BlockType.code,
-            elements=[
-                Element.normalText(
-                    text=token.get("raw", "")
-                )
-            ],
-            userDefinedValue={
-                "language": "html"
-            }
-        )]
 
-    def block_error(self, token: Dict[str, Any], state: BlockState) -> List[
-        Block]:
-        print(token.get("raw", ""))
-        return []
+EMPTY_BLOCK = _SharedEmptyBlock()
 
-    def list(self, token: Dict[str, Any], state: BlockState) -> List[Block]:
-        attrs = token['attrs']
-        if attrs['ordered']:
-            return self.render_numberpoint_list(token, state)
-        else:
-            return self.render_bulletpoint_list(token, state)
-
-    def render_bulletpoint_list(self, token: Dict[str, Any],
-                                state: BlockState, indent: int = 0) -> List[Block]:
-        outs = []
-        for b in token.get("children", []):
-            eles = []
-            for perE in b.get("children", []):
-                if perE["type"] == "paragraph":
-                    outs.append(
-                        Block.copyDefault(
-                            type=BlockType.list,
-                            elements=self.render_elements(perE.get("children", []), state)
-                        )
-                    )
-                elif perE["type"] == "list":
-                    outs = outs + self.render_bulletpoint_list(perE, state, indent=indent+1)
-                else:
-                    eles.append(perE)
-            if len(eles) > 0:
-                outs.append(
-                    Block.copyDefault(
-                        type=BlockType.list,
-                        elements=self.render_elements(eles, state),
-                        indent = indent,
-                    )
-                )
-        return outs
-
-    def render_numberpoint_list(self, token: Dict[str, Any],
-                                state: BlockState) -> List[Block]:
-        outs = []
-        i = 0
-        for b in token.get("children", []):
-            i = i + 1
-            perBlock = Block.copyDefault(
-                type=BlockType.number_list,
-                elements=self.render_elements(b.get("children", []), state),
-                computedValue=str(i) + ".",
-                userDefinedValue=str(i) + "."
-            )
-            outs.append(perBlock)
-        return outs
+
+# compact模式下只去掉首尾空行、不逐行strip的block类型
+compactContainerTypes = {BlockType.code, BlockType.quote, BlockType.vote,
+                         BlockType.todos}
+
+
+# createAssistantCommentBlocks 的转换缓存，默认关闭，见 enableConversionCache
+conversionCache: Optional[ConversionCache] = None
+
+
+def enableConversionCache(maxEntries: int = 256,
+                          maxBytes: int = 16 * 1024 * 1024) -> ConversionCache:
+    global conversionCache
+    conversionCache = ConversionCache(maxEntries=maxEntries, maxBytes=maxBytes)
+    return conversionCache
+
+
+def disableConversionCache():
+    global conversionCache
+    conversionCache = None
 
 
 # 创建一个comment blocks
 # askedMemberInfo = { id: <memberId>, name: "samdy"}
-def createAssistantCommentBlocks(messageFromAI: str) -> list[Dict]:
+# urlRefs: blocksToMarkdownWithUrlRefs 返回的映射，用于还原AI回复中的 L1 等url引用
+# useCache: 开启了 conversionCache 时，传False可以跳过这次调用的缓存
+# limits: ConversionLimits，超限时返回一个包含原始markdown的code block，见 limits.py
+def createAssistantCommentBlocks(messageFromAI: str,
+                                 urlRefs=None, useCache=True,
+                                 limits: Optional[ConversionLimits] = None
+                                 ) -> list[Dict]:
     # _blocks: list[Block] = []
     # # append ai message block
     # _blocks.append(Block.copyDefault(
@@ -996,47 +1013,220 @@ def createAssistantCommentBlocks(messageFromAI: str) -> list[Dict]:
     # for b in _blocks:
     #     out = out + b.render()
     # return out
-    markdown = mistune.create_markdown(renderer=TrickleBlockRenderer(),
-                                       hard_wrap=True)
-    out = markdown(messageFromAI)
-    # print(f'createAssistantCommentBlocks: {out=}')
+    out, _ = createAssistantCommentBlocksWithLimits(
+        messageFromAI, urlRefs=urlRefs, useCache=useCache, limits=limits)
     return out
 
 
+# 和 createAssistantCommentBlocks 一样，返回 (blocks, 触发的限制名)，没有超限时限制名是None
+def createAssistantCommentBlocksWithLimits(messageFromAI: str, urlRefs=None,
+                                           useCache=True,
+                                           limits: Optional[ConversionLimits] = None):
+    urlRefs = UrlReferences.fromValue(urlRefs)
+    cache = conversionCache if useCache else None
+    cacheKey = None
+    if cache is not None:
+        cacheKey = cache.key(messageFromAI or "", {
+            "hard_wrap": True,
+            "urlRefs": urlRefs.toDict() if urlRefs is not None else None,
+        })
+        cached = cache.get(cacheKey, generateUUID)
+        if cached is not None:
+            return cached, None
+
+    if messageFromAI is None:
+        messageFromAI = "\n"
+    tracker = LimitTracker(limits) if limits is not None else None
+    try:
+        out = _markdownToBlocks(messageFromAI, urlRefs, tracker)
+    except (LimitExceeded, TraversalDepthError) as e:
+        if tracker is None:
+            raise
+        e = asLimitExceeded(e)
+        reportLimit(Stage.renderBlocks, e, tracker)
+        # 退化的结果不放进缓存，换一组限制时还能重新转换
+        return _fallbackBlocks(messageFromAI, limits), e.limit
+    if cache is not None:
+        cache.put(cacheKey, out)
+    return out, None
+
+
+def _markdownToBlocks(messageFromAI: str, urlRefs: Optional[UrlReferences],
+                      tracker: Optional[LimitTracker]) -> List[Dict]:
+    from trickle_block_util.renderer import LIMIT_TRACKER, \
+        TrickleBlockRenderer, getParser
+    if tracker is not None:
+        tracker.checkInput(len(messageFromAI.encode('utf-8')))
+        tracker.checkParseCost(messageFromAI)
+    renderer = TrickleBlockRenderer(urlRefs=urlRefs)
+    # 解析和渲染分开调用，方便分别统计耗时
+    markdown = getParser(hardWrap=True)
+    with stageTimer(Stage.parse, inputSize=len(messageFromAI)) as timer:
+        tokens, state = markdown.parse(messageFromAI)
+        timer.outputSize = len(tokens)
+    if tracker is not None:
+        tracker.checkTime()
+        # 渲染过程中由 renderer 计数和检查时间
+        state.env[LIMIT_TRACKER] = tracker
+    with stageTimer(Stage.renderBlocks, inputSize=len(tokens)) as timer:
+        out = renderer(tokens, state)
+        timer.outputSize = len(out)
+    return out
+
+
+def _fallbackBlocks(messageFromAI: str, limits: ConversionLimits) -> List[Dict]:
+    # 原样放进一个code block，超过 maxInputBytes 的部分截掉
+    text = messageFromAI
+    if limits.maxInputBytes is not None:
+        encoded = text.encode('utf-8')
+        if len(encoded) > limits.maxInputBytes:
+            text = encoded[:limits.maxInputBytes].decode('utf-8', errors='ignore')
+    return Block.copyDefault(
+        type=BlockType.code,
+        elements=[Element.normalText(text=text)],
+        userDefinedValue={"language": "markdown"},
+    ).render()
+
+
 # 计算一个文本的tokens
 def getTextTokens(text):
-    tic = time.time()
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    out = len(encoding.encode(text))
-    toc = time.time()
-    # print("=====> getTextTokens duration: " + str(toc - tic))
+    with stageTimer(Stage.tokenize, inputSize=len(text)) as timer:
+        out = len(_tokenizer.encode(text))
+        timer.tokens = out
     return out
 
 
 # 输入字符串 和 maxTokens，截取出符合 maxTokens 的字符串
 def truncateText(text, maxTokens):
     """Truncate a string to have `max_tokens` according to the given encoding."""
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    return encoding.decode(encoding.encode(text)[:maxTokens])
+    with stageTimer(Stage.truncate, inputSize=len(text)) as timer:
+        encoded = _tokenizer.encode(text)
+        out = _tokenizer.decode(encoded[:maxTokens])
+        timer.tokens = min(len(encoded), maxTokens)
+        timer.outputSize = len(out)
+    return out
 
 
-def blocksToMarkdown(blocks):
-    out: List[str] = []
+def blocksToMarkdown(blocks, profile=RenderProfile.default,
+                     urlRefs: Optional[UrlReferences] = None,
+                     limits: Optional[ConversionLimits] = None):
+    # limits: 超限时只输出超限之前的block，末尾加 TRUNCATED_MARKER，见 limits.py
+    out, _ = blocksToMarkdownWithLimits(blocks, profile=profile, urlRefs=urlRefs,
+                                        limits=limits)
+    return out
+
+
+# 和 blocksToMarkdown 一样，返回 (markdown, 触发的限制名)，没有超限时限制名是None
+def blocksToMarkdownWithLimits(blocks, profile=RenderProfile.default,
+                               urlRefs: Optional[UrlReferences] = None,
+                               limits: Optional[ConversionLimits] = None):
+    tracker = LimitTracker(limits) if limits is not None else None
+    with stageTimer(Stage.markdown, inputSize=len(blocks)) as timer:
+        out = _blocksToMarkdown(blocks, profile, urlRefs, tracker)
+        timer.outputSize = len(out)
+    return out, tracker.fired if tracker is not None else None
+
+
+def _measureBlock(data: Dict, tracker: LimitTracker):
+    # 转换之前先数一遍block/element/表格单元格和嵌套深度，超限就不转换这个block
+    stack = [(data, 0, True)]
+    while stack:
+        node, depth, isBlock = stack.pop()
+        tracker.checkDepth(depth)
+        # 超过全局最大深度的 Block(...) 也转换不了
+        checkDepth(depth)
+        if isBlock:
+            tracker.addBlocks()
+            if node.get('type') == BlockType.table:
+                content = (node.get('userDefinedValue') or {}).get('content') or []
+                tracker.addTableCells(sum(len(row) for row in content))
+        else:
+            tracker.addElements()
+        for child in node.get('blocks') or []:
+            stack.append((child, depth + 1, True))
+        for child in node.get('elements') or []:
+            stack.append((child, depth + 1, False))
+
+
+def _blocksToMarkdown(blocks, profile, urlRefs, tracker=None):
+    return "\n".join([md for _, _, md in
+                      _blockMarkdownEntries(blocks, profile, urlRefs, tracker)])
+
+
+def _blockMarkdownEntries(blocks, profile, urlRefs, tracker=None):
+    """每个输出的顶层block: (原始数据, Block, markdown)，用 "\n" 连起来就是 blocksToMarkdown 的结果。
+    超限时最后一项是 (None, None, TRUNCATED_MARKER)。"""
+    compact = profile == RenderProfile.compact
+    out = []
     for perBlk in blocks:
+        if tracker is not None:
+            try:
+                tracker.checkTime()
+                _measureBlock(perBlk, tracker)
+            except (LimitExceeded, TraversalDepthError) as e:
+                reportLimit(Stage.markdown, asLimitExceeded(e), tracker)
+                out.append((None, None, TRUNCATED_MARKER))
+                break
         blk = Block(perBlk)
         if blk.isDeleted:
             continue
 
-        out.append(blk.toMarkdown())
-    return "\n".join(out)
+        blkMarkdown = blk.toMarkdown(profile, urlRefs)
+        # compact模式下连续的空block只保留一个空行，开头的空行直接去掉
+        if compact and blkMarkdown == "" and (len(out) == 0 or out[-1][2] == ""):
+            continue
+        out.append((perBlk, blk, blkMarkdown))
+    if compact and len(out) > 0 and out[-1][2] == "":
+        out.pop()
+    return out
+
+
+# url替换成 L1 这样的短引用，返回 markdown 和 {"L1": url} 映射
+def blocksToMarkdownWithUrlRefs(blocks, profile=RenderProfile.default,
+                                minLength: int = 0):
+    urlRefs = UrlReferences(minLength=minLength)
+    out = blocksToMarkdown(blocks, profile=profile, urlRefs=urlRefs)
+    return out, urlRefs.toDict()
+
+
+# 整个block列表的内容hash，blocks可以是dict或者Block
+def blocksContentHash(blocks) -> str:
+    return _digest([
+        (b if isinstance(b, Block) else Block(b)).contentHash() for b in blocks
+    ])
+
+
+# 对比default和compact两种profile的输出，返回每个文档的token节省情况
+def markdownTokenSavingsReport(blocks) -> Dict[str, Any]:
+    defaultMarkdown = blocksToMarkdown(blocks)
+    compactMarkdown = blocksToMarkdown(blocks, profile=RenderProfile.compact)
+    defaultTokens = getTextTokens(defaultMarkdown)
+    compactTokens = getTextTokens(compactMarkdown)
+    savedTokens = defaultTokens - compactTokens
+    return {
+        "defaultChars": len(defaultMarkdown),
+        "compactChars": len(compactMarkdown),
+        "defaultTokens": defaultTokens,
+        "compactTokens": compactTokens,
+        "savedTokens": savedTokens,
+        "savedRatio": savedTokens / defaultTokens if defaultTokens else 0.0,
+    }
 
 
-def generateTrickleContentPrompt(title: str, blocks: list, maxTokens=1500):
+def generateTrickleContentPrompt(title: str, blocks: list, maxTokens=1500,
+                                 profile=RenderProfile.default):
+    # blocks 带有 tokenCounts 标注时按block累加预算，只对没标注/过期的block调用tokenizer，
+    # 见 tokencounts.py
+    if maxTokens is not None:
+        from trickle_block_util.tokencounts import budgetContent, hasAnnotations
+        if hasAnnotations(blocks):
+            return budgetContent(title, blocks, maxTokens, profile=profile)
+
     out = ""
     if title and title != '':
         out = out + title + "\n"
 
-    out = out + blocksToMarkdown(blocks)
+    out = out + blocksToMarkdown(blocks, profile=profile)
     if maxTokens is None:
         convertToStr = out
     else:
@@ -1065,34 +1255,42 @@ def generateTrickleFieldDataPrompt(data: dict, maxTokens=None):
     return result
 
 
-def generateTrickleStatusCommentPrompt(statusComments: list, maxTokens=None):
+def generateTrickleStatusCommentPrompt(statusComments: list, maxTokens=None,
+                                       dedup=False):
     '''
         stautsComents must be sorted before handling!!!
 
         statusComments:
         [{'john': comment1str }, {'mary': comment2str}]
 
+        dedup: 重复的段落替换成简短的引用，见 dedup.dedupTexts
     '''
     # 过滤掉所有是update this trickle的status comment
     # 取最近50条
     # ["commenName": "blocks的markDown"]
 
-    newCommentList = []
+    commentPairs = []
     for comment in statusComments:
         if 'updated this post' in comment:
             continue
         for k, v in comment.items():
-            commentStr = f"{k}: {v}"
-            newCommentList.append(commentStr)
-        if len(newCommentList) == 50:
+            commentPairs.append((k, v))
+        if len(commentPairs) == 50:
             break
 
+    if dedup:
+        from trickle_block_util.dedup import dedupTexts
+        commentPairs, _ = dedupTexts(commentPairs)
+    newCommentList = [f"{k}: {v}" for k, v in commentPairs]
+
     convertToStr = "\n".join(newCommentList)
     result = convertToStr
     return result
 
 
-def generateTrickleNormalCommentPrompt(comments: list, maxTokens=1000):
+def generateTrickleNormalCommentPrompt(comments: list, maxTokens=1000,
+                                       profile=RenderProfile.default,
+                                       dedup=False):
     # 提取最近 N 条的comments
     '''
         comments must be sorted before handling!!!
@@ -1103,27 +1301,52 @@ def generateTrickleNormalCommentPrompt(comments: list, maxTokens=1000):
           'commentAuthorName': 'John'   }, ... , ...]
 
         commentblocks: list[dict] in block format
+
+        dedup: 引用或重复的内容替换成简短的引用，见 dedup.dedupCommentThread
+
+        评论或其中的block带有 tokenCounts 标注时，预算直接用标注的token数，见 tokencounts.py
+        （dedup 会改写内容，这时不使用标注）
     '''
+    dedupedMarkdowns = None
+    if dedup:
+        from trickle_block_util.dedup import dedupCommentThread
+        dedupedMarkdowns, _ = dedupCommentThread(comments, profile=profile)
+    tokenCounter = None
+    if maxTokens is not None and not dedup:
+        from trickle_block_util.tokencounts import CommentTokenCounter
+        tokenCounter = CommentTokenCounter(profile)
     commentPromptWithIds = {}
     newCommentList = []
+    # 和 newCommentList 一一对应
+    keptComments = []
     for comment in comments:
         if comment['commentBlocks'] is None:
-            print("ERROR: comment blocks is none")
-            print(comment)
+            logger.error("comment blocks is none: %r", comment)
             continue
-        block = blocksToMarkdown(comment['commentBlocks'])
+        if dedupedMarkdowns is not None:
+            block = dedupedMarkdowns[comment["commentId"]]
+        elif tokenCounter is not None and tokenCounter.annotated(comment):
+            block = tokenCounter.render(comment)
+        else:
+            block = blocksToMarkdown(comment['commentBlocks'], profile=profile)
         commentStr = f"{comment['commentAuthorName']}: {block}"
         commentPromptWithIds[comment["commentId"]] = commentStr
         newCommentList.append(commentStr)
+        keptComments.append(comment)
 
     commentOriginPrompt = "\n".join(newCommentList)
     if maxTokens is None:
         commentPrompt = commentOriginPrompt
+    elif dedup:
+        commentPrompt = _budgetDedupedComments(keptComments, maxTokens, profile)
     else:
         usedTokens = 0
         truncateCommentList = []
-        for perComment in newCommentList[::-1]:
-            commentTokens = getTextTokens(perComment)
+        for comment, perComment in zip(keptComments[::-1], newCommentList[::-1]):
+            if tokenCounter is not None:
+                commentTokens = tokenCounter.commentTokens(comment, perComment)
+            else:
+                commentTokens = getTextTokens(perComment)
             usedTokens += commentTokens
             if maxTokens - usedTokens < 0:
                 break
@@ -1133,12 +1356,35 @@ def generateTrickleNormalCommentPrompt(comments: list, maxTokens=1000):
     return commentPromptWithIds, commentPrompt
 
 
+def _budgetDedupedComments(comments: list, maxTokens: int, profile) -> str:
+    # 先整个评论串去重再按预算丢掉旧评论的话，保留下来的 "(same as X above)" 可能指向被丢掉的评论。
+    # 这里只对保留下来的评论去重，去重后放不下就再多丢几条重新去重，直到引用都在prompt里
+    from trickle_block_util.dedup import dedupCommentThread
+    start = 0
+    while start < len(comments):
+        kept = comments[start:]
+        dedupedMarkdowns, _ = dedupCommentThread(kept, profile=profile)
+        commentStrs = [f"{c['commentAuthorName']}: {dedupedMarkdowns[c['commentId']]}"
+                       for c in kept]
+        usedTokens = 0
+        fit = 0
+        for perComment in commentStrs[::-1]:
+            usedTokens += getTextTokens(perComment)
+            if maxTokens - usedTokens < 0:
+                break
+            fit += 1
+        if fit == len(kept):
+            return "\n".join(commentStrs)
+        start = len(comments) - fit
+    return ""
+
+
 def generateAssistantPrompts(userInputMessage, assistantSetting):
     prompts = []
     # 1. system prompts
     systemPrompt = assistantSetting.get("system", "")
-    print(f'{assistantSetting=}')
-    print(f'{systemPrompt=}')
+    logger.debug("assistantSetting=%r systemPrompt=%r", assistantSetting,
+                 systemPrompt)
     if systemPrompt is not None and systemPrompt != "":
         prompts.append({
             "role": "system",
@@ -1155,6 +1401,8 @@ def generateAssistantPrompts(userInputMessage, assistantSetting):
 
 
 if __name__ == "__main__":
+    import pprint
+
     # # block data path
     # blockDataFile = "data/trickle_blocks_02.json"
 
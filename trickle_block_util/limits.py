@@ -0,0 +1,184 @@
+from typing import Optional
+import logging
+import re
+import time
+
+from trickle_block_util.metrics import Stage, emitStage
+
+logger = logging.getLogger(__name__)
+
+
+# 单次转换的工作量上限。AI输出或者客户端数据异常（几MB的嵌套列表、成千上万个反引号、
+# 巨大的table）时，超过上限就放弃完整转换，退化成更便宜的结果:
+#   createAssistantCommentBlocks -> 一个code block，内容是（截断后的）原始markdown
+#   blocksToMarkdown -> 只保留超限之前的block，末尾加 TRUNCATED_MARKER
+
+class Limit:
+    inputBytes = "inputBytes"
+    depth = "depth"
+    blocks = "blocks"
+    elements = "elements"
+    tableCells = "tableCells"
+    seconds = "seconds"
+
+
+TRUNCATED_MARKER = "[truncated]"
+
+
+class ConversionLimits:
+    """None 表示不限制。"""
+
+    def __init__(self, maxInputBytes: Optional[int] = 256 * 1024,
+                 maxDepth: Optional[int] = 100,
+                 maxBlocks: Optional[int] = 20000,
+                 maxElements: Optional[int] = 100000,
+                 maxTableCells: Optional[int] = 50000,
+                 maxSeconds: Optional[float] = 5.0):
+        self.maxInputBytes = maxInputBytes
+        self.maxDepth = maxDepth
+        self.maxBlocks = maxBlocks
+        self.maxElements = maxElements
+        self.maxTableCells = maxTableCells
+        self.maxSeconds = maxSeconds
+
+
+class LimitExceeded(Exception):
+
+    def __init__(self, limit: str, value, maximum):
+        super().__init__(f"conversion limit {limit} exceeded: {value} > {maximum}")
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+
+
+# 段落里的 */_ 分隔符、空行、fenced code 的开始/结束行
+_EMPHASIS_SCAN = re.compile(r'\n[ \t]*(?=\n)|^[ \t]{0,3}(?:`{3,}|~{3,})|[*_]+', re.M)
+
+
+def estimateEmphasisWork(text: str) -> int:
+    """粗略估计mistune处理强调嵌套的工作量: 每个收尾的分隔符按前面还没配对的开头个数计，
+    开头一层层堆起来（'**a *b ' * n + 'c* d**' * n）时按平方增长。
+    空行处重新计数，fenced code 里的不算。"""
+    work = 0
+    pending = 0
+    inFence = False
+    for m in _EMPHASIS_SCAN.finditer(text):
+        c = m.group()[0]
+        if c == '\n':
+            pending = 0
+            continue
+        if c != '*' and c != '_':
+            inFence = not inFence
+            pending = 0
+            continue
+        if inFence:
+            continue
+        start, end = m.span()
+        opens = end < len(text) and not text[end].isspace()
+        closes = start > 0 and not text[start - 1].isspace()
+        if opens and closes:
+            # 词中间的 _ 不算强调，* 有没配对的开头时当作收尾
+            if c == '_':
+                continue
+            opens = pending == 0
+        if opens:
+            pending += 1
+        elif closes and pending:
+            work += pending
+            pending -= 1
+    return work
+
+
+class LimitTracker:
+    """一次转换的计数器，超限时抛出 LimitExceeded。"""
+
+    # 每处理这么多个节点看一次时间
+    CLOCK_INTERVAL = 256
+    # estimateEmphasisWork 每秒能处理的量，按偏慢的机器估计
+    EMPHASIS_WORK_PER_SECOND = 1000000
+
+    def __init__(self, limits: ConversionLimits):
+        self.limits = limits
+        self.started = time.perf_counter()
+        self.blocks = 0
+        self.elements = 0
+        self.tableCells = 0
+        # 触发的限制名，reportLimit 时设置
+        self.fired: Optional[str] = None
+        self._untilClock = self.CLOCK_INTERVAL
+
+    def checkInput(self, size: int):
+        maximum = self.limits.maxInputBytes
+        if maximum is not None and size > maximum:
+            raise LimitExceeded(Limit.inputBytes, size, maximum)
+
+    def checkDepth(self, depth: int):
+        maximum = self.limits.maxDepth
+        if maximum is not None and depth > maximum:
+            raise LimitExceeded(Limit.depth, depth, maximum)
+
+    def checkTime(self):
+        maximum = self.limits.maxSeconds
+        if maximum is not None:
+            seconds = time.perf_counter() - self.started
+            if seconds > maximum:
+                raise LimitExceeded(Limit.seconds, round(seconds, 3), maximum)
+
+    def checkParseCost(self, text: str):
+        # markdown 解析中途没法打断，强调嵌套的开销按平方增长，解析之前先按估计的工作量检查剩余时间
+        maximum = self.limits.maxSeconds
+        if maximum is None:
+            return
+        elapsed = time.perf_counter() - self.started
+        allowed = (maximum - elapsed) * self.EMPHASIS_WORK_PER_SECOND
+        # 工作量不会超过 (分隔符个数 / 2) ** 2，分隔符少时不用扫描
+        delimiters = text.count('*') + text.count('_')
+        if delimiters * delimiters / 4 <= allowed:
+            return
+        work = estimateEmphasisWork(text)
+        if work > allowed:
+            raise LimitExceeded(Limit.seconds, round(
+                elapsed + work / self.EMPHASIS_WORK_PER_SECOND, 3), maximum)
+
+    def _tick(self, n: int):
+        self._untilClock -= n
+        if self._untilClock <= 0:
+            self._untilClock = self.CLOCK_INTERVAL
+            self.checkTime()
+
+    def addBlocks(self, n: int = 1):
+        self.blocks += n
+        maximum = self.limits.maxBlocks
+        if maximum is not None and self.blocks > maximum:
+            raise LimitExceeded(Limit.blocks, self.blocks, maximum)
+        self._tick(n)
+
+    def addElements(self, n: int = 1):
+        self.elements += n
+        maximum = self.limits.maxElements
+        if maximum is not None and self.elements > maximum:
+            raise LimitExceeded(Limit.elements, self.elements, maximum)
+        self._tick(n)
+
+    def addTableCells(self, n: int):
+        self.tableCells += n
+        maximum = self.limits.maxTableCells
+        if maximum is not None and self.tableCells > maximum:
+            raise LimitExceeded(Limit.tableCells, self.tableCells, maximum)
+        self._tick(1)
+
+
+def asLimitExceeded(exc: Exception) -> LimitExceeded:
+    # traversal.TraversalDepthError（超过全局的最大深度）按 depth 限制处理，同样走退化逻辑
+    if isinstance(exc, LimitExceeded):
+        return exc
+    return LimitExceeded(Limit.depth, exc.depth, exc.limit)
+
+
+def reportLimit(stage: str, exc: LimitExceeded, tracker: LimitTracker):
+    # 记日志，并以 Stage.limit 上报给 metrics hook，record 里带上是哪个限制
+    tracker.fired = exc.limit
+    seconds = time.perf_counter() - tracker.started
+    logger.warning("%s fell back after %.3fs: %s", stage, seconds, exc)
+    emitStage(Stage.limit, seconds, limit=exc.limit, value=exc.value,
+              maximum=exc.maximum, limitedStage=stage)
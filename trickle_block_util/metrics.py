@@ -0,0 +1,94 @@
+from typing import Any, Callable, Dict, Optional
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# 转换流程各阶段的耗时/大小上报。没有注册hook时 stageTimer 不计时也不创建记录。
+class Stage:
+    # markdown -> mistune tokens
+    parse = "parse"
+    # mistune tokens -> blocks
+    renderBlocks = "renderBlocks"
+    # blocks -> markdown
+    markdown = "markdown"
+    tokenize = "tokenize"
+    truncate = "truncate"
+    # 转换超过 ConversionLimits 后退化，record 里有 limit/value/maximum/limitedStage
+    limit = "limit"
+
+
+# hook(record)，record:
+# {"stage": str, "seconds": float, "inputSize": int, "outputSize": int, "tokens": int}
+# 用tuple保存，注册/取消时整体替换，遍历时不需要加锁
+_hooks = ()
+
+
+def addMetricsHook(hook: Callable[[Dict[str, Any]], None]):
+    global _hooks
+    if hook not in _hooks:
+        _hooks = _hooks + (hook,)
+
+
+def removeMetricsHook(hook: Callable[[Dict[str, Any]], None]):
+    global _hooks
+    # 和 addMetricsHook 一样按相等比较，绑定方法每次取都是新对象
+    _hooks = tuple(h for h in _hooks if h != hook)
+
+
+def metricsEnabled() -> bool:
+    return len(_hooks) > 0
+
+
+def emitStage(stage: str, seconds: float, inputSize: Optional[int] = None,
+              outputSize: Optional[int] = None, tokens: Optional[int] = None,
+              **extra):
+    hooks = _hooks
+    if not hooks:
+        return
+    record = {
+        "stage": stage,
+        "seconds": seconds,
+        "inputSize": inputSize,
+        "outputSize": outputSize,
+        "tokens": tokens,
+    }
+    record.update(extra)
+    for hook in hooks:
+        try:
+            hook(record)
+        except Exception:
+            # 上报失败不能影响转换
+            logger.exception("metrics hook failed for stage %s", stage)
+
+
+class stageTimer:
+    """with stageTimer(Stage.parse, inputSize=len(text)) as timer:
+           ...
+           timer.outputSize = len(tokens)
+    """
+
+    __slots__ = ("stage", "inputSize", "outputSize", "tokens", "extra",
+                 "_start")
+
+    def __init__(self, stage: str, inputSize: Optional[int] = None, **extra):
+        self.stage = stage
+        self.inputSize = inputSize
+        self.outputSize = None
+        self.tokens = None
+        self.extra = extra
+        self._start = None
+
+    def __enter__(self):
+        if _hooks:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if self._start is not None:
+            emitStage(self.stage, time.perf_counter() - self._start,
+                      inputSize=self.inputSize, outputSize=self.outputSize,
+                      tokens=self.tokens, failed=excType is not None,
+                      **self.extra)
+        return False
@@ -0,0 +1,98 @@
+from typing import List, Dict, Tuple
+import re
+
+from trickle_block_util.generator import Block, BlockType, RenderProfile, \
+    blocksToMarkdown, getTextTokens, truncateText
+
+
+# 只需要文章结构（路由、分类）的时候，不用把整篇正文都转成markdown
+class OutlineLevel:
+    # 只有 h1/h2/h3 标题
+    headings = 0
+    # 标题 + 每一节的第一句话
+    leads = 1
+    # 完整内容，等同于 blocksToMarkdown
+    full = 2
+
+
+headingLevels = {
+    BlockType.h1: 1,
+    BlockType.h2: 2,
+    BlockType.h3: 3,
+}
+
+# 可以从中取出"第一句话"的block类型，code/embed/table这类跳过
+leadBlockTypes = [
+    BlockType.text,
+    BlockType.list,
+    BlockType.number_list,
+    BlockType.checkbox,
+    BlockType.quote,
+    BlockType.reference,
+]
+
+sentenceEnd = re.compile(r'[.!?。！？](?=\s|$)|[。！？]')
+
+
+def firstSentence(text: str) -> str:
+    text = " ".join(text.split())
+    matched = sentenceEnd.search(text)
+    if matched:
+        return text[:matched.end()]
+    return text
+
+
+def _headingToMarkdown(blk: Block) -> str:
+    title = "".join([e.toMarkdown() for e in blk.elements]).strip()
+    return "  " * blk.indent + "#" * headingLevels[blk.type] + " " + title
+
+
+def _leadOf(blk: Block) -> str:
+    if blk.type == BlockType.quote:
+        text = " ".join(["".join([e.toMarkdown() for e in b.elements])
+                         for b in blk.blocks])
+    else:
+        text = "".join([e.toMarkdown() for e in blk.elements])
+    return firstSentence(text)
+
+
+def blocksToOutline(blocks: List[Dict], level=OutlineLevel.headings,
+                    profile=RenderProfile.default) -> str:
+    if level >= OutlineLevel.full:
+        return blocksToMarkdown(blocks, profile=profile)
+
+    out: List[str] = []
+    # 还没找到本节第一句话的时候为True，文章开头（第一个标题之前）也算一节
+    needLead = level == OutlineLevel.leads
+    for perBlk in blocks:
+        # 标题和第一句话都只看block自己的type/elements，不转换正文
+        if perBlk.get('isDeleted'):
+            continue
+        blkType = perBlk.get('type')
+        if blkType in headingLevels:
+            out.append(_headingToMarkdown(Block(perBlk)))
+            needLead = level == OutlineLevel.leads
+        elif needLead and blkType in leadBlockTypes:
+            lead = _leadOf(Block(perBlk))
+            if lead:
+                out.append(lead)
+                needLead = False
+    return "\n".join(out)
+
+
+# 在 maxTokens 以内选信息最多的一档，返回 (level, outline)
+def fitOutline(blocks: List[Dict], maxTokens: int,
+               profile=RenderProfile.default) -> Tuple[int, str]:
+    fitted = None
+    for level in [OutlineLevel.headings, OutlineLevel.leads,
+                  OutlineLevel.full]:
+        outline = blocksToOutline(blocks, level=level, profile=profile)
+        if getTextTokens(outline) > maxTokens:
+            break
+        fitted = (level, outline)
+    if fitted is None:
+        # 连标题都放不下，只能截断
+        outline = blocksToOutline(blocks, level=OutlineLevel.headings,
+                                  profile=profile)
+        return OutlineLevel.headings, truncateText(outline, maxTokens)
+    return fitted
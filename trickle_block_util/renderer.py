@@ -0,0 +1,502 @@
+from typing import List, Optional, Dict, Any
+import logging
+import threading
+
+import mistune
+from mistune.renderers.markdown import MarkdownRenderer
+from mistune.core import BlockState
+
+from trickle_block_util.generator import EMPTY_BLOCK, EMPTY_TEXT, Block, \
+    BlockType, Element, ElementType, UrlReferences
+from trickle_block_util.traversal import checkDepth
+
+
+# mistune token -> Block 的渲染器。单独成模块，generator 只在第一次转换markdown时才导入，
+# 只用 blocksToMarkdown 的调用方不需要加载 mistune。
+
+logger = logging.getLogger(__name__)
+
+
+# render_elements 里会合并成一个text element的类型
+textElementTypes = {'text', 'linebreak', 'softbreak'}
+
+
+# 转换结果里的空文本和空行用共享的 EMPTY_TEXT/EMPTY_BLOCK，
+# 公开的 Element.normalText("")/Block.raw("") 返回的是调用方可以修改的新对象
+def _textElement(text: str) -> Element:
+    return EMPTY_TEXT if text == "" else Element.normalText(text=text)
+
+
+def _rawBlock(text: str) -> Block:
+    return EMPTY_BLOCK if text == "" else Block.raw(text=text)
+
+
+class TrickleBlockRenderer(MarkdownRenderer):
+    """A renderer to convert markdown to Trickle Block.
+
+    除了构造时传入的 urlRefs 不保存任何状态，每次渲染的中间结果都在 state.env 里，
+    同一个实例可以在多个线程里同时使用。"""
+    NAME = 'TrickleBlock'
+
+    def __init__(self, urlRefs: Optional[UrlReferences] = None):
+        super().__init__()
+        # blocksToMarkdown时替换掉的url，AI原样返回 L1 这样的引用时还原
+        self.urlRefs = urlRefs
+
+    def restoreUrl(self, url: str) -> str:
+        if self.urlRefs is None:
+            return url
+        return self.urlRefs.resolve(url)
+
+    def __call__(self, tokens, state: BlockState) -> List[Block]:
+        out = []
+        blocks = self.render_blocks(tokens, state)
+        for b in blocks:
+            out.extend(b.render())
+        return out
+
+    elementType = ['emphasis', 'strong', 'link', 'image', 'codespan',
+                   'inline_html', 'linebreak']
+
+    def getRawText(self, token: Dict[str, Any], depth: int = 1,
+                   state: Optional[BlockState] = None) -> str:
+        # 一次遍历把所有叶子的文本追加到同一个buffer里，最后只join一次。
+        # 传了state时，每个有children的token在buffer里的区间会缓存在 state.env 中，
+        # 之后对子树再调用 getRawText 直接取缓存，不再重新遍历。
+        cache = state.env.setdefault(RAW_TEXT_CACHE, {}) \
+            if state is not None else None
+        if cache is not None:
+            cached = _cachedRawText(cache, token)
+            if cached is not None:
+                return cached
+
+        fragments: List[str] = []
+        # (token, None) 进入节点；(token, start) 离开节点，start是进入时buffer的长度
+        stack = [(token, None, 1)]
+        while stack:
+            node, start, nodeDepth = stack.pop()
+            if start is not None:
+                cache[id(node)] = [node, fragments, start, len(fragments)]
+                continue
+            children = node.get("children")
+            if not children:
+                fragments.append(_tokenRawText(node))
+                continue
+            if cache is not None:
+                cached = _cachedRawText(cache, node)
+                if cached is not None:
+                    fragments.append(cached)
+                    continue
+                stack.append((node, len(fragments), nodeDepth))
+            checkDepth(nodeDepth)
+            stack.extend([(c, None, nodeDepth + 1) for c in reversed(children)])
+        return "".join(fragments)
+
+    def render_children(self, token, state: BlockState):
+        children = token['children']
+        return self.render_tokens(children, state)
+
+    def _get_element_method(self, name):
+        if name == "text":
+            return self.text
+        elif name == "emphasis":
+            return self.emphasis
+        elif name == "strong":
+            return self.strong
+        elif name == "link":
+            return self.link
+        elif name == "image":
+            return self.image
+        elif name == "codespan":
+            return self.codespan
+        elif name == "inline_html":
+            return self.inline_html
+        elif name == "softbreak":
+            return self.softbreak
+        elif name == "linebreak":
+            return self.linebreak
+        elif name == "block_text":
+            return self.block_text
+        else:
+            return self.defalut_element_render
+
+    def defalut_element_render(self, token: Dict[str, Any],
+                               state: BlockState) -> List[Element]:
+        text = self.getRawText(token, state=state)
+        # print(f'defalut_element_render: {text=}')
+        return [_textElement(text)]
+
+    def render_elements(self, tokens: List[Dict], state: BlockState) -> List[
+        Element]:
+        # 相邻的 text/softbreak/linebreak token，以及渲染出来的 text element，
+        # 一次遍历合并成一个 text element；不修改传进来的token，解析结果可以重复使用
+        elements = []
+        pending: List[str] = []
+        for t in tokens:
+            tType = t["type"]
+            if tType == 'text':
+                pending.append(t.get('raw', ''))
+                continue
+            if tType == 'linebreak' or tType == 'softbreak':
+                pending.append('\n')
+                continue
+            func = self._get_element_method(tType)
+            for e in func(t, state):
+                if e.type in textElementTypes:
+                    pending.append(e.text)
+                    continue
+                if pending:
+                    text = "".join(pending)
+                    pending = []
+                    if text:
+                        elements.append(Element.normalText(text=text))
+                elements.append(e)
+        if pending:
+            text = "".join(pending)
+            if text:
+                elements.append(Element.normalText(text=text))
+        tracker = _limitTracker(state)
+        if tracker is not None:
+            tracker.addElements(len(elements))
+        return elements
+
+    def _get_block_method(self, name):
+        if name == "heading":
+            return self.heading
+        elif name == "paragraph":
+            return self.paragraph
+        elif name == "block_code":
+            return self.block_code
+        elif name == "list":
+            return self.list
+        elif name == "block_quote":
+            return self.block_quote
+        elif name == "blank_line":
+            return self.blank_line
+        else:
+            return self.defalut_block_render
+
+    def render_blocks(self, tokens: List[Dict], state: BlockState) -> List[
+        Block]:
+        blocks = []
+        tracker = _limitTracker(state)
+        for b in tokens:
+            # print(f'render_blocks:')
+            # pprint.pprint(b)
+            func = self._get_block_method(b["type"])
+            rendered = func(b, state)
+            if tracker is not None:
+                tracker.addBlocks(len(rendered))
+            blocks.extend(rendered)
+        return blocks
+
+    def defalut_block_render(self, token: Dict[str, Any], state: BlockState) -> \
+    List[Block]:
+        text = self.getRawText(token, state=state)
+        return [_rawBlock(text)]
+
+    def text(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
+        # {'raw': 'Headline 1', 'type': 'text'}
+        return [_textElement(token.get("raw", ""))]
+
+    def emphasis(self, token: Dict[str, Any], state: BlockState) -> List[
+        Element]:
+        # {'children': [{'raw': 'Python', 'type': 'text'}],'type': 'emphasis'}
+        return [Element.italic(
+            elements=self.render_elements(token.get("children", []), state)
+        )]
+
+    def strong(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
+        # {'children': [{'raw': 'hello world', 'type': 'text'}],'type': 'strong'}
+        return [Element.bold(
+            elements=self.render_elements(token.get("children", []), state)
+        )]
+
+    def link(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
+        url = self.restoreUrl(token.get('attrs',{}).get('url','https://#'))
+        rawText = self.getRawText(token=token, state=state)
+        if rawText == "":
+            rawText = url
+        return [Element.link(
+            text=rawText,
+            value=url
+        )]
+
+    def image(self, token: Dict[str, Any], state: BlockState) -> List[Element]:
+        return [Element.image(
+            text="",
+            value=self.restoreUrl(token.get('attrs',{}).get('url','https://#'))
+        )]
+
+    def codespan(self, token: Dict[str, Any], state: BlockState) -> List[
+        Element]:
+        # {'raw': '类', 'type': 'codespan'}
+        return [Element.inlineCode(
+            text=token.get("raw", "")
+        )]
+
+    def inline_html(self, token: Dict[str, Any], state: BlockState) -> List[
+        Element]:
+        return [Element.inlineCode(
+            text=token.get("raw", "")
+        )]
+
+    def block_text(self, token: Dict[str, Any], state: BlockState) -> List[
+        Element]:
+        return self.render_elements(token.get("children", []),
+                                    state)  # + [Element.normalText(text="\n")]
+
+    def softbreak(self, token: Dict[str, Any], state: BlockState) -> List[
+        Element]:
+        return [Element.normalText(
+            text="\n"
+        )]
+
+    def linebreak(self, token: Dict[str, Any], state: BlockState) -> List[
+        Element]:
+        return [
+            Element.normalText(
+                text="  \n"
+            )
+        ]
+
+    def blank_line(self, token: Dict[str, Any], state: BlockState) -> List[
+        Block]:
+        # {'type': 'blank_line'}
+        return [EMPTY_BLOCK]
+        # return []
+
+    def paragraph(self, token: Dict[str, Any], state: BlockState) -> List[
+        Block]:
+        out = []
+        otherTokens = []
+        childrenTokens = token.get("children", [])
+        for perC in childrenTokens:
+            if perC.get("type","") == ElementType.image:
+                if len(otherTokens) > 0:
+                    out.append(Block.copyDefault(
+                        type=BlockType.text,
+                        elements=self.render_elements(otherTokens, state)
+                    ))
+                    otherTokens = []
+                out.append(Block.gallery(
+                    elements=self.render_elements([perC], state)
+                ))
+            else:
+                otherTokens.append(perC)
+        if len(otherTokens) > 0:
+            out.append(Block.copyDefault(
+                type=BlockType.text,
+                elements=self.render_elements(otherTokens, state)
+            ))
+        return out
+
+    def heading(self, token: Dict[str, Any], state: BlockState) -> List[Block]:
+        # {'attrs': {'level': 1},
+        # 'children': [{'raw': 'Headline 1', 'type': 'text'}],
+        # 'style': 'axt',
+        # 'type': 'heading'}
+        hLevel = token.get("attrs", {}).get("level", 3)
+        if hLevel == 1:
+            bType = BlockType.h1
+        elif hLevel == 2:
+            bType = BlockType.h2
+        else:
+            bType = BlockType.h3
+        return [Block.copyDefault(
+            type=bType,
+            elements=self.render_elements(token.get("children", []), state)
+        )]
+
+    def thematic_break(self, token: Dict[str, Any], state: BlockState) -> List[
+        Block]:
+        return [_rawBlock(token.get("raw", ""))]
+
+    def block_code(self, token: Dict[str, Any], state: BlockState) -> List[
+        Block]:
+        # {'attrs': {'info': 'python'},
+        # 'marker': '```',
+        # 'raw': 'class HelloWorld:\n'
+        #         '    def __init__(self):\n'
+        #         '        self.message = "Hello, World!"\n'
+        #         '\n'
+        #         '    def __str__(self):\n'
+        #         '        return self.message\n'
+        #         '\n'
+        #         'if __name__ == "__main__":\n'
+        #         '    hw = HelloWorld()\n'
+        #         '    print(hw)\n',
+        # 'style': 'fenced',
+        # 'type': 'block_code'}
+        return [Block.copyDefault(
+            type=BlockType.code,
+            elements=[_textElement(token.get("raw", ""))],
+            userDefinedValue={
+                "language": token.get("attrs", {}).get("info", "plain")
+            }
+        )]
+
+    def block_quote(self, token: Dict[str, Any], state: BlockState) -> List[
+        Block]:
+        # {'children': [{'children': [{'raw': 'Quote Message:', 'type': 'text'}],
+        #         'type': 'paragraph'},
+        #        {'attrs': {'depth': 1, 'ordered': False},
+        #         'bullet': '-',
+        #         'children': [{'children': [{'children': [{'raw': 'point 1',
+        #                                                   'type': 'text'}],
+        #                                     'type': 'block_text'}],
+        #                       'type': 'list_item'},
+        #                      {'children': [{'children': [{'raw': 'point 2',
+        #                                                   'type': 'text'}],
+        #                                     'type': 'block_text'}],
+        #                       'type': 'list_item'}],
+        #         'tight': True,
+        #         'type': 'list'}],
+        # 'type': 'block_quote'}
+        # quote 每嵌套一层 render_blocks 就多一层，深度记在 state.env 里，和list一样检查
+        depth = state.env.get(QUOTE_DEPTH, 0) + 1
+        checkDepth(depth)
+        tracker = _limitTracker(state)
+        if tracker is not None:
+            tracker.checkDepth(depth)
+        state.env[QUOTE_DEPTH] = depth
+        try:
+            blocks = self.render_blocks(token.get("children", []), state)
+        finally:
+            state.env[QUOTE_DEPTH] = depth - 1
+        return [Block.copyDefault(
+            type=BlockType.quote,
+            blocks=blocks,
+            elements=[EMPTY_TEXT],
+        )]
+
+    def block_html(self, token: Dict[str, Any], state: BlockState) -> List[
+        Block]:
+        return [Block.copyDefault(
+            type=BlockType.code,
+            elements=[_textElement(token.get("raw", ""))],
+            userDefinedValue={
+                "language": "html"
+            }
+        )]
+
+    def block_error(self, token: Dict[str, Any], state: BlockState) -> List[
+        Block]:
+        logger.warning("mistune block_error: %r", token.get("raw", ""))
+        return []
+
+    def list(self, token: Dict[str, Any], state: BlockState) -> List[Block]:
+        attrs = token['attrs']
+        if attrs['ordered']:
+            return self.render_numberpoint_list(token, state)
+        else:
+            return self.render_bulletpoint_list(token, state)
+
+    def render_bulletpoint_list(self, token: Dict[str, Any],
+                                state: BlockState, indent: int = 0) -> List[Block]:
+        outs = []
+        tracker = _limitTracker(state)
+        # 嵌套的list用显式栈处理，每一帧: [list_item迭代器, indent, 当前item的children迭代器, eles]
+        stack = [[iter(token.get("children", [])), indent, None, []]]
+        while stack:
+            frame = stack[-1]
+            items, itemIndent, children, eles = frame
+            if children is None:
+                b = next(items, None)
+                if b is None:
+                    stack.pop()
+                    continue
+                frame[2] = iter(b.get("children", []))
+                frame[3] = []
+                continue
+            perE = next(children, None)
+            if perE is None:
+                if len(eles) > 0:
+                    outs.append(
+                        Block.copyDefault(
+                            type=BlockType.list,
+                            elements=self.render_elements(eles, state),
+                            indent = itemIndent,
+                        )
+                    )
+                frame[2] = None
+            elif perE["type"] == "paragraph":
+                outs.append(
+                    Block.copyDefault(
+                        type=BlockType.list,
+                        elements=self.render_elements(perE.get("children", []), state)
+                    )
+                )
+            elif perE["type"] == "list":
+                checkDepth(len(stack))
+                if tracker is not None:
+                    tracker.checkDepth(len(stack))
+                stack.append([iter(perE.get("children", [])), itemIndent + 1,
+                              None, []])
+            else:
+                eles.append(perE)
+        return outs
+
+    def render_numberpoint_list(self, token: Dict[str, Any],
+                                state: BlockState) -> List[Block]:
+        outs = []
+        i = 0
+        for b in token.get("children", []):
+            i = i + 1
+            perBlock = Block.copyDefault(
+                type=BlockType.number_list,
+                elements=self.render_elements(b.get("children", []), state),
+                computedValue=str(i) + ".",
+                userDefinedValue=str(i) + "."
+            )
+            outs.append(perBlock)
+        return outs
+
+
+RAW_TEXT_CACHE = "trickleRawTextCache"
+# state.env 里的 limits.LimitTracker，createAssistantCommentBlocks 传了limits时才有
+LIMIT_TRACKER = "trickleLimitTracker"
+# state.env 里当前所在的 block_quote 层数
+QUOTE_DEPTH = "trickleQuoteDepth"
+
+
+def _tokenRawText(token: Dict[str, Any]) -> str:
+    # 没有children的token
+    if token.get("raw") is not None:
+        return token["raw"]
+    if token.get("type") == 'softbreak':
+        return '\n'
+    return ''
+
+
+def _limitTracker(state: Optional[BlockState]):
+    # 单独调用 render_* 时可以不传state
+    return state.env.get(LIMIT_TRACKER) if state is not None else None
+
+
+def _cachedRawText(cache: Dict[int, list], token: Dict[str, Any]) -> Optional[str]:
+    # 缓存项: [token, fragments, start, end]，第一次取的时候才join，之后直接存字符串
+    entry = cache.get(id(token))
+    if entry is None or entry[0] is not token:
+        return None
+    if entry[1] is not None:
+        entry[3] = "".join(entry[1][entry[2]:entry[3]])
+        entry[1] = None
+    return entry[3]
+
+
+# 按 hard_wrap 缓存创建好的 parser，create_markdown 每次都要初始化插件和规则
+_parsers: Dict[bool, mistune.Markdown] = {}
+_parsersLock = threading.Lock()
+
+
+def getParser(hardWrap: bool = True) -> mistune.Markdown:
+    # 解析状态都在每次 parse 新建的 BlockState 里，同一个parser可以在多个线程里同时使用
+    parser = _parsers.get(hardWrap)
+    if parser is None:
+        with _parsersLock:
+            parser = _parsers.get(hardWrap)
+            if parser is None:
+                parser = mistune.create_markdown(renderer=None, hard_wrap=hardWrap)
+                _parsers[hardWrap] = parser
+    return parser
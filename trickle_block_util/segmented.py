@@ -0,0 +1,263 @@
+from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+import threading
+
+from trickle_block_util import generator
+from trickle_block_util.cache import _reassignIds
+from trickle_block_util.generator import UrlReferences
+
+
+# 很大的markdown（几百KB的AI输出、导入的文件）按顶层的安全边界切成几段，多进程并行解析，
+# 再按顺序拼起来，结果和整体一次解析完全一样（除了随机生成的id）。
+#
+# 安全边界: 一串空行之后、不在 fenced code 里、下一行顶格写并且不是列表项/引用/html。
+# 这样切开之后每一段的第一行在整体解析时也一定是一个新的顶层block的开始:
+#   - 空行总会结束段落；顶格的非列表行会结束前面的列表和引用
+#   - 列表项之间、列表项的缩进续行、缩进代码块、fence里的空行都不会被切开
+# 整个文档作用域的语法没法分段: 出现链接引用定义（[x]: url）或者html块时直接整体解析。
+#
+# 引用被紧跟的列表/分隔线/fence打断时，mistune 把引用插在“当前最后一个token”之前，
+# 而打断它的列表还会吞掉空行之后的分隔线、标题等，所以结果的顺序依赖后面的内容。
+# 这种情况下下一个边界只能放在普通段落行之前（列表在这里一定正常结束）。
+
+_fenceOpen = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+_fenceClose = re.compile(r"^ {0,3}(`{3,}|~{3,})[ \t]*$")
+_listMarker = re.compile(r"^([*+-]|\d{1,9}[.)])([ \t]|$)")
+_refDefinition = re.compile(r"^ {0,3}\[[^\]]*\]:", re.MULTILINE)
+_htmlBlock = re.compile(r"^ {0,3}<", re.MULTILINE)
+_quoteLine = re.compile(r"^ {0,3}>")
+_thematicBreak = re.compile(r"^ {0,3}((\*[ \t]*){3,}|(-[ \t]*){3,}|(_[ \t]*){3,})$")
+_atxHeading = re.compile(r"^ {0,3}#{1,6}([ \t]|$)")
+
+
+def _isBlank(line: str) -> bool:
+    return line.strip() == ""
+
+
+def _startsTopLevelBlock(line: str) -> bool:
+    if _isBlank(line) or line[0] in " \t>":
+        return False
+    return _listMarker.match(line) is None
+
+
+def _startsParagraph(line: str) -> bool:
+    line = line.rstrip("\n")
+    return _startsTopLevelBlock(line) and _fenceOpen.match(line) is None \
+        and _thematicBreak.match(line) is None and _atxHeading.match(line) is None
+
+
+def _indentOf(line: str) -> int:
+    return len(line) - len(line.lstrip(" "))
+
+
+def _closesFence(line: str, marker: str) -> bool:
+    # 关闭的fence: 最多3个空格缩进，同样的字符，长度不小于开始的fence，后面只能有空白
+    m = _fenceClose.match(line)
+    return m is not None and m.group(1).startswith(marker)
+
+
+def _breaksListItem(line: str, indent: int, breakIndent: int) -> bool:
+    # mistune: 缩进不够续行的非空行，是这些block的开始时结束列表项，否则原样接在列表项里（lazy）
+    if indent > breakIndent:
+        return False
+    rest = line[indent:]
+    return rest[:1] in (">", "<") or _fenceOpen.match(rest) is not None \
+        or _thematicBreak.match(rest.rstrip("\n")) is not None \
+        or _atxHeading.match(rest) is not None or _listMarker.match(rest) is not None
+
+
+def segmentBoundaries(lines: List[str]) -> List[int]:
+    """可以从这一行开始新的一段的行号（不含0）。lines 带行尾的换行符。
+
+    列表项里的 fence 跟着列表项结束，之后顶格的 ``` 是新的 fence 的开始，所以 fence 要和列表项
+    一起跟踪（按 mistune 的规则: 续行要缩进到内容列，缩进不够的行是block开始时结束列表项，
+    否则是 lazy continuation）。只跟踪一层列表里的 fence，嵌套列表里的 fence、lazy 的 fence 行、
+    列表缩进里的tab等判断不准的情况，从那里开始不再切分。"""
+    out = []
+    # (fence字符串, 所在列表项的内容列，顶层是0)
+    fence = None
+    # 打开的列表项，外层到内层: [结束列表项的block最多缩进到哪一列, 内容列, 已经有内容]
+    items: List[list] = []
+    # 上一行是空行，previousBlank 不算fence里的空行，只用来判断边界
+    previousBlank = False
+    blankBefore = False
+    previousQuote = False
+    # 上一个非空行是段落文字，列表标记接在段落后面时可能不算列表
+    paragraph = False
+    # 前面有被打断的引用，还没遇到能安全切开的段落行
+    interrupted = False
+    for i, line in enumerate(lines):
+        if previousQuote and not _isBlank(line) and _quoteLine.match(line) is None:
+            interrupted = True
+        previousQuote = False
+        blank = _isBlank(line)
+        indent = _indentOf(line)
+        if items and not blank and line[indent] == "\t":
+            return out
+        if fence is not None:
+            marker, container = fence
+            if container == 0:
+                if _closesFence(line, marker):
+                    fence = None
+                previousBlank = False
+                blankBefore = blank
+                continue
+            # 列表项里的fence
+            if blank or indent >= container or (
+                    not blankBefore and not _breaksListItem(line, indent, items[-1][0])):
+                # lazy 的行原样接在列表项里，也能关闭fence
+                if not blank and _closesFence(
+                        line[container:] if indent >= container else line, marker):
+                    fence = None
+                previousBlank = False
+                blankBefore = blank
+                continue
+            # 列表项结束，里面的fence也跟着结束
+            fence = None
+            items.clear()
+            previousBlank = blankBefore = False
+        if blank:
+            previousBlank = blankBefore = True
+            paragraph = False
+            if items and not items[-1][2]:
+                # 空的列表项后面最多一个空行
+                items.pop()
+            continue
+        if previousBlank and i > 0 and _startsTopLevelBlock(line):
+            if not interrupted:
+                out.append(i)
+            elif _startsParagraph(line):
+                out.append(i)
+                interrupted = False
+        afterBlank = blankBefore
+        previousBlank = blankBefore = False
+        previousQuote = _quoteLine.match(line) is not None
+
+        while items and indent < items[-1][1] and (
+                afterBlank or _breaksListItem(line, indent, items[-1][0])):
+            items.pop()
+            paragraph = False
+        if items and indent < items[-1][1]:
+            # lazy continuation
+            if _fenceOpen.match(line[indent:]) is not None:
+                return out
+            items[-1][2] = True
+            continue
+        container = items[-1][1] if items else 0
+        if items:
+            items[-1][2] = True
+        rel = indent - container
+        if rel > 3:
+            # 缩进代码块，或者段落的续行
+            continue
+        rest = line[indent:]
+        m = _listMarker.match(rest)
+        if m is not None:
+            marker = m.group(1)
+            text = rest[m.end(1):]
+            if paragraph and not afterBlank and (
+                    (marker[0].isdigit() and int(marker[:-1]) != 1) or not text.strip()):
+                # 不能打断段落，还是段落文字
+                continue
+            if "\t" in text[:len(text) - len(text.lstrip(" \t"))]:
+                return out
+            spaces = _indentOf(text)
+            if not text.strip() or spaces > 4:
+                # 空的列表项，或者内容是缩进代码块
+                spaces = 1
+            if _fenceOpen.match(text[spaces:]) is not None:
+                return out
+            items.append([container + min(rel + len(marker), 3),
+                          indent + len(marker) + spaces, bool(text.strip())])
+            paragraph = bool(text.strip())
+            continue
+        m = _fenceOpen.match(rest)
+        if m is not None:
+            if len(items) > 1:
+                return out
+            fence = (m.group(1), container)
+            paragraph = False
+            continue
+        paragraph = _thematicBreak.match(rest.rstrip("\n")) is None \
+            and _atxHeading.match(rest) is None
+    return out
+
+
+def splitSegments(text: str, targetBytes: int) -> Optional[List[str]]:
+    """切成大约 targetBytes 一段，不能安全切分时返回None。"""
+    if _refDefinition.search(text) or _htmlBlock.search(text):
+        return None
+    lines = text.split("\n")
+    # 保留换行符，拼回去和原文一模一样
+    lines = [line + "\n" for line in lines[:-1]] + [lines[-1]]
+    segments = []
+    start = 0
+    size = 0
+    boundaries = set(segmentBoundaries(lines))
+    for i, line in enumerate(lines):
+        if i in boundaries and size >= targetBytes:
+            segments.append("".join(lines[start:i]))
+            start = i
+            size = 0
+        size += len(line)
+    segments.append("".join(lines[start:]))
+    return segments
+
+
+# 每种进程数一个进程池，不同进程数的转换同时进行时不会关掉别人正在用的池
+_executors: Dict[int, ProcessPoolExecutor] = {}
+_executorLock = threading.Lock()
+
+
+def _getExecutor(workers: int) -> ProcessPoolExecutor:
+    with _executorLock:
+        executor = _executors.get(workers)
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            _executors[workers] = executor
+        return executor
+
+
+def shutdownExecutor():
+    # 关掉所有进程池，调用方要保证这时没有进行中的转换
+    with _executorLock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown()
+
+
+def _convertSegment(text: str, urlRefs: Optional[Dict[str, str]]) -> List[Dict]:
+    return generator._markdownToBlocks(text, UrlReferences.fromValue(urlRefs), None)
+
+
+def createAssistantCommentBlocksSegmented(messageFromAI: str, urlRefs=None,
+                                          workers: Optional[int] = None,
+                                          minSegmentBytes: int = 32 * 1024
+                                          ) -> List[Dict]:
+    """和 createAssistantCommentBlocks 一样的结果，输入足够大时分段并行解析。
+    小于 2 * minSegmentBytes、只有一个CPU或不能安全切分时就是普通的单次解析。"""
+    if messageFromAI is None:
+        messageFromAI = "\n"
+    workers = workers or os.cpu_count() or 1
+    urlRefs = UrlReferences.fromValue(urlRefs)
+    segments = None
+    if workers > 1 and len(messageFromAI) >= 2 * minSegmentBytes:
+        # 每个worker分几段，段的大小不均时负载也比较平均
+        targetBytes = max(minSegmentBytes, len(messageFromAI) // (workers * 4))
+        segments = splitSegments(messageFromAI, targetBytes)
+    if segments is None or len(segments) == 1:
+        return generator._markdownToBlocks(messageFromAI, urlRefs, None)
+
+    mapping = urlRefs.toDict() if urlRefs is not None else None
+    executor = _getExecutor(workers)
+    out = []
+    for blocks in executor.map(_convertSegment, segments,
+                               [mapping] * len(segments)):
+        out.extend(blocks)
+    if generator._idGenerator is not generator._uuid1:
+        # 自定义的id生成器（比如计数器）在各个子进程里各自运行会重复，统一在这里重新生成
+        _reassignIds(out, generator.generateUUID)
+    return out
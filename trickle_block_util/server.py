@@ -0,0 +1,497 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+from trickle_block_util import tokenizer
+from trickle_block_util.generator import RenderProfile, blocksToMarkdown, \
+    createAssistantCommentBlocks, truncateText, warmUp
+from trickle_block_util.limits import ConversionLimits
+
+logger = logging.getLogger(__name__)
+
+
+# 本地常驻的转换服务，给其他语言的服务调用，只依赖标准库:
+#   python -m trickle_block_util.server --port 8765
+#   python -m trickle_block_util.server --unix-socket /tmp/trickle.sock
+#
+# POST /markdown  {"blocks": [...], "profile": "default", "maxTokens": null} -> {"markdown": str}
+# POST /blocks    {"markdown": str} -> {"blocks": [...]}
+# POST /tokens    {"text": str} -> {"tokens": int}  或 {"texts": [str]} -> {"tokens": [int]}
+# GET  /stats     延迟分位数、队列深度、tokens 请求的批大小
+# GET  /health
+#
+# HTTP线程只负责收发，请求放进 MicroBatcher 的队列:
+# tokens 请求由一个工作线程攒批，合并成一次 encode_batch；转换请求不攒批（没有批量转换的接口），
+# 放进另一个队列，由单独的转换线程逐个按 ConversionLimits 执行，大的转换不会挡住排在后面的 tokens 请求。
+# parser、renderer 和 tiktoken 编码启动时加载好之后一直复用。
+# 请求体超过 maxBodyBytes 时不读，直接返回413并关闭连接。
+
+# 默认的请求体上限，blocks 的json比对应的markdown大很多，按 maxInputBytes 的几十倍留余量
+DEFAULT_MAX_BODY_BYTES = 8 * 1024 * 1024
+
+class RequestKind:
+    markdown = "markdown"
+    blocks = "blocks"
+    tokens = "tokens"
+
+
+class _Stats:
+
+    def __init__(self, window: int = 2048):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.batches = 0
+        self.batchedRequests = 0
+        self.maxBatchSize = 0
+        self.maxQueueDepth = 0
+        # 最近 window 个请求的 (排队秒数, 总秒数)
+        self._latencies = deque(maxlen=window)
+
+    def recordBatch(self, size: int, queueDepth: int):
+        # 只有 tokens 请求攒批
+        with self._lock:
+            self.batches += 1
+            self.batchedRequests += size
+            self.maxBatchSize = max(self.maxBatchSize, size)
+            self.maxQueueDepth = max(self.maxQueueDepth, queueDepth)
+
+    def recordQueueDepth(self, queueDepth: int):
+        with self._lock:
+            self.maxQueueDepth = max(self.maxQueueDepth, queueDepth)
+
+    def recordRequest(self, kind: str, waited: float, total: float, failed: bool):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            if failed:
+                self.errors += 1
+            self._latencies.append((waited, total))
+
+    def snapshot(self, queueDepth: int) -> Dict[str, Any]:
+        with self._lock:
+            waited = sorted(w for w, _ in self._latencies)
+            total = sorted(t for _, t in self._latencies)
+            return {
+                "uptimeSeconds": time.time() - self.started,
+                "requests": dict(self.requests),
+                "errors": self.errors,
+                "queueDepth": queueDepth,
+                "maxQueueDepth": self.maxQueueDepth,
+                "batches": self.batches,
+                "meanBatchSize": self.batchedRequests / self.batches
+                if self.batches else 0.0,
+                "maxBatchSize": self.maxBatchSize,
+                "latencyMs": _percentiles(total),
+                "queueWaitMs": _percentiles(waited),
+            }
+
+
+def _percentiles(sortedSeconds: List[float]) -> Dict[str, float]:
+    if not sortedSeconds:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    last = len(sortedSeconds) - 1
+    return {name: sortedSeconds[min(last, int(round(q * last)))] * 1000
+            for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))}
+
+
+class MicroBatcher:
+    """submit 返回 Future。tokens 请求由攒批线程处理，队列里有请求时最多再等 maxWait 秒凑满
+    maxBatch 个；markdown/blocks 转换不攒批，由 converters 个转换线程逐个执行，
+    每次转换受 limits 限制，默认是 ConversionLimits()。"""
+
+    def __init__(self, maxBatch: int = 64, maxWait: float = 0.002,
+                 converters: int = 1, limits: Optional[ConversionLimits] = None):
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.limits = limits if limits is not None else ConversionLimits()
+        self.stats = _Stats()
+        # tokens 请求
+        self._queue: "queue.Queue[Optional[Tuple[str, Any, Future, float]]]" = \
+            queue.Queue()
+        # markdown/blocks 转换请求
+        self._convertQueue: "queue.Queue[Optional[Tuple[str, Any, Future, float]]]" = \
+            queue.Queue()
+        self._threads = [threading.Thread(target=self._run, name="trickle-batcher",
+                                          daemon=True)]
+        self._threads.extend([
+            threading.Thread(target=self._runConversions,
+                             name=f"trickle-converter-{i}", daemon=True)
+            for i in range(max(1, converters))
+        ])
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, kind: str, payload: Any) -> Future:
+        future = Future()
+        target = self._queue if kind == RequestKind.tokens else self._convertQueue
+        target.put((kind, payload, future, time.perf_counter()))
+        return future
+
+    def queueDepth(self) -> int:
+        return self._queue.qsize() + self._convertQueue.qsize()
+
+    def close(self):
+        self._queue.put(None)
+        for _ in self._threads[1:]:
+            self._convertQueue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _collect(self, first) -> Tuple[list, bool]:
+        batch = [first]
+        deadline = time.perf_counter() + self.maxWait
+        while len(batch) < self.maxBatch:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 \
+                    else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, stopping = self._collect(first)
+            self.stats.recordBatch(len(batch), self.queueDepth() + len(batch))
+            self._runTokens(batch, time.perf_counter())
+            if stopping:
+                return
+
+    def _runConversions(self):
+        while True:
+            item = self._convertQueue.get()
+            if item is None:
+                return
+            self.stats.recordQueueDepth(self.queueDepth() + 1)
+            self._runOne(item, time.perf_counter())
+
+    def _finish(self, item, started: float, result=None, error: Exception = None):
+        kind, _, future, submitted = item
+        self.stats.recordRequest(kind, started - submitted,
+                                 time.perf_counter() - submitted, error is not None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _runTokens(self, items, started: float):
+        # 所有请求里的文本拼成一次 encode_batch，再按请求拆回去
+        texts = []
+        for _, payload, _, _ in items:
+            texts.extend(payload)
+        try:
+            counts = [len(t) for t in tokenizer.encodeBatch(texts)]
+        except Exception as e:
+            if len(items) == 1:
+                self._finish(items[0], started, error=e)
+                return
+            # 整批失败时逐个请求重新encode，只有出错的请求失败
+            for item in items:
+                self._runTokens([item], started)
+            return
+        i = 0
+        for item in items:
+            n = len(item[1])
+            self._finish(item, started, result=counts[i:i + n])
+            i += n
+
+    def _runOne(self, item, started: float):
+        kind, payload, _, _ = item
+        try:
+            result = _converters[kind](payload, self.limits)
+        except Exception as e:
+            self._finish(item, started, error=e)
+            return
+        self._finish(item, started, result=result)
+
+
+def _toMarkdown(payload: Dict[str, Any], limits: ConversionLimits) -> str:
+    out = blocksToMarkdown(payload["blocks"],
+                           profile=payload.get("profile", RenderProfile.default),
+                           limits=limits)
+    maxTokens = payload.get("maxTokens")
+    if maxTokens is not None:
+        out = truncateText(out, maxTokens)
+    return out
+
+
+def _toBlocks(payload: Dict[str, Any], limits: ConversionLimits) -> List[Dict]:
+    return createAssistantCommentBlocks(payload["markdown"],
+                                        urlRefs=payload.get("urlRefs"),
+                                        useCache=False, limits=limits)
+
+
+_converters: Dict[str, Callable[[Any, ConversionLimits], Any]] = {
+    RequestKind.markdown: _toMarkdown,
+    RequestKind.blocks: _toBlocks,
+}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _parseRequest(kind: str, body: Dict[str, Any]):
+    if kind == RequestKind.markdown:
+        if not isinstance(body.get("blocks"), list):
+            raise BadRequest("'blocks' must be a list")
+        return body
+    if kind == RequestKind.blocks:
+        if not isinstance(body.get("markdown"), str):
+            raise BadRequest("'markdown' must be a string")
+        return body
+    if isinstance(body.get("text"), str):
+        return [body["text"]]
+    texts = body.get("texts")
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        raise BadRequest("expected 'text' or a list of strings in 'texts'")
+    return texts
+
+
+class SidecarHandler(BaseHTTPRequestHandler):
+    server_version = "TrickleBlockSidecar/1"
+    # keep-alive，客户端可以复用连接
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status: int, body: Dict[str, Any], close: bool = False):
+        # close: 请求体没有读完，连接不能再复用
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        if close:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        batcher: MicroBatcher = self.server.batcher
+        if self.path == "/stats":
+            self._send(200, batcher.stats.snapshot(batcher.queueDepth()))
+        elif self.path == "/health":
+            self._send(200, {"ok": True})
+        else:
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        kind = self.path.strip("/")
+        if kind not in (RequestKind.markdown, RequestKind.blocks, RequestKind.tokens):
+            self._send(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send(400, {"error": "invalid Content-Length"}, close=True)
+            return
+        maximum = self.server.maxBodyBytes
+        if maximum is not None and length > maximum:
+            self._send(413, {"error": f"request body of {length} bytes "
+                                      f"exceeds {maximum}"}, close=True)
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise BadRequest("request body must be a json object")
+            payload = _parseRequest(kind, body)
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+            return
+        try:
+            result = self.server.batcher.submit(kind, payload).result()
+        except Exception as e:
+            self._send(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        if kind == RequestKind.tokens and "text" in body:
+            result = result[0]
+        key = {RequestKind.markdown: "markdown", RequestKind.blocks: "blocks",
+               RequestKind.tokens: "tokens"}[kind]
+        self._send(200, {key: result})
+
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.path, *args)
+
+
+class _SidecarMixin:
+    daemon_threads = True
+    # 默认的 listen backlog 只有5，并发连接多时unix socket会直接返回EAGAIN
+    request_queue_size = 128
+    maxBodyBytes: Optional[int] = DEFAULT_MAX_BODY_BYTES
+
+    def setUpBatcher(self, batcher: MicroBatcher):
+        self.batcher = batcher
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+
+
+class SidecarHTTPServer(_SidecarMixin, ThreadingHTTPServer):
+    pass
+
+
+class SidecarUnixServer(_SidecarMixin, socketserver.ThreadingUnixStreamServer):
+
+    def get_request(self):
+        # unix socket 没有客户端地址，BaseHTTPRequestHandler 需要一个 (host, port)
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def _removeStaleSocket(path: str):
+    # 只删除上次退出时留下的socket文件，路径写错时不会删掉普通文件
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a unix socket")
+    os.unlink(path)
+
+
+def createServer(host: str = "127.0.0.1", port: int = 8765,
+                 unixSocket: Optional[str] = None, maxBatch: int = 64,
+                 maxWait: float = 0.002, warm: bool = True, converters: int = 1,
+                 limits: Optional[ConversionLimits] = None,
+                 maxBodyBytes: Optional[int] = DEFAULT_MAX_BODY_BYTES):
+    """创建服务（还没开始 serve_forever）。port=0 时由系统分配端口，见 server.server_address。
+    converters、limits 见 MicroBatcher；maxBodyBytes 是请求体的上限，None 不限制。"""
+    if warm:
+        try:
+            warmUp()
+        except Exception:
+            # 拿不到 tiktoken 编码时转换照常提供，tokens 请求返回错误
+            logger.exception("warm up failed")
+    if unixSocket is not None:
+        _removeStaleSocket(unixSocket)
+        server = SidecarUnixServer(unixSocket, SidecarHandler)
+    else:
+        server = SidecarHTTPServer((host, port), SidecarHandler)
+    server.maxBodyBytes = maxBodyBytes
+    server.setUpBatcher(MicroBatcher(maxBatch=maxBatch, maxWait=maxWait,
+                                     converters=converters, limits=limits))
+    return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.unixPath = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unixPath)
+
+
+class SidecarError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class SidecarClient:
+    """SidecarClient(port=8765) 或 SidecarClient(unixSocket="/tmp/trickle.sock")。
+    一个client保持一个连接，不是线程安全的，多线程时每个线程各建一个。"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765,
+                 unixSocket: Optional[str] = None, timeout: float = 30.0):
+        if unixSocket is not None:
+            self._conn = _UnixHTTPConnection(unixSocket, timeout)
+        else:
+            self._conn = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method: str, path: str, body: Optional[Dict] = None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        self._conn.request(method, path, body=data, headers=headers)
+        response = self._conn.getresponse()
+        out = json.loads(response.read())
+        if response.status != 200:
+            raise SidecarError(response.status, out.get("error", ""))
+        return out
+
+    def toMarkdown(self, blocks: List[Dict], profile: str = RenderProfile.default,
+                   maxTokens: Optional[int] = None) -> str:
+        return self._request("POST", "/markdown", {
+            "blocks": blocks, "profile": profile, "maxTokens": maxTokens,
+        })["markdown"]
+
+    def toBlocks(self, markdown: str, urlRefs: Optional[Dict[str, str]] = None
+                 ) -> List[Dict]:
+        return self._request("POST", "/blocks", {
+            "markdown": markdown, "urlRefs": urlRefs,
+        })["blocks"]
+
+    def countTokens(self, text: str) -> int:
+        return self._request("POST", "/tokens", {"text": text})["tokens"]
+
+    def countTokensBatch(self, texts: List[str]) -> List[int]:
+        return self._request("POST", "/tokens", {"texts": texts})["tokens"]
+
+    def stats(self) -> Dict[str, Any]:
+        return self._request("GET", "/stats")
+
+    def close(self):
+        self._conn.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m trickle_block_util.server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None,
+                        help="listen on a unix socket instead of tcp")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0,
+                        help="how long the batcher waits to fill a batch")
+    parser.add_argument("--converters", type=int, default=1,
+                        help="threads running markdown/blocks conversions")
+    parser.add_argument("--max-seconds", type=float, default=5.0,
+                        help="time limit of a single conversion")
+    parser.add_argument("--max-body-bytes", type=int,
+                        default=DEFAULT_MAX_BODY_BYTES,
+                        help="reject larger request bodies with 413")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    server = createServer(host=args.host, port=args.port,
+                          unixSocket=args.unix_socket, maxBatch=args.max_batch,
+                          maxWait=args.max_wait_ms / 1000,
+                          converters=args.converters,
+                          limits=ConversionLimits(maxSeconds=args.max_seconds),
+                          maxBodyBytes=args.max_body_bytes)
+    logger.info("listening on %s", args.unix_socket or server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+from typing import List, Dict, Optional, Tuple
+
+from trickle_block_util import tokenizer
+from trickle_block_util.generator import Block, RenderProfile, \
+    _blockMarkdownEntries, _digest, getTextTokens, truncateText
+from trickle_block_util.metrics import Stage, stageTimer
+
+
+# 存储层可以在每个顶层block（和每条评论）上保存算好的token数，拼prompt时直接累加，
+# 只对没有标注或者标注已经过期的block调用tokenizer。
+#
+# 标注格式，key是 "模型/profile"，hash是 Block.contentHash()，内容变了hash就对不上:
+#   block["tokenCounts"] = {"gpt-3.5-turbo/default": {"hash": "...", "tokens": 42}}
+#   comment["tokenCounts"] 同样格式，hash见 commentContentHash
+#
+# block之间用 "\n" 连接，每个分隔符按1个token计算。逐个block相加得到的是估计值，
+# 跨block边界的token不会合并，所以一般会略多于整体tokenize的结果，用来卡预算是偏保守的。
+
+TOKEN_COUNTS = "tokenCounts"
+
+
+def annotationKey(profile: str = RenderProfile.default) -> str:
+    return f"{tokenizer.MODEL}/{profile}"
+
+
+def hasAnnotations(blocks: List) -> bool:
+    return any(isinstance(b, dict) and TOKEN_COUNTS in b for b in blocks)
+
+
+def freshTokenCount(record, key: str, contentHash: str) -> Optional[int]:
+    counts = record.get(TOKEN_COUNTS) if isinstance(record, dict) else None
+    if not counts:
+        return None
+    annotation = counts.get(key)
+    if annotation is None or annotation.get("hash") != contentHash:
+        return None
+    return annotation.get("tokens")
+
+
+def _annotate(record: Dict, key: str, contentHash: str, tokens: int):
+    record.setdefault(TOKEN_COUNTS, {})[key] = {"hash": contentHash, "tokens": tokens}
+
+
+def commentContentHash(authorName: str, blocks: List[Block]) -> str:
+    return _digest([authorName, [b.contentHash() for b in blocks]])
+
+
+class TokenCounter:
+    """按标注或tokenizer计算每个block的token数，reused/tokenized 记录用了多少标注、调了多少次tokenizer。"""
+
+    def __init__(self, profile: str = RenderProfile.default):
+        self.profile = profile
+        self.key = annotationKey(profile)
+        self.reused = 0
+        self.tokenized = 0
+
+    def entries(self, blocks: List) -> List[Tuple[Optional[Dict], Optional[Block], str]]:
+        with stageTimer(Stage.markdown, inputSize=len(blocks)) as timer:
+            out = _blockMarkdownEntries(blocks, self.profile, None)
+            timer.outputSize = len(out)
+        return out
+
+    def entryTokens(self, data: Optional[Dict], blk: Optional[Block], md: str) -> int:
+        if blk is not None:
+            tokens = freshTokenCount(data, self.key, blk.contentHash())
+            if tokens is not None:
+                self.reused += 1
+                return tokens
+        self.tokenized += 1
+        return getTextTokens(md)
+
+    def blocksTokens(self, entries) -> int:
+        # block之间的 "\n" 各算一个token
+        return sum(self.entryTokens(*e) for e in entries) + max(0, len(entries) - 1)
+
+
+def estimateTokens(blocks: List, profile: str = RenderProfile.default
+                   ) -> Tuple[int, Dict[str, int]]:
+    """blocksToMarkdown(blocks, profile) 的token数估计，返回 (tokens, {"reused", "tokenized"})。"""
+    counter = TokenCounter(profile)
+    tokens = counter.blocksTokens(counter.entries(blocks))
+    return tokens, {"reused": counter.reused, "tokenized": counter.tokenized}
+
+
+def annotateTokenCounts(blocks: List[Dict], profile: str = RenderProfile.default,
+                        force: bool = False) -> int:
+    """给顶层block写入当前模型和profile的token数标注（原地修改），返回新写入的数量。
+    已有的标注没过期时跳过，force=True 全部重新计算。"""
+    counter = TokenCounter(profile)
+    return _annotateEntries(counter, counter.entries(blocks), force)
+
+
+def _annotateEntries(counter: TokenCounter, entries, force: bool) -> int:
+    written = 0
+    for data, blk, md in entries:
+        if blk is None or not isinstance(data, dict):
+            continue
+        contentHash = blk.contentHash()
+        if not force and freshTokenCount(data, counter.key, contentHash) is not None:
+            continue
+        _annotate(data, counter.key, contentHash, getTextTokens(md))
+        written += 1
+    return written
+
+
+def annotateCommentTokenCounts(comments: List[Dict],
+                               profile: str = RenderProfile.default,
+                               force: bool = False) -> int:
+    """给评论的block和评论本身（"作者: markdown" 整体）写入token数标注，返回新写入的数量。
+    comments 的格式同 generateTrickleNormalCommentPrompt。"""
+    counter = TokenCounter(profile)
+    written = 0
+    for comment in comments:
+        blocks = comment.get('commentBlocks')
+        if blocks is None:
+            continue
+        # 每个block只渲染一次，block和评论的标注共用
+        entries = counter.entries(blocks)
+        written += _annotateEntries(counter, entries, force)
+        contentHash = commentContentHash(
+            comment['commentAuthorName'], [blk for _, blk, _ in entries if blk])
+        if not force and freshTokenCount(comment, counter.key, contentHash) is not None:
+            continue
+        commentStr = f"{comment['commentAuthorName']}: " + \
+            "\n".join([md for _, _, md in entries])
+        _annotate(comment, counter.key, contentHash, getTextTokens(commentStr))
+        written += 1
+    return written
+
+
+def budgetContent(title: str, blocks: List, maxTokens: int,
+                  profile: str = RenderProfile.default) -> str:
+    """generateTrickleContentPrompt 的按block预算版本: 能放下的block整个保留，
+    第一个放不下的block截断到剩余的token数，后面的丢掉。"""
+    counter = TokenCounter(profile)
+    head = title + "\n" if title else ""
+    used = getTextTokens(head) if head else 0
+    if used >= maxTokens:
+        return truncateText(head, maxTokens)
+    parts: List[str] = []
+    for data, blk, md in counter.entries(blocks):
+        separator = 1 if parts else 0
+        cost = counter.entryTokens(data, blk, md) + separator
+        if used + cost <= maxTokens:
+            parts.append(md)
+            used += cost
+            continue
+        remaining = maxTokens - used - separator
+        if remaining > 0:
+            parts.append(truncateText(md, remaining))
+        break
+    return head + "\n".join(parts)
+
+
+class CommentTokenCounter(TokenCounter):
+    """generateTrickleNormalCommentPrompt 用: 有标注的评论逐block渲染并记下结果，
+    算预算时优先用评论本身的标注，其次累加block的标注。"""
+
+    def __init__(self, profile: str = RenderProfile.default):
+        super().__init__(profile)
+        # id(comment) -> entries
+        self._entries: Dict[int, list] = {}
+        self._prefixTokens: Dict[str, int] = {}
+
+    def annotated(self, comment: Dict) -> bool:
+        return TOKEN_COUNTS in comment or hasAnnotations(comment['commentBlocks'])
+
+    def render(self, comment: Dict) -> str:
+        entries = self.entries(comment['commentBlocks'])
+        self._entries[id(comment)] = entries
+        return "\n".join([md for _, _, md in entries])
+
+    def commentTokens(self, comment: Dict, commentStr: str) -> int:
+        entries = self._entries.get(id(comment))
+        if entries is None:
+            self.tokenized += 1
+            return getTextTokens(commentStr)
+        authorName = comment['commentAuthorName']
+        tokens = freshTokenCount(comment, self.key, commentContentHash(
+            authorName, [blk for _, blk, _ in entries if blk]))
+        if tokens is not None:
+            self.reused += 1
+            return tokens
+        prefix = self._prefixTokens.get(authorName)
+        if prefix is None:
+            prefix = getTextTokens(f"{authorName}: ")
+            self._prefixTokens[authorName] = prefix
+        return prefix + self.blocksTokens(entries)
@@ -0,0 +1,37 @@
+from typing import List
+import threading
+
+
+# tiktoken 导入和加载编码文件都比较慢（第一次还要下载），只在第一次计算token时加载。
+# 加载好的编码可以在多个线程里同时使用，encode/decode 执行时会释放GIL。
+
+MODEL = "gpt-3.5-turbo"
+
+_encoding = None
+_encodingLock = threading.Lock()
+
+
+def getEncoding():
+    global _encoding
+    encoding = _encoding
+    if encoding is None:
+        # 多个线程同时第一次调用时只加载一次
+        with _encodingLock:
+            if _encoding is None:
+                import tiktoken
+                _encoding = tiktoken.encoding_for_model(MODEL)
+            encoding = _encoding
+    return encoding
+
+
+def encode(text: str) -> List[int]:
+    return getEncoding().encode(text)
+
+
+def decode(tokens: List[int]) -> str:
+    return getEncoding().decode(tokens)
+
+
+def encodeBatch(texts: List[str]) -> List[List[int]]:
+    # tiktoken 在自己的线程池里并行编码
+    return getEncoding().encode_batch(texts)
@@ -0,0 +1,115 @@
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+
+# 用显式栈遍历 block/element/mistune token 树，不依赖python递归。
+# AI输出或者客户端传来的数据嵌套很深时，递归会撞上 recursion limit，
+# 这里超过 maxDepth 会抛出 TraversalDepthError。
+
+DEFAULT_MAX_DEPTH = 1000
+
+# 全局的最大深度，各个遍历函数没有传 maxDepth 时使用
+maxDepth = DEFAULT_MAX_DEPTH
+
+
+def setMaxDepth(depth: int):
+    global maxDepth
+    maxDepth = depth
+
+
+class TraversalDepthError(ValueError):
+
+    def __init__(self, depth: int, limit: int):
+        super().__init__(f"tree is nested deeper than the max depth {limit}")
+        self.depth = depth
+        self.limit = limit
+
+
+def checkDepth(depth: int, limit: Optional[int] = None):
+    limit = maxDepth if limit is None else limit
+    if depth > limit:
+        raise TraversalDepthError(depth, limit)
+
+
+def walkPreOrder(root, getChildren: Callable[[Any], Iterable],
+                 maxDepth: Optional[int] = None) -> Iterator[Tuple[Any, int]]:
+    """先序遍历，yield (node, depth)，root的depth是0。"""
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        checkDepth(depth, maxDepth)
+        yield node, depth
+        children = getChildren(node)
+        if children:
+            stack.extend([(c, depth + 1) for c in reversed(list(children))])
+
+
+def walkPostOrder(root, getChildren: Callable[[Any], Iterable],
+                  maxDepth: Optional[int] = None) -> Iterator[Tuple[Any, int]]:
+    """后序遍历，子节点都处理完之后才 yield (node, depth)。"""
+    # (node, depth, 子节点是否已经入栈)
+    stack = [(root, 0, False)]
+    while stack:
+        node, depth, expanded = stack.pop()
+        if expanded:
+            yield node, depth
+            continue
+        checkDepth(depth, maxDepth)
+        stack.append((node, depth, True))
+        children = getChildren(node)
+        if children:
+            stack.extend([(c, depth + 1, False)
+                          for c in reversed(list(children))])
+
+
+def foldTree(root, getChildren: Callable[[Any], Iterable],
+             combine: Callable[[Any, List], Any],
+             maxDepth: Optional[int] = None):
+    """自底向上合并: combine(node, [每个子节点的结果]) -> node的结果。"""
+    # 每一帧: [node, 子节点列表, 下一个要处理的子节点下标, 已有的子节点结果]
+    children = getChildren(root)
+    stack = [[root, list(children) if children else [], 0, []]]
+    while True:
+        frame = stack[-1]
+        node, nodeChildren, i, results = frame
+        if i < len(nodeChildren):
+            frame[2] = i + 1
+            child = nodeChildren[i]
+            checkDepth(len(stack), maxDepth)
+            grandChildren = getChildren(child)
+            stack.append([child, list(grandChildren) if grandChildren else [],
+                          0, []])
+            continue
+        result = combine(node, results)
+        stack.pop()
+        if not stack:
+            return result
+        stack[-1][3].append(result)
+
+
+class Visitor:
+    """继承后重写 enter/leave。enter 返回 False 时不再进入这个节点的子节点。"""
+
+    def getChildren(self, node) -> Iterable:
+        return getattr(node, 'blocks', None) or []
+
+    def enter(self, node, depth: int) -> bool:
+        return True
+
+    def leave(self, node, depth: int):
+        pass
+
+    def walk(self, root, maxDepth: Optional[int] = None):
+        stack = [(root, 0, False)]
+        while stack:
+            node, depth, entered = stack.pop()
+            if entered:
+                self.leave(node, depth)
+                continue
+            checkDepth(depth, maxDepth)
+            descend = self.enter(node, depth)
+            stack.append((node, depth, True))
+            if descend is not False:
+                children = self.getChildren(node)
+                if children:
+                    stack.extend([(c, depth + 1, False)
+                                  for c in reversed(list(children))])